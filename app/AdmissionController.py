@@ -0,0 +1,141 @@
+"""
+AdmissionController.py : a class deciding if the STOW-RS service can accept more data, based on the S3 upload backlog and the free disk space.
+
+SPDX-License-Identifier: Apache 2.0
+"""
+
+import os
+import time
+import asyncio
+import shutil
+import logging
+from threading import Condition
+from concurrent import futures
+
+
+class AdmissionController:
+    """
+    The service is considered overloaded when the bytes waiting to be uploaded exceed queuedBytesHigh or when the free space
+    of the temp folder drops below freeDiskLow. It stays overloaded until both are back under queuedBytesLow / above freeDiskHigh.
+    While overloaded, new STOW-RS requests are refused with a 503 and the requests in progress pause between instances.
+    """
+
+    queuedBytesHigh = 2147483648
+    queuedBytesLow = 1073741824
+    freeDiskLow = 1073741824
+    freeDiskHigh = 2147483648
+    maxInstancesInFlight = 256     # per transaction, 0 means unlimited.
+    retryAfter = 5
+    maxPause = 30
+
+
+    def __init__(self, uploader, folder, workers=1):
+        # workers : the number of processes sharing the temp folder, each one gets its share of the upload backlog.
+        self.uploader = uploader
+        self.folder = folder
+        self.overloaded = False
+        self.condition = Condition()
+        self._configure(workers)
+
+    def _configure(self, workers):
+        self.queuedBytesHigh = self.__readEnv("QUEUEDBYTESHIGH", self.queuedBytesHigh) // workers
+        self.queuedBytesLow = self.__readEnv("QUEUEDBYTESLOW", min(self.queuedBytesLow, self.queuedBytesHigh*workers)) // workers
+        self.freeDiskLow = self.__readEnv("FREEDISKLOW", self.freeDiskLow)
+        self.freeDiskHigh = self.__readEnv("FREEDISKHIGH", max(self.freeDiskHigh, self.freeDiskLow))
+        self.maxInstancesInFlight = self.__readEnv("MAXINSTANCESINFLIGHT", self.maxInstancesInFlight)
+        self.retryAfter = self.__readEnv("RETRYAFTER", self.retryAfter)
+        self.maxPause = self.__readEnv("MAXPAUSE", self.maxPause)
+        logging.debug(f"Admission control : queued bytes {self.queuedBytesLow}-{self.queuedBytesHigh}, free disk {self.freeDiskLow}-{self.freeDiskHigh}, {self.maxInstancesInFlight} instances in flight per transaction.")
+
+    @staticmethod
+    def __readEnv(name, default):
+        try:
+            return int(os.environ[name])
+        except:
+            return default
+
+    def __freeDisk(self):
+        try:
+            return shutil.disk_usage(self.folder).free
+        except FileNotFoundError:
+            os.makedirs(self.folder, exist_ok=True)
+            return shutil.disk_usage(self.folder).free
+
+    def IsOverloaded(self):
+        stats = self.uploader.GetStats()
+        # the files of the failed uploads stay in the temp folder until they are replayed, they are part of the backlog.
+        queuedBytes = stats["queued_bytes"] + stats.get("kept_bytes", 0)
+        freeDisk = self.__freeDisk()
+        with self.condition:
+            if not self.overloaded and (queuedBytes > self.queuedBytesHigh or freeDisk < self.freeDiskLow):
+                logging.warning(f"STOW-RS service overloaded : {queuedBytes} bytes waiting for upload, {freeDisk} bytes free on disk.")
+                self.overloaded = True
+            elif self.overloaded and queuedBytes < self.queuedBytesLow and freeDisk > self.freeDiskHigh:
+                logging.warning("STOW-RS service load back to normal.")
+                self.overloaded = False
+            return self.overloaded
+
+    def Admit(self):
+        # Returns False if a new STOW-RS request should be refused.
+        return not self.IsOverloaded()
+
+    def Notify(self):
+        # To be called when an upload completes, wakes up the requests waiting for capacity.
+        with self.condition:
+            self.condition.notify_all()
+
+    def WaitForCapacity(self, transaction):
+        """
+        Blocks the request thread before it reads its next instance while the service is overloaded, or while the transaction
+        has maxInstancesInFlight instances waiting for their upload.
+        A transaction pauses maxPause seconds at most in total : once its pause budget is spent, its next instances are refused
+        without waiting as long as the capacity is not back.
+
+        Args:
+            transaction : the StowRsTransaction. The completed futures are removed from its transactionUploads list, and
+                          its admissionDeadline is set at its first pause.
+
+        Returns:
+            False if the capacity was not recovered before the deadline of the transaction.
+        """
+        uploads = transaction.transactionUploads
+        uploads[:] = [f for f in uploads if not f.done()]
+        if self.maxInstancesInFlight > 0 and len(uploads) >= self.maxInstancesInFlight:
+            remaining = self.__remainingPause(transaction)
+            if remaining > 0:
+                futures.wait(uploads, timeout=remaining, return_when=futures.FIRST_COMPLETED)
+            uploads[:] = [f for f in uploads if not f.done()]
+            if len(uploads) >= self.maxInstancesInFlight:
+                return False
+        while self.IsOverloaded():
+            remaining = self.__remainingPause(transaction)
+            if remaining <= 0:
+                return False
+            with self.condition:
+                self.condition.wait(timeout=min(remaining, 1))
+        return True
+
+    async def WaitForCapacityAsync(self, transaction):
+        """
+        Same as WaitForCapacity for the requests handled by the asyncio front end, the event loop is not blocked while waiting.
+        """
+        uploads = transaction.transactionUploads
+        uploads[:] = [f for f in uploads if not f.done()]
+        if self.maxInstancesInFlight > 0 and len(uploads) >= self.maxInstancesInFlight:
+            remaining = self.__remainingPause(transaction)
+            if remaining > 0:
+                await asyncio.wait([asyncio.wrap_future(f) for f in uploads], timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+            uploads[:] = [f for f in uploads if not f.done()]
+            if len(uploads) >= self.maxInstancesInFlight:
+                return False
+        while self.IsOverloaded():
+            remaining = self.__remainingPause(transaction)
+            if remaining <= 0:
+                return False
+            await asyncio.sleep(min(remaining, 1))
+        return True
+
+    def __remainingPause(self, transaction):
+        if transaction.admissionDeadline is None:
+            transaction.admissionDeadline = time.monotonic() + self.maxPause
+        return transaction.admissionDeadline - time.monotonic()
@@ -0,0 +1,83 @@
+"""
+ContentHasher.py : the digests of a received instance, computed while its chunks arrive so that the file is not read again.
+
+SPDX-License-Identifier: Apache 2.0
+"""
+
+import zlib
+import base64
+import hashlib
+
+
+def crc32Value(crc):
+    # The base64 of the big endian CRC32, as S3 expects it in the x-amz-checksum-crc32 header.
+    return base64.b64encode(crc.to_bytes(4, "big")).decode("ascii")
+
+
+class S3ETagHasher:
+    """
+    Computes, while an instance is received, the ETag S3 gives to the object once uploaded by upload_file : the MD5 of the
+    object under the multipart threshold, otherwise the MD5 of the MD5s of its parts followed by "-" and the number of parts.
+    The objects encrypted with SSE-KMS get another ETag, their HEAD check never matches and they are uploaded again.
+    """
+
+    minPartSize = 5242880   # s3transfer raises smaller part sizes to the S3 minimum.
+
+    def __init__(self, multipartThreshold, partSize):
+        self.multipartThreshold = multipartThreshold
+        self.partSize = max(partSize, self.minPartSize)
+        self.whole = hashlib.md5()
+        self.part = hashlib.md5()
+        self.partDigests = []
+        self.partFill = 0
+        self.size = 0
+
+    def update(self, data):
+        view = memoryview(data)
+        self.size += len(view)
+        if self.whole is not None:
+            if self.size < self.multipartThreshold:
+                self.whole.update(view)
+            else:
+                self.whole = None    # the object is sent in parts.
+        while len(view) > 0:
+            taken = min(len(view), self.partSize - self.partFill)
+            self.part.update(view[:taken])
+            self.partFill += taken
+            view = view[taken:]
+            if self.partFill == self.partSize:
+                self.partDigests.append(self.part.digest())
+                self.part = hashlib.md5()
+                self.partFill = 0
+
+    def etag(self):
+        if self.whole is not None:
+            return self.whole.hexdigest()
+        digests = self.partDigests + ([ self.part.digest() ] if self.partFill > 0 else [])
+        return hashlib.md5(b"".join(digests)).hexdigest() + "-" + str(len(digests))
+
+
+class ContentHasher:
+    """
+    The digests of an instance needed by its upload : the CRC32 sent to S3 with the instance, which S3 checks against the
+    data it received, and the S3ETagHasher etag of the duplicates detection. Either can be left out.
+    """
+
+    def __init__(self, checksum=True, etagHasher=None):
+        self.crc = 0 if checksum else None
+        self.etagHasher = etagHasher
+        self.size = 0
+
+    def update(self, data):
+        self.size += len(data)
+        if self.crc is not None:
+            self.crc = zlib.crc32(data, self.crc)
+        if self.etagHasher is not None:
+            self.etagHasher.update(data)
+
+    def checksum(self):
+        # The CRC32 of the instance, base64 encoded, or None.
+        return crc32Value(self.crc) if self.crc is not None else None
+
+    def etag(self):
+        return self.etagHasher.etag() if self.etagHasher is not None else None
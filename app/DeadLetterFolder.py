@@ -0,0 +1,111 @@
+"""
+DeadLetterFolder.py : the folder of the instances which could not be copied to S3, and their manifest.
+
+SPDX-License-Identifier: Apache 2.0
+"""
+
+import os
+import json
+import time
+import uuid
+import fcntl
+import logging
+from threading import Lock
+from contextlib import contextmanager
+from concurrent import futures
+
+
+class DeadLetterFolder:
+    """
+    An instance whose upload failed for good is moved to the folder, and a line describing it is appended to manifest.jsonl :
+    { "id", "file", "bucket", "key", "size", "error", "failed" }. The instances stay there until Replay() sends them again,
+    which is what `python3 main.py replay-deadletter` does. The manifest is locked while it is written, the workers of the
+    multi-process mode share it.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.manifest = os.path.join(folder, "manifest.jsonl")
+        self.lock = Lock()
+        os.makedirs(folder, exist_ok=True)
+
+    def Add(self, filepath, bucket, key, error):
+        """
+        Moves filepath to the folder and records it in the manifest.
+
+        Args:
+            filepath :  The local copy of the instance.
+            bucket :    The destination bucket.
+            key :       The destination key.
+            error :     Why the upload failed.
+        Returns:
+            The path of the instance in the folder.
+        Raises:
+            OSError if the file could not be moved.
+        """
+        entryId = uuid.uuid4().hex
+        if os.path.dirname(os.path.abspath(filepath)) == os.path.abspath(self.folder):
+            destination = filepath   # a replayed instance failed again.
+        else:
+            destination = os.path.join(self.folder, entryId+"-"+os.path.basename(filepath))
+            os.replace(filepath, destination)
+        entry = { "id" : entryId, "file" : destination, "bucket" : bucket, "key" : key, "size" : os.path.getsize(destination),
+                  "error" : str(error), "failed" : time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()) }
+        with self.__locked("a") as manifest:
+            manifest.write(json.dumps(entry)+"\n")
+        logging.error(f"Upload of s3://{bucket}/{key} failed for good, the instance was moved to {destination}.")
+        return destination
+
+    def Entries(self):
+        # Returns the list of the manifest entries, as dicts.
+        if not os.path.exists(self.manifest):
+            return []
+        with self.__locked("r") as manifest:
+            return [ json.loads(line) for line in manifest if line.strip() ]
+
+    def Remove(self, entryIds):
+        # Removes the entries from the manifest, their files are left untouched.
+        entryIds = set(entryIds)
+        with self.__locked("r+") as manifest:
+            lines = [ line for line in manifest if line.strip() and json.loads(line)["id"] not in entryIds ]
+            manifest.seek(0)
+            manifest.writelines(lines)
+            manifest.truncate()
+
+    def Replay(self, senders):
+        """
+        Sends the instances of the manifest again and waits for the uploads. The uploaded ones are removed from the folder,
+        the ones which fail again are recorded with a new entry by the sender.
+
+        Args:
+            senders :   A function returning the S3FileManager sending to a bucket. Its onUploaded callback must delete the
+                        uploaded files, and the sender must use this dead letter folder.
+        Returns:
+            The number of instances uploaded, and the number of instances which failed again.
+        Raises:
+            None
+        """
+        entries = self.Entries()
+        uploads = []
+        for entry in entries:
+            if not os.path.exists(entry["file"]):
+                logging.error(f"Dead letter {entry['id']} : {entry['file']} does not exist anymore.")
+                continue
+            uploads.append(senders(entry["bucket"]).AddSendJob([entry["file"], entry["key"]]))
+        futures.wait(uploads)
+        self.Remove([ entry["id"] for entry in entries ])
+        uploaded = sum( 1 for upload in uploads if upload.result() )
+        logging.info(f"Dead letter replay : {uploaded} instance(s) uploaded, {len(uploads) - uploaded} failed again.")
+        return uploaded , len(uploads) - uploaded
+
+    @contextmanager
+    def __locked(self, mode):
+        with self.lock:
+            if mode == "r+" and not os.path.exists(self.manifest):
+                open(self.manifest, "a").close()
+            with open(self.manifest, mode) as manifest:
+                fcntl.flock(manifest, fcntl.LOCK_SH if mode == "r" else fcntl.LOCK_EX)
+                try:
+                    yield manifest
+                finally:
+                    fcntl.flock(manifest, fcntl.LOCK_UN)
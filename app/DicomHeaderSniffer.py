@@ -0,0 +1,205 @@
+"""
+DicomHeaderSniffer.py : an incremental parser reading the UIDs of a DICOM instance from the first bytes of its stream.
+
+SPDX-License-Identifier: Apache 2.0
+"""
+
+import struct
+import zlib
+import logging
+from pydicom import Dataset
+
+
+SOPClassUIDTag = 0x00080016
+SOPInstanceUIDTag = 0x00080018
+StudyInstanceUIDTag = 0x0020000D
+SeriesInstanceUIDTag = 0x0020000E
+TransferSyntaxUIDTag = 0x00020010
+
+ItemTag = 0xFFFEE000
+ItemDelimitationTag = 0xFFFEE00D
+SequenceDelimitationTag = 0xFFFEE0DD
+UndefinedLength = 0xFFFFFFFF
+
+ImplicitVRLittleEndian = "1.2.840.10008.1.2"
+ExplicitVRBigEndian = "1.2.840.10008.1.2.2"
+DeflatedExplicitVRLittleEndian = "1.2.840.10008.1.2.1.99"
+
+# Explicit VRs encoded with 2 reserved bytes and a 4 bytes length.
+LongLengthVRs = { b"OB", b"OD", b"OF", b"OL", b"OV", b"OW", b"SQ", b"SV", b"UC", b"UN", b"UR", b"UT", b"UV" }
+
+WantedTags = { SOPClassUIDTag : "UI", SOPInstanceUIDTag : "UI", StudyInstanceUIDTag : "UI", SeriesInstanceUIDTag : "UI" }
+
+
+class DicomHeaderSniffer:
+    """
+    Watches the bytes of a DICOM instance as they are received ( preamble, file meta information, then the dataset )
+    and stops as soon as the SOP Class, SOP Instance, Study Instance and Series Instance UIDs are known.
+    The values of the other elements are skipped without being buffered.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.skip = 0
+        self.state = "preamble"     # preamble -> meta -> dataset -> done
+        self.littleEndian = True
+        self.implicitVR = False
+        self.transferSyntax = None
+        self.inflater = None
+        self.depth = 0              # sequence nesting level, only the top level elements are of interest.
+        self.tags = {}
+        self.done = False
+
+    def feed(self, data):
+        """
+        Adds the next received bytes of the instance.
+
+        Args:
+            data : the next bytes of the instance.
+
+        Returns:
+            True once the sniffer does not need more data, either because the UIDs were found or because they can't be.
+        """
+        if self.done:
+            return True
+        if self.inflater is not None:
+            data = self.inflater.decompress(data)
+        if self.skip > 0:
+            skipped = min(self.skip, len(data))
+            self.skip -= skipped
+            data = data[skipped:]
+        self.buffer.extend(data)
+        try:
+            self.__parse()
+        except Exception as ex:
+            logging.debug(f"Could not sniff the DICOM header: {ex}")
+            self.__finish()
+        return self.done
+
+    def getDataset(self):
+        """
+        Returns:
+            a pydicom dataset containing the tags "00080016" , "0020000D" , "0020000E" , "00080018", or None if they were not all found.
+        """
+        if len(self.tags) != len(WantedTags):
+            return None
+        ds = Dataset()
+        for tag in sorted(self.tags):
+            ds.add_new(tag, WantedTags[tag], self.tags[tag])
+        return ds
+
+    def __finish(self):
+        self.done = True
+        self.state = "done"
+        self.buffer = bytearray()
+        self.inflater = None
+
+    def __consume(self, length):
+        if length > len(self.buffer):
+            self.skip = length - len(self.buffer)
+            self.buffer = bytearray()
+        else:
+            del self.buffer[:length]
+
+    def __parse(self):
+        while not self.done and self.skip == 0:
+            if self.state == "preamble":
+                if not self.__parsePreamble():
+                    return
+            elif not self.__parseElement():
+                return
+
+    def __parsePreamble(self):
+        if len(self.buffer) < 132:
+            return False
+        if self.buffer[128:132] == b"DICM":
+            self.__consume(132)
+            self.state = "meta"
+        elif self.buffer[0:2] == b"\x02\x00":
+            self.state = "meta"
+        else:
+            # No preamble and no file meta information, guess the encoding from the first element.
+            self.state = "dataset"
+            self.implicitVR = not self.buffer[4:6].isalpha()
+        return True
+
+    def __readElementHeader(self):
+        """
+        Returns:
+            ( tag , vr , length , header length ) of the element at the start of the buffer, or None if the buffer is too short.
+        """
+        if len(self.buffer) < 8:
+            return None
+        endian = "<" if self.littleEndian else ">"
+        group , element = struct.unpack_from(endian+"HH", self.buffer)
+        tag = group << 16 | element
+        if group == 0xFFFE or self.implicitVR:
+            length = struct.unpack_from(endian+"L", self.buffer, 4)[0]
+            return tag , None , length , 8
+        vr = bytes(self.buffer[4:6])
+        if vr in LongLengthVRs:
+            if len(self.buffer) < 12:
+                return None
+            length = struct.unpack_from(endian+"L", self.buffer, 8)[0]
+            return tag , vr , length , 12
+        length = struct.unpack_from(endian+"H", self.buffer, 6)[0]
+        return tag , vr , length , 8
+
+    def __parseElement(self):
+        header = self.__readElementHeader()
+        if header is None:
+            return False
+        tag , vr , length , headerLength = header
+
+        if self.state == "meta":
+            if tag >> 16 != 0x0002:
+                self.__startDataset()
+                return True
+            if tag == TransferSyntaxUIDTag:
+                if len(self.buffer) < headerLength+length:
+                    return False
+                self.transferSyntax = bytes(self.buffer[headerLength:headerLength+length]).decode("ascii").rstrip("\x00 ")
+            self.__consume(headerLength+length)
+            return True
+
+        if tag == ItemTag:
+            # items of undefined length are parsed element by element, the other ones are skipped.
+            self.__consume(headerLength if length == UndefinedLength else headerLength+length)
+            return True
+        if tag == ItemDelimitationTag:
+            self.__consume(headerLength)
+            return True
+        if tag == SequenceDelimitationTag:
+            self.depth -= 1
+            self.__consume(headerLength)
+            return True
+        if length == UndefinedLength:
+            self.depth += 1
+            self.__consume(headerLength)
+            return True
+
+        if self.depth == 0:
+            if tag > SeriesInstanceUIDTag:
+                self.__finish()
+                return True
+            if tag in WantedTags:
+                if length > 128:
+                    raise ValueError(f"invalid length {length} for the UID {tag:08X}")
+                if len(self.buffer) < headerLength+length:
+                    return False
+                self.tags[tag] = bytes(self.buffer[headerLength:headerLength+length]).decode("ascii").rstrip("\x00 ")
+                if len(self.tags) == len(WantedTags):
+                    self.__finish()
+                    return True
+        self.__consume(headerLength+length)
+        return True
+
+    def __startDataset(self):
+        self.state = "dataset"
+        if self.transferSyntax == ImplicitVRLittleEndian:
+            self.implicitVR = True
+        elif self.transferSyntax == ExplicitVRBigEndian:
+            self.littleEndian = False
+        elif self.transferSyntax == DeflatedExplicitVRLittleEndian:
+            self.inflater = zlib.decompressobj(-zlib.MAX_WBITS)
+            self.buffer = bytearray(self.inflater.decompress(bytes(self.buffer)))
@@ -0,0 +1,145 @@
+"""
+InstanceCompressor.py : the lossless compression of the uncompressed instances before their upload, to the Deflated
+Explicit VR Little Endian transfer syntax.
+
+SPDX-License-Identifier: Apache 2.0
+"""
+
+import os
+import zlib
+import time
+import struct
+import logging
+from concurrent.futures import ThreadPoolExecutor
+import StowMetrics
+
+
+ExplicitVRLittleEndian = "1.2.840.10008.1.2.1"
+DeflatedExplicitVRLittleEndian = "1.2.840.10008.1.2.1.99"
+_LONG_VRS = { b"OB", b"OD", b"OF", b"OL", b"OV", b"OW", b"SQ", b"UC", b"UN", b"UR", b"UT" }
+READ_SIZE = 1048576
+
+
+def deflatedFileMeta(elements):
+    """
+    Args:
+        elements :  The bytes of the File Meta Information elements following the group length (0002,0000).
+    Returns:
+        The same elements with the Deflated Explicit VR Little Endian transfer syntax, or None if the instance is not
+        Explicit VR Little Endian or its File Meta Information could not be read.
+    Raises:
+        None
+    """
+    rewritten = bytearray()
+    found = False
+    position = 0
+    while position < len(elements):
+        if position + 8 > len(elements):
+            return None
+        group , element = struct.unpack_from("<HH", elements, position)
+        vr = elements[position+4:position+6]
+        if vr in _LONG_VRS:
+            if position + 12 > len(elements):
+                return None
+            headerSize , length = 12 , struct.unpack_from("<I", elements, position+8)[0]
+        else:
+            headerSize , length = 8 , struct.unpack_from("<H", elements, position+6)[0]
+        end = position + headerSize + length
+        if group != 0x0002 or end > len(elements):
+            return None
+        if element == 0x0010:
+            if elements[position+headerSize:end].rstrip(b"\0 ") != ExplicitVRLittleEndian.encode():
+                return None
+            value = DeflatedExplicitVRLittleEndian.encode()   # 22 bytes, no padding needed.
+            rewritten += struct.pack("<HH2sH", 0x0002, 0x0010, b"UI", len(value)) + value
+            found = True
+        else:
+            rewritten += elements[position:end]
+        position = end
+    return bytes(rewritten) if found else None
+
+
+class InstanceCompressor:
+    """
+    Compresses the Explicit VR Little Endian instances in place : the File Meta Information is kept, with the Deflated
+    Explicit VR Little Endian transfer syntax, and the data set that follows is deflated ( RFC 1951, no zlib header ) as
+    it is read. The data set is not parsed, its encoding stays the same. pydicom, and thus dicom_to_static_web, inflates
+    the data set when it reads the instance.
+    The other transfer syntaxes are left as they are, and so are the instances which would not shrink by minSaving.
+    The compression runs on threads of its own, zlib releases the GIL while it compresses.
+    """
+
+    level = 1
+    threads = os.cpu_count() or 1
+    minSaving = 0.05
+
+    def __init__(self):
+        self.level = self.__readEnv("COMPRESSIONLEVEL", self.level)
+        self.threads = max(1, self.__readEnv("COMPRESSTHREADS", self.threads))
+        self.executor = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix="compress")
+        logging.info(f"Uncompressed instances deflated before their upload, level {self.level}, {self.threads} thread(s).")
+
+    @staticmethod
+    def __readEnv(name, default):
+        try:
+            return int(os.environ[name])
+        except:
+            return default
+
+    def Submit(self, function, *args):
+        return self.executor.submit(function, *args)
+
+    def Compress(self, filepath, hasher=None):
+        """
+        Args:
+            filepath :  The instance to compress, replaced by its compressed version.
+            hasher :    An optional ContentHasher, fed with the compressed instance as it is written.
+        Returns:
+            The size of the compressed instance, or None if the instance was left as it is.
+        Raises:
+            None
+        """
+        started = time.thread_time()
+        temp = filepath + ".deflate"
+        try:
+            with open(filepath, "rb") as source:
+                preamble = source.read(132)
+                groupLength = source.read(12)
+                if preamble[128:] != b"DICM" or groupLength[:6] != b"\x02\x00\x00\x00UL":
+                    return None
+                meta = deflatedFileMeta(source.read(struct.unpack_from("<I", groupLength, 8)[0]))
+                if meta is None:
+                    return None
+                size = os.fstat(source.fileno()).st_size
+                compressor = zlib.compressobj(self.level, zlib.DEFLATED, -zlib.MAX_WBITS)
+                with open(temp, "wb") as target:
+                    def write(data):
+                        target.write(data)
+                        if hasher is not None:
+                            hasher.update(data)
+                    write(preamble + struct.pack("<HH2sHI", 0x0002, 0x0000, b"UL", 4, len(meta)) + meta)
+                    while chunk := source.read(READ_SIZE):
+                        write(compressor.compress(chunk))
+                    write(compressor.flush())
+                    compressedSize = target.tell()
+            if compressedSize > size * (1 - self.minSaving):
+                os.remove(temp)
+                logging.debug(f"{filepath} left uncompressed, deflate only brings it from {size} to {compressedSize} bytes.")
+                return None
+            os.replace(temp, filepath)
+        except Exception as ex:
+            logging.warning(f"Could not compress {filepath}, it is uploaded as it is : {ex}")
+            try:
+                os.remove(temp)
+            except OSError:
+                pass
+            return None
+        finally:
+            StowMetrics.compressionSeconds.inc(time.thread_time() - started)
+        StowMetrics.compressedInstances.inc()
+        StowMetrics.compressionSavedBytes.inc(size - compressedSize)
+        logging.debug(f"{filepath} deflated from {size} to {compressedSize} bytes.")
+        return compressedSize
+
+    def Shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
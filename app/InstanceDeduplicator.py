@@ -0,0 +1,94 @@
+"""
+InstanceDeduplicator.py : the detection of the instances sent again, which are already stored in S3 with the same content.
+
+SPDX-License-Identifier: Apache 2.0
+"""
+
+import os
+import logging
+import collections
+from threading import Lock
+import StowMetrics
+
+
+class InstanceDeduplicator:
+    """
+    Remembers the ETag of the capacity instances stored last, in LRU order. An instance received again with the same key
+    and the same content is not uploaded : IsDuplicate() finds it in the index while the request is handled. With
+    headCheck, the instances missing from the index are looked up in S3 by the upload thread before their upload, see
+    IsStored().
+    """
+
+    capacity = 50000
+
+    def __init__(self, headCheck=True):
+        self.headCheck = headCheck
+        try:
+            self.capacity = int(os.environ["DEDUPINDEXSIZE"])
+        except:
+            pass
+        self.index = collections.OrderedDict()  # S3 key -> ETag
+        self.lock = Lock()
+        logging.info(f"Duplicate instances detection : index of {self.capacity} instances{', then S3 HEAD check' if headCheck else ''}.")
+
+    def Remember(self, key, etag):
+        if etag is None:
+            return
+        with self.lock:
+            self.index[key] = etag
+            self.index.move_to_end(key)
+            while len(self.index) > self.capacity:
+                self.index.popitem(last=False)
+
+    def IsDuplicate(self, key, etag, size=0):
+        """
+        Args:
+            key :   The S3 key of the instance.
+            etag :  The S3ETagHasher.etag() of the received instance.
+            size :  Its size, for the metrics.
+        Returns:
+            True if the same content was stored lately under key.
+        Raises:
+            None
+        """
+        with self.lock:
+            stored = self.index.get(key)
+            if stored is not None:
+                self.index.move_to_end(key)
+        if stored is None or stored != etag:
+            return False
+        self.__count("index", size)
+        return True
+
+    def IsStored(self, head, key, etag, size=0, storedEtag=None):
+        """
+        The HEAD check of an instance missing from the index.
+
+        Args:
+            head :          A function returning the ETag of the object stored under key, or None if there is none.
+            key :           The S3 key of the instance.
+            etag :          The S3ETagHasher.etag() of the received instance.
+            size :          Its size, for the metrics.
+            storedEtag :    The etag of the file uploaded instead of the received instance, once compressed.
+        Returns:
+            True if S3 has the same content under key. False if not, or if the HEAD request failed.
+        Raises:
+            None
+        """
+        if not self.headCheck or etag is None:
+            return False
+        try:
+            stored = head(key)
+        except Exception as ex:
+            logging.debug(f"HEAD check of {key} failed, the instance is uploaded : {ex}")
+            return False
+        if stored is None or stored.strip('"') != (storedEtag or etag):
+            return False
+        self.Remember(key, etag)
+        self.__count("head", size)
+        return True
+
+    @staticmethod
+    def __count(check, size):
+        StowMetrics.duplicateInstances.inc(check=check)
+        StowMetrics.duplicateBytes.inc(size)
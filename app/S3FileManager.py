@@ -7,33 +7,138 @@ SPDX-License-Identifier: Apache 2.0
 import boto3
 import botocore
 from botocore.config import Config
+from boto3.s3.transfer import TransferConfig
 import os
-import collections
-from time import sleep
-from threading import Thread
+import zlib
+import time
+from threading import Lock, Event
+from concurrent.futures import ThreadPoolExecutor, Future
 import logging
+import StowMetrics
+from UploadRetryPolicy import UploadRetryPolicy, UploadInterrupted
+from UploadConcurrencyController import UploadConcurrencyController
+from UploadScheduler import FairUploadQueue, DefaultPriority
+from ContentHasher import ContentHasher, S3ETagHasher, crc32Value
+
+
+class S3StreamUpload:
+    """
+    Writes an object to S3 while its content is still being received. The data is buffered up to partSize and sent
+    as the parts of a S3 multipart upload. Objects smaller than partSize are sent with a single put_object call.
+    The requests are retried with retryPolicy, the parts are held in memory until they are sent.
+    With checksum, the CRC32 of each part and of the whole object are computed as the data arrives and sent with the
+    requests, S3 refuses the parts and the object which do not match. The CRC32 is only recorded in the metadata of the
+    objects sent with put_object, the metadata of a multipart upload is given before its content is known.
+    """
+
+    def __init__(self, client, bucketname, key, partSize, retryPolicy, checksum=True):
+        self.client = client
+        self.retry = retryPolicy
+        self.bucket_name = bucketname
+        self.key = key
+        self.partSize = max(partSize, 5242880) # S3 minimum part size is 5MB.
+        self.buffer = bytearray()
+        self.uploadId = None
+        self.parts = []
+        self.size = 0
+        self.crc = 0 if checksum else None
+
+    def write(self, data):
+        self.buffer.extend(data)
+        self.size += len(data)
+        if self.crc is not None:
+            self.crc = zlib.crc32(data, self.crc)
+        while len(self.buffer) >= self.partSize:
+            self.__uploadPart(bytes(self.buffer[:self.partSize]))
+            del self.buffer[:self.partSize]
+        return len(data)
+
+    def __uploadPart(self, data):
+        checksumArgs = {}
+        if self.uploadId is None:
+            if self.crc is not None:
+                checksumArgs = { "ChecksumAlgorithm" : "CRC32", "ChecksumType" : "FULL_OBJECT" }
+            self.uploadId = self.retry.Call(lambda: self.client.create_multipart_upload(Bucket=self.bucket_name, Key=self.key, **checksumArgs), f"Multipart upload of {self.key}")["UploadId"]
+        partNumber = len(self.parts)+1
+        part = {}
+        if self.crc is not None:
+            part["ChecksumCRC32"] = crc32Value(zlib.crc32(data))
+        resp = self.retry.Call(lambda: self.client.upload_part(Bucket=self.bucket_name, Key=self.key, UploadId=self.uploadId, PartNumber=partNumber, Body=data, **part), f"Part {partNumber} of {self.key}", size=len(data))
+        part.update({"ETag": resp["ETag"], "PartNumber": partNumber})
+        self.parts.append(part)
+
+    def complete(self):
+        checksumArgs = {}
+        if self.uploadId is None:
+            data = bytes(self.buffer)
+            if self.crc is not None:
+                checksumArgs = { "ChecksumCRC32" : crc32Value(self.crc), "Metadata" : { "crc32" : crc32Value(self.crc) } }
+            self.retry.Call(lambda: self.client.put_object(Bucket=self.bucket_name, Key=self.key, Body=data, **checksumArgs), f"Upload of {self.key}", size=len(data))
+        else:
+            if len(self.buffer) > 0:
+                self.__uploadPart(bytes(self.buffer))
+            if self.crc is not None:
+                checksumArgs = { "ChecksumCRC32" : crc32Value(self.crc), "ChecksumType" : "FULL_OBJECT" }
+            self.retry.Call(lambda: self.client.complete_multipart_upload(Bucket=self.bucket_name, Key=self.key, UploadId=self.uploadId, MultipartUpload={"Parts": self.parts}, **checksumArgs), f"Completion of {self.key}")
+        self.buffer = bytearray()
+        logging.debug(f"{self.size} bytes streamed to s3://{self.bucket_name}/{self.key} in {max(len(self.parts),1)} part(s).")
+
+    def abort(self):
+        self.buffer = bytearray()
+        if self.uploadId is not None:
+            try:
+                self.client.abort_multipart_upload(Bucket=self.bucket_name, Key=self.key, UploadId=self.uploadId)
+            except Exception as ex:
+                logging.error(f"Could not abort the multipart upload of {self.key}: {ex}")
 
 
 class S3FileManager:
 
     session = None
     s3 = None
-    status = 'idle'
-    DICOMInstancetoSend = None
-    DICOMInstanceSent = None
+    executor = None
     InstanceId= None
     EdgeId = None
     bucket_name = None
     config = Config(s3={"use_accelerate_endpoint": True})
     aws_access_key_id = None
     aws_secret_access_key = None
-    threadList = []
     threadCount = 16
+    maxConcurrency = 64
+    minConcurrency = 1
+    multipartThreshold = 67108864
+    multipartChunkSize = 16777216
+    multipartConcurrency = 8
+    largeUploadSlots = 2
+    streamPartSize = multipartChunkSize
+    endpointUrl = None
+    clientAttempts = 3
+    uploadChecksum = True
  
 
-    def __init__(self, EdgeId, bucketname):
+    def __init__(self, EdgeId, bucketname, onUploaded=None, journal=None, keepFailed=True, streamSlots=0, deadLetter=None, fair=True, dedup=None, compressor=None):
+        # onUploaded( DCMObj , success ) is called by the upload thread once the copy of DCMObj to S3 is over.
+        # journal is an optional UploadJournal keeping track of the jobs not uploaded yet.
+        # keepFailed : the journal entry of a failed upload is kept to be replayed at the next start, and its size is counted
+        # in the backlog until then. Otherwise the failed jobs are dropped from the journal.
+        # streamSlots : the number of threads which may upload through OpenStreamUpload at the same time ( diskless mode ).
+        # deadLetter : an optional DeadLetterFolder, with keepFailed the files which could not be uploaded after the retries
+        # are moved to it instead of waiting in the journal for the next start.
+        # fair : the queued jobs are taken in turn from each flow, by priority class ( see FairUploadQueue ), instead of in
+        # the order they were queued.
+        # dedup : an optional InstanceDeduplicator, the jobs given with the ETag of their file are not uploaded when the
+        # same content is already stored under their key.
+        # compressor : an optional InstanceCompressor, the queued files are compressed by its threads before their upload.
         self.bucket_name = bucketname
         self.EdgeId = EdgeId
+        self.onUploaded = onUploaded
+        self.journal = journal
+        self.keepFailed = keepFailed
+        self.streamSlots = streamSlots
+        self.deadLetter = deadLetter
+        self.fair = fair
+        self.dedup = dedup
+        self.compressor = compressor
         self._configure(EdgeId, bucketname)
 
 
@@ -42,11 +147,42 @@ class S3FileManager:
         self.bucket_name = bucketname
         logging.debug(f"S#FileManager configure for {self.threadCount} threads.")
         logging.debug(f"S3 threads will be copying files to the bucket {bucketname}.")
-        poolsize = self.threadCount+5
         try:
             self.threadCount = int(os.environ['THREADCOUNT'])
         except:
             logging.debug(f"No THREADCOUNT env variable, defaulting to {self.threadCount}.")
+        self.multipartThreshold = self.__readEnv('MULTIPARTTHRESHOLD', self.multipartThreshold)
+        self.multipartChunkSize = self.__readEnv('MULTIPARTCHUNKSIZE', self.multipartChunkSize)
+        self.multipartConcurrency = self.__readEnv('MULTIPARTCONCURRENCY', self.multipartConcurrency)
+        self.largeUploadSlots = self.__readEnv('LARGEUPLOADSLOTS', self.largeUploadSlots)
+        # THREADCOUNT is where the upload concurrency starts, the controller then moves it between the two bounds.
+        self.maxConcurrency = max(self.threadCount, self.__readEnv('UPLOADCONCURRENCYMAX', max(self.threadCount, self.maxConcurrency)))
+        self.minConcurrency = self.__readEnv('UPLOADCONCURRENCYMIN', self.minConcurrency)
+        self.streamPartSize = self.multipartChunkSize
+        try:
+            # the CRC32 of the instances computed while they are received is sent to S3, "none" lets the SDK compute its own.
+            self.uploadChecksum = os.environ['UPLOADCHECKSUM'].lower() != "none"
+        except:
+            pass
+        try:
+            # an S3 compatible service, like the stand-in of benchmarks/loadtest.py. The bucket is addressed in the path.
+            self.endpointUrl = os.environ['S3ENDPOINTURL']
+            logging.info(f"S3 requests are sent to {self.endpointUrl}.")
+        except:
+            self.endpointUrl = None
+        # Files under the multipart threshold are sent with a single PUT by up to maxConcurrency workers. The larger ones are
+        # sent by largeUploadSlots dedicated workers, each using multipartConcurrency connections for its parts. This keeps
+        # the small instances flowing while large ones are uploaded, and gives the connection pool its size. The diskless
+        # stream uploads are sent by the request threads, each of them needs a connection too. The pool is sized for the
+        # ceiling of the concurrency controller, whatever the concurrency it chooses.
+        self.smallTransferConfig = TransferConfig(multipart_threshold=self.multipartThreshold, multipart_chunksize=self.multipartChunkSize, use_threads=False)
+        self.largeTransferConfig = TransferConfig(multipart_threshold=self.multipartThreshold, multipart_chunksize=self.multipartChunkSize, max_concurrency=self.multipartConcurrency)
+        poolsize = self.maxConcurrency + self.largeUploadSlots*self.multipartConcurrency + self.streamSlots + 5
+        logging.debug(f"S3 connection pool sized for {poolsize} connections.")
+        # The client retries a request a few times by itself, the upload as a whole is then retried by retryPolicy.
+        clientConfig = botocore.client.Config(max_pool_connections=poolsize, retries={"mode": "standard", "total_max_attempts": self.clientAttempts})
+        if self.endpointUrl is not None:
+            clientConfig = clientConfig.merge(Config(s3={"addressing_style": "path"}))
         try:
             if self.aws_access_key_id == None:
                 self.aws_access_key_id = os.environ['AWS_ACCESS_KEY']
@@ -54,60 +190,281 @@ class S3FileManager:
                 self.aws_secret_access_key = os.environ['AWS_SECRET_KEY']
             self.session = boto3.Session(self.aws_access_key_id,self.aws_secret_access_key)
             
-            self.s3 = self.session.resource('s3' , config=botocore.client.Config(max_pool_connections=poolsize))
+            self.s3 = self.session.resource('s3' , config=clientConfig, endpoint_url=self.endpointUrl)
 
         except:          # we might be in greengrass mode :
             logging.debug("No AWS IAM credentials provided defaulting to greengrass authentication provider")    
             try:
                 self.session = boto3.Session()
-                self.s3 = self.session.resource('s3' ,config=botocore.client.Config(max_pool_connections=poolsize))
+                self.s3 = self.session.resource('s3' ,config=clientConfig, endpoint_url=self.endpointUrl)
                     
             except:
                 logging.error("There was an issue creating an boto3 session.")   
 
-  
-
-        
-        self.DICOMInstancetoSend = collections.deque([])
-        self.DICOMInstanceSent = collections.deque([])
         self.EdgeId = EdgeId
+        # every upload takes a slot of the controller, whichever the pool it runs in.
+        senders = self.largeUploadSlots + self.streamSlots
+        self.concurrency = UploadConcurrencyController(self.threadCount + senders, self.maxConcurrency + senders, self.minConcurrency)
+        self.retryPolicy = UploadRetryPolicy(self.concurrency)
+        if self.s3 is not None:
+            self.retryPolicy.WatchClient(self.s3.meta.client)
+        self.stopping = Event()
+        self.statsLock = Lock()
+        self.queued = 0
+        self.queuedBytes = 0
+        self.inFlight = 0
+        self.uploaded = 0
+        self.failed = 0
+        self.keptBytes = 0
+        self.deadLettered = 0
+        self.duplicates = 0
+        self.queueWaitTotal = 0.0
+        self.queueWaitMax = 0.0
+        self.uploadedBytes = 0
+        self.uploadSeconds = 0.0
 
         self.PrepareS3Threads()
 
-    def __uploadfile(self, obj):
-        #08/04/2022 - Add support for multipart upload.
-        self.status = 'uploading'
-        logging.debug(f"Bufferred Files in queue to send to {self.bucket_name} : {len(self.DICOMInstancetoSend)}")
+    @staticmethod
+    def __readEnv(name, default):
+        try:
+            return int(os.environ[name])
+        except:
+            return default
+
+    def __storedETag(self, key):
+        # The ETag of the object stored under key, or None if there is none.
         try:
-            self.s3.Bucket(self.bucket_name).upload_file(obj[0],self.EdgeId+obj[1])
+            return self.s3.meta.client.head_object(Bucket=self.bucket_name, Key=key)["ETag"]
+        except botocore.exceptions.ClientError as ex:
+            if ex.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+                return None
+            raise
+
+    def NewContentHasher(self):
+        # The ContentHasher of a received instance, or None when neither its checksum nor its ETag are needed.
+        if self.dedup is None and not self.uploadChecksum:
+            return None
+        etagHasher = S3ETagHasher(self.multipartThreshold, self.multipartChunkSize) if self.dedup is not None else None
+        return ContentHasher(self.uploadChecksum, etagHasher)
+
+    def __uploadArgs(self, checksum, large):
+        """
+        Args:
+            checksum :  The base64 CRC32 of the file computed while it was received, or None.
+            large :     True if the file is sent with a multipart upload.
+        Returns:
+            The ExtraArgs of upload_file. S3 checks the CRC32 of the whole object against checksum, and the SDK sends the
+            CRC32 of each part with it, computed from the part while it is sent. The CRC32 is recorded in the crc32
+            metadata of the object too.
+        Raises:
+            None
+        """
+        if checksum is None:
+            return None
+        extraArgs = { "ChecksumCRC32" : checksum, "Metadata" : { "crc32" : checksum } }
+        if large:
+            extraArgs.update({ "ChecksumAlgorithm" : "CRC32", "ChecksumType" : "FULL_OBJECT" })
+        return extraArgs
+
+    def IsDuplicate(self, DICOMTreePath, etag, size=0):
+        # True if the instance is one of the recently stored ones, with the same content. DICOMTreePath is the relative s3 path.
+        if self.dedup is None or etag is None:
+            return False
+        return self.dedup.IsDuplicate(self.EdgeId+DICOMTreePath, etag, size)
+
+    def __uploadfile(self, obj, enqueuedAt, size, entryId, etag=None, checksum=None, storedEtag=None):
+        wait = time.monotonic() - enqueuedAt
+        with self.statsLock:
+            self.queued -= 1
+            self.inFlight += 1
+            self.queueWaitTotal += wait
+            self.queueWaitMax = max(self.queueWaitMax, wait)
+        logging.debug(f"Upload of {obj[1]} to {self.bucket_name} started after {wait*1000:.3f}ms in queue.")
+        success = True
+        kept = self.keepFailed
+        transferConfig = self.largeTransferConfig if size >= self.multipartThreshold else self.smallTransferConfig
+        extraArgs = self.__uploadArgs(checksum, size >= self.multipartThreshold)
+        started = time.monotonic()
+        skipped = False
+        try:
+            if self.dedup is not None and self.dedup.IsStored(self.__storedETag, self.EdgeId+obj[1], etag, size, storedEtag):
+                skipped = True
+                logging.info(f"{obj[1]} is already stored in {self.bucket_name} with the same content, not uploaded again.")
+            else:
+                self.retryPolicy.Call(lambda: self.s3.Bucket(self.bucket_name).upload_file(obj[0],self.EdgeId+obj[1], ExtraArgs=extraArgs, Config=transferConfig), f"Upload of {obj[1]}", self.stopping, size)
+        except UploadInterrupted as ex:
+            # the journal entry is replayed at the next start.
+            success = False
+            logging.warning(str(ex))
         except Exception as ex:
+            success = False
             logging.error(f"Could not copy the file to S3: {ex}")
-        self.status = 'idle'
+            if self.keepFailed and self.deadLetter is not None:
+                try:
+                    self.deadLetter.Add(obj[0], self.bucket_name, self.EdgeId+obj[1], ex)
+                    kept = False
+                    with self.statsLock:
+                        self.deadLettered += 1
+                except Exception as err:
+                    logging.error(f"Could not move {obj[0]} to the dead letter folder, it stays in the journal: {err}")
+        if entryId is not None and (success or not kept):
+            try:
+                self.journal.MarkUploaded(entryId)
+            except Exception as ex:
+                logging.error(f"Could not mark {obj[0]} as uploaded in the journal: {ex}")
+        duration = time.monotonic() - started
+        if success and self.dedup is not None:
+            self.dedup.Remember(self.EdgeId+obj[1], etag)
+        if success and not skipped:
+            logging.debug(f"Uploaded {obj[1]} : {size} bytes in {duration:.3f}s ({size/max(duration,1e-6)/1048576:.1f}MB/s).")
+            StowMetrics.uploadDuration.observe(duration)
+        with self.statsLock:
+            self.inFlight -= 1
+            self.queuedBytes -= size
+            if skipped:
+                self.duplicates += 1
+            elif success:
+                self.uploaded += 1
+                self.uploadedBytes += size
+                self.uploadSeconds += duration
+            else:
+                self.failed += 1
+                if kept:
+                    self.keptBytes += size
+        if self.onUploaded is not None:
+            try:
+                self.onUploaded(obj, success)
+            except Exception as ex:
+                logging.error(f"Upload completion callback failed for {obj[0]}: {ex}")
+        return success
    
-    def AddSendJob(self,DCMObj):
-            self.DICOMInstancetoSend.append(DCMObj)  # DCMObj should contains the absolutfile location , and its relative s3 path
-            
+    def AddSendJob(self,DCMObj, entryId=None, flow=None, priority=DefaultPriority, etag=None, checksum=None):
+        # DCMObj should contains the absolutfile location , and its relative s3 path.
+        # The job is recorded in the journal before being queued, unless it comes from the journal ( entryId ).
+        # flow is the transaction or the sender the job belongs to, and priority its class in UploadScheduler.PriorityClasses.
+        # etag is the NewContentHasher() etag of the file, when given the upload is skipped if S3 already has the same content.
+        # checksum is its NewContentHasher() checksum, S3 refuses the upload if the data it receives does not match.
+        # With a compressor, the file is compressed before it is queued for upload, and both are computed again.
+        # Returns a future resolved with True once the file is copied to S3, or False if the copy failed.
+        size = os.path.getsize(DCMObj[0])
+        if self.journal is not None and entryId is None:
+            entryId = self.journal.Record(DCMObj)
+        with self.statsLock:
+            self.queued += 1
+            self.queuedBytes += size
+        future = Future()
+        job = (DCMObj, time.monotonic(), size, entryId, future, etag, checksum, None)
+        if self.compressor is not None:
+            self.compressor.Submit(self.__compressJob, job, flow, priority)
+        else:
+            self.__queueJob(job, flow, priority)
+        return future
 
-    def __s3upload(self,args):
-        while(True):
-            if len(self.DICOMInstancetoSend) > 0:
-                obj = self.DICOMInstancetoSend.popleft()
-                self.__uploadfile(obj)
-                self.DICOMInstanceSent.append(obj)
-            else:
-                sleep(0.1)
-    
+    def __compressJob(self, job, flow, priority):
+        # Runs on the compressor threads, nothing else resolves the future of the job if it raises.
+        DCMObj , enqueuedAt , size , entryId , future , etag , checksum , storedEtag = job
+        try:
+            hasher = self.NewContentHasher()
+            compressedSize = self.compressor.Compress(DCMObj[0], hasher)
+            if compressedSize is not None:
+                # the received etag stays the identity of the instance in the index of the duplicates.
+                compressedJob = (DCMObj, enqueuedAt, compressedSize, entryId, future, etag, hasher.checksum() if hasher is not None else None,
+                                 hasher.etag() if hasher is not None else None)
+                with self.statsLock:
+                    self.queuedBytes -= size - compressedSize
+                job = compressedJob
+        except Exception as ex:
+            logging.error(f"Could not compress {DCMObj[0]}, it is uploaded as it is : {ex}")
+        try:
+            self.__queueJob(job, flow, priority)
+        except Exception as ex:
+            # the upload pool is stopped, the file stays in the journal for the next run.
+            logging.error(f"Could not queue the upload of {DCMObj[0]} to {DCMObj[1]} : {ex}")
+            with self.statsLock:
+                self.queued -= 1
+                self.queuedBytes -= job[2]
+            future.set_exception(ex)
 
-    def GetInstanceSent(self):
-        if len(self.DICOMInstanceSent) > 0:
-            obj = self.DICOMInstanceSent.popleft()
-            return obj
-        else:
-            return None
+    def __queueJob(self, job, flow, priority):
+        large = job[2] >= self.multipartThreshold
+        queue = self.largeQueue if large else self.queue
+        queue.Put(job, flow, priority)
+        # each task of the pool uploads the job the queue hands out next, which is not always this one.
+        (self.largeExecutor if large else self.executor).submit(self.__uploadNext, queue)
+
+    def __uploadNext(self, queue):
+        DCMObj , enqueuedAt , size , entryId , future , etag , checksum , storedEtag = queue.Get()
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(self.__uploadfile(DCMObj, enqueuedAt, size, entryId, etag, checksum, storedEtag))
+        except Exception as ex:
+            future.set_exception(ex)
+
+    def ReplayJournal(self, entries=None):
+        # Queues the jobs left in the journal by a previous run of the service. Returns the number of jobs queued.
+        # entries is the subset of the journal entries to replay, in the multi-process mode each worker replays its share.
+        if self.journal is None:
+            return 0
+        if entries is None:
+            entries = self.journal.Pending()
+        self.journal.Claim([ entryId for entryId , obj in entries ])
+        count = 0
+        for entryId, obj in entries:
+            if not os.path.exists(obj[0]):
+                logging.error(f"Journal entry {entryId} : {obj[0]} does not exist anymore, it can't be uploaded to {obj[1]}.")
+                self.journal.MarkUploaded(entryId)
+                continue
+            self.AddSendJob(obj, entryId, flow="journal")
+            count += 1
+        logging.info(f"{count} file(s) from the upload journal queued for upload.")
+        return count
+
+    def OpenStreamUpload(self, DICOMTreePath):
+        # DICOMTreePath is the relative s3 path of the instance, as for AddSendJob.
+        return S3StreamUpload(self.s3.meta.client, self.bucket_name, self.EdgeId+DICOMTreePath, self.streamPartSize, self.retryPolicy, self.uploadChecksum)
+
+    def GetStats(self):
+        with self.statsLock:
+            started = self.uploaded + self.failed + self.duplicates + self.inFlight
+            # the jobs taken by a worker but waiting for a slot of the concurrency controller are still queued.
+            sending = min(self.inFlight, self.concurrency.active)
+            return {
+                "queued" : self.queued + self.inFlight - sending,
+                "queued_bytes" : self.queuedBytes,
+                "inflight" : sending,
+                "uploaded" : self.uploaded,
+                "failed" : self.failed,
+                "kept_bytes" : self.keptBytes,
+                "dead_lettered" : self.deadLettered,
+                "duplicates" : self.duplicates,
+                "retries" : self.retryPolicy.retries,
+                "throttled" : self.retryPolicy.throttled,
+                "concurrency" : self.concurrency.limit,
+                "queued_flows" : self.queue.Flows() + self.largeQueue.Flows(),
+                "queue_wait_avg" : self.queueWaitTotal / started if started > 0 else 0.0,
+                "queue_wait_max" : self.queueWaitMax,
+                "uploaded_bytes" : self.uploadedBytes,
+                "upload_seconds" : self.uploadSeconds
+            }
 
     def PrepareS3Threads(self):
-        for x in range(self.threadCount):
-            logging.debug("[ServiceInit] - S3 thread # "+str(x))
-            thread = Thread(target = self.__s3upload, args = ( 1, ))
-            thread.start()
-            self.threadList.append(thread)
+        logging.debug(f"[ServiceInit] - S3 upload pool of {self.threadCount}-{self.maxConcurrency} threads, and {self.largeUploadSlots} threads for files over {self.multipartThreshold} bytes.")
+        self.executor = ThreadPoolExecutor(max_workers=self.maxConcurrency, thread_name_prefix="s3upload")
+        self.largeExecutor = ThreadPoolExecutor(max_workers=self.largeUploadSlots, thread_name_prefix="s3upload-large")
+        self.queue = FairUploadQueue(self.fair)
+        self.largeQueue = FairUploadQueue(self.fair)
+
+    def Shutdown(self, wait=True):
+        # Stops accepting new jobs. With wait=True the files already queued are uploaded before returning, the ones waiting
+        # for a retry are left in the journal.
+        logging.info(f"Draining the S3 upload queue, {self.queued} file(s) left to send.")
+        self.stopping.set()
+        if self.compressor is not None:
+            # the compressed files are queued for upload, before the upload pools stop.
+            self.compressor.Shutdown(wait=wait)
+        self.executor.shutdown(wait=wait)
+        self.largeExecutor.shutdown(wait=wait)
+        if self.journal is not None:
+            self.journal.Close()
@@ -0,0 +1,128 @@
+"""
+StowAsgi.py : a minimal ASGI application serving the STOW-RS routes from an asyncio event loop.
+A request waiting for its body only holds a coroutine, so thousands of slow senders can share one process.
+
+SPDX-License-Identifier: Apache 2.0
+"""
+
+import re
+import logging
+
+
+class RequestBodyTooLarge(Exception):
+    pass
+
+
+class ClientDisconnected(ConnectionError):
+    pass
+
+
+class AsgiResponse:
+    """
+    A response of the ASGI application. The body is bytes, a str sent as UTF-8, or an iterable of bytes chunks
+    which are sent one http.response.body message at a time.
+    """
+
+    def __init__(self, status, body=b"", headers=None, content_type=None):
+        self.status = status
+        self.body = body.encode("utf-8") if isinstance(body, str) else body
+        self.headers = dict(headers or {})
+        if content_type is not None:
+            self.headers["Content-Type"] = content_type
+
+    # same name as the Flask responses, used by the request metrics.
+    @property
+    def status_code(self):
+        return self.status
+
+
+class AsgiRequest:
+    """
+    The headers of a HTTP request, and its body received chunk by chunk with read().
+    """
+
+    def __init__(self, scope, receive, maxBodySize):
+        self.scope = scope
+        self.receive = receive
+        self.maxBodySize = maxBodySize
+        self.headers = [ (name.decode("latin-1"), value.decode("latin-1")) for name , value in scope["headers"] ]
+        self.client = (scope.get("client") or (None,))[0]
+        self.received = 0
+        self.complete = False
+
+    def header(self, name, default=None):
+        name = name.lower()
+        for key , value in self.headers:
+            if key.lower() == name:
+                return value
+        return default
+
+    async def read(self):
+        # Returns the next chunk of the body, b'' once the body is complete.
+        while not self.complete:
+            message = await self.receive()
+            if message["type"] == "http.disconnect":
+                raise ClientDisconnected("client disconnected before the end of the request body")
+            self.complete = not message.get("more_body", False)
+            chunk = message.get("body", b"")
+            self.received += len(chunk)
+            if self.received > self.maxBodySize:
+                raise RequestBodyTooLarge()
+            if chunk:
+                return chunk
+        return b""
+
+
+class AsgiApp:
+    """
+    Routes the HTTP requests by method and path regex to coroutines taking the AsgiRequest and the named groups of the
+    path regex, and returning an AsgiResponse.
+    """
+
+    def __init__(self, maxBodySize=4294967296):
+        self.maxBodySize = maxBodySize
+        self.routes = []
+
+    def route(self, method, pattern):
+        def register(handler):
+            self.routes.append( (method, re.compile(pattern+"$"), handler) )
+            return handler
+        return register
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return
+        response = await self.__dispatch(scope, receive)
+        await send({ "type": "http.response.start", "status": response.status,
+            "headers": [ (name.lower().encode("latin-1"), str(value).encode("latin-1")) for name , value in response.headers.items() ] })
+        if isinstance(response.body, (bytes, bytearray)):
+            await send({ "type": "http.response.body", "body": response.body })
+            return
+        for chunk in response.body:
+            await send({ "type": "http.response.body", "body": chunk, "more_body": True })
+        await send({ "type": "http.response.body", "body": b"" })
+
+    async def __dispatch(self, scope, receive):
+        allowed = False
+        for method , pattern , handler in self.routes:
+            match = pattern.match(scope["path"])
+            if match is None:
+                continue
+            allowed = True
+            if method != scope["method"]:
+                continue
+            request = AsgiRequest(scope, receive, self.maxBodySize)
+            length = request.header("Content-Length")
+            if length is not None and length.isdigit() and int(length) > self.maxBodySize:
+                return AsgiResponse(413)
+            try:
+                return await handler(request, **match.groupdict())
+            except RequestBodyTooLarge:
+                return AsgiResponse(413)
+            except ClientDisconnected as err:
+                logging.warning(str(err))
+                return AsgiResponse(400)
+            except Exception:
+                logging.exception(f"Error while handling {scope['method']} {scope['path']}.")
+                return AsgiResponse(500)
+        return AsgiResponse(405 if allowed else 404)
@@ -0,0 +1,250 @@
+"""
+StowMetrics.py : the metrics of the STOW-RS service and their rendering in the Prometheus / OpenMetrics text format.
+
+SPDX-License-Identifier: Apache 2.0
+"""
+
+import os
+import json
+import time
+import logging
+from threading import Lock, Thread
+
+
+class MetricsRegistry:
+    """
+    In the multi-process mode every worker publishes the samples of its metrics in a shared folder, and render() sums the
+    samples of all the workers. The metrics marked as shared ( eg. the temp folder volume ) are the same for every worker
+    and are rendered from the local process only.
+    """
+
+    publishInterval = 5
+
+    def __init__(self):
+        self.metrics = []
+        self.folder = None
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        peers = self.__peerSamples()
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            samples = metric.samples()
+            if not metric.shared and peers:
+                samples = mergeSamples(samples, [ peer.get(metric.name, []) for peer in peers ])
+            for name , labels , value in samples:
+                lines.append(f"{name}{formatLabels(labels)} {formatValue(value)}")
+        return "\n".join(lines)+"\n"
+
+    def shareWith(self, folder):
+        """
+        Multi-process mode : publishes the samples of this process in folder every publishInterval seconds.
+        """
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+        Thread(target=self.__publishLoop, name="metrics-publisher", daemon=True).start()
+
+    def forget(self, pid):
+        # To be called once a worker has exited, its samples are not rendered anymore.
+        try:
+            os.remove(os.path.join(self.folder, f"{pid}.json"))
+        except (OSError, TypeError):
+            pass
+
+    def publish(self):
+        samples = { metric.name : metric.samples() for metric in self.metrics if not metric.shared }
+        path = os.path.join(self.folder, f"{os.getpid()}.json")
+        with open(path+".tmp", "w") as snapshot:
+            json.dump(samples, snapshot)
+        os.replace(path+".tmp", path)
+
+    def __publishLoop(self):
+        while True:
+            try:
+                self.publish()
+            except Exception as ex:
+                logging.error(f"Could not publish the metrics of the worker: {ex}")
+            time.sleep(self.publishInterval)
+
+    def __peerSamples(self):
+        if self.folder is None:
+            return []
+        own = f"{os.getpid()}.json"
+        peers = []
+        for filename in os.listdir(self.folder):
+            if filename == own or not filename.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(self.folder, filename)) as snapshot:
+                    peers.append(json.load(snapshot))
+            except (OSError, ValueError):
+                continue   # the worker exited meanwhile.
+        return peers
+
+
+def mergeSamples(samples, peerSamples):
+    # Sums the values of the samples with the same name and labels. JSON turned the label tuples into lists.
+    merged = { (name, tuple(labels)) : value for name , labels , value in samples }
+    for peer in peerSamples:
+        for name , labels , value in peer:
+            key = (name, tuple(tuple(label) for label in labels))
+            merged[key] = merged.get(key, 0) + value
+    return [ (name, labels, value) for ( name , labels ) , value in merged.items() ]
+
+
+def formatLabels(labels):
+    if not labels:
+        return ""
+    return "{"+",".join(f'{key}="{value}"' for key , value in labels)+"}"
+
+def formatValue(value):
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Counter:
+    kind = "counter"
+    shared = False
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.values = {}
+        self.lock = Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            return [ (self.name, tuple(zip(self.labelnames, key)), value) for key , value in sorted(self.values.items()) ]
+
+
+class Gauge:
+    """
+    A gauge either set by the code, or read from a function when the metrics are rendered.
+    kind can be set to "counter" for the totals maintained elsewhere ( eg. by S3FileManager ).
+    shared is set for the values which are the same for all the workers, they are not summed in the multi-process mode.
+    """
+
+    def __init__(self, name, help, kind="gauge", shared=False):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.shared = shared
+        self.value = 0
+        self.function = None
+
+    def set(self, value):
+        self.value = value
+
+    def setFunction(self, function):
+        self.function = function
+
+    def samples(self):
+        value = self.value
+        if self.function is not None:
+            try:
+                value = self.function()
+            except Exception:
+                value = float("nan")
+        return [ (self.name, (), value) ]
+
+
+class Histogram:
+    kind = "histogram"
+    shared = False
+
+    def __init__(self, name, help, buckets, labelnames=()):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets) + (float("inf"),)
+        self.labelnames = labelnames
+        self.values = {}            # label values -> [ bucket counts , sum , count ]
+        self.lock = Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None:
+                entry = self.values[key] = [ [0]*len(self.buckets) , 0.0 , 0 ]
+            for index , bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][index] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            for key , ( counts , total , count ) in sorted(self.values.items()):
+                labels = tuple(zip(self.labelnames, key))
+                cumulative = 0
+                for bound , bucketCount in zip(self.buckets, counts):
+                    cumulative += bucketCount
+                    samples.append( (self.name+"_bucket", labels + (("le", formatValue(bound)),), cumulative) )
+                samples.append( (self.name+"_sum", labels, total) )
+                samples.append( (self.name+"_count", labels, count) )
+        return samples
+
+
+class PhaseTimer:
+    """
+    Splits the time spent handling an instance in phases. mark(phase) charges the time elapsed since the previous mark to phase.
+    """
+
+    def __init__(self):
+        self.last = time.perf_counter()
+        self.phases = {}
+
+    def mark(self, phase):
+        now = time.perf_counter()
+        self.phases[phase] = self.phases.get(phase, 0.0) + now - self.last
+        self.last = now
+
+    def flush(self):
+        for phase , seconds in self.phases.items():
+            phaseSeconds.inc(seconds, phase=phase)
+        self.phases = {}
+
+
+registry = MetricsRegistry()
+
+DurationBuckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+requestCount = registry.register(Counter("stow_requests_total", "STOW-RS requests handled, per HTTP status.", ("status",)))
+requestDuration = registry.register(Histogram("stow_request_duration_seconds", "Duration of the STOW-RS requests, per HTTP status.", DurationBuckets, ("status",)))
+receivedBytes = registry.register(Counter("stow_received_bytes_total", "Bytes of DICOM instances received."))
+partsPerRequest = registry.register(Histogram("stow_parts_per_request", "Number of instances per STOW-RS request.", (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)))
+phaseSeconds = registry.register(Counter("stow_phase_seconds_total", "Time spent receiving the instances, per phase : multipart parsing, header sniffing, disk write, content hash, S3 upload.", ("phase",)))
+uploadDuration = registry.register(Histogram("stow_s3_upload_duration_seconds", "Duration of the successful S3 uploads.", DurationBuckets))
+uploadQueueDepth = registry.register(Gauge("stow_s3_upload_queue_depth", "Instances waiting for an upload thread."))
+uploadQueueFlows = registry.register(Gauge("stow_s3_upload_queue_flows", "Transactions or senders with instances waiting for an upload thread."))
+uploadQueuedBytes = registry.register(Gauge("stow_s3_upload_queued_bytes", "Bytes of the instances queued or being uploaded."))
+uploadKeptBytes = registry.register(Gauge("stow_s3_upload_kept_bytes", "Bytes of the instances kept in the temp folder after a failed upload, until the next replay of the journal. The dead letter folder is not counted."))
+uploadsInFlight = registry.register(Gauge("stow_s3_uploads_in_flight", "Uploads in progress."))
+uploadConcurrency = registry.register(Gauge("stow_s3_upload_concurrency", "Uploads allowed at the same time, as chosen by the concurrency controller from the throughput and the error rate."))
+uploadFailures = registry.register(Gauge("stow_s3_upload_failures_total", "Failed S3 uploads.", kind="counter"))
+uploadRetries = registry.register(Gauge("stow_s3_upload_retries_total", "S3 uploads tried again after an error.", kind="counter"))
+uploadThrottled = registry.register(Gauge("stow_s3_upload_throttled_total", "S3 requests answered with a 503 SlowDown or another throttling error.", kind="counter"))
+uploadDeadLettered = registry.register(Gauge("stow_s3_upload_dead_lettered_total", "Instances moved to the dead letter folder after their last failed upload.", kind="counter"))
+duplicateInstances = registry.register(Counter("stow_duplicate_instances_total", "Instances received again with the same content, not uploaded. Per check : index of the recently stored instances, or S3 HEAD.", ("check",)))
+duplicateBytes = registry.register(Counter("stow_duplicate_bytes_total", "Bytes of the duplicate instances which were not uploaded."))
+compressedInstances = registry.register(Counter("stow_compressed_instances_total", "Instances deflated before their upload."))
+compressionSavedBytes = registry.register(Counter("stow_compression_saved_bytes_total", "Bytes the deflated instances were reduced by."))
+compressionSeconds = registry.register(Counter("stow_compression_cpu_seconds_total", "CPU time of the compression threads, including the instances left uncompressed."))
+tempFolderUsed = registry.register(Gauge("stow_tempfolder_used_bytes", "Used space of the volume holding the temp folder.", shared=True))
+tempFolderFree = registry.register(Gauge("stow_tempfolder_free_bytes", "Free space of the volume holding the temp folder.", shared=True))
@@ -4,13 +4,86 @@ StowRsJsonResponse.py : a class used to build a DICOM PS18 STOW-RS response enve
 SPDX-License-Identifier: Apache 2.0
 """
 
+import json
+from json.encoder import encode_basestring_ascii as _encode
+
 import pydicom
 from pydicom import Dataset , DataElement , Sequence
 
+# json.dumps( sort_keys=True ) layout of Dataset.to_json : tags ascending, "Value" before "vr".
+_RESPONSE = '{"00081190": %s, "00081198": {"Value": [%s], "vr": "SQ"}, "00081199": {"Value": [%s], "vr": "SQ"}}'
+_REFERENCED_ITEM = ('{"00081150": {"Value": [%s], "vr": "UI"}, "00081155": {"Value": [%s], "vr": "UI"}, '
+                   '"00081190": {"Value": [%s], "vr": "UR"}}')
+
 class StowRsJsonResponse(object):
-    
+
     @staticmethod
     def generateResponse( successlist , failedlist , retrieveUrl):
+        """
+        Builds the PS3.18 JSON response of a STOW-RS transaction.
+
+        The document is written directly from preformatted fragments, the strings being escaped with the C encoder of
+        the json module. The output is byte-for-byte the one of generateDatasetResponse ( pydicom Dataset.to_json ),
+        without creating a Dataset and four DataElements per instance.
+
+        Args:
+            successlist :   The [ SOPClassUID , SOPInstanceUID , RetrieveURL , WarningReason ] entries of the stored instances.
+            failedlist :    The [ SOPClassUID , SOPInstanceUID , FailureReason ] entries of the failed instances.
+            retrieveUrl :   The Retrieve URL of the study.
+            The reasons are DICOM status codes, either an int or a hexadecimal string like "A700".
+
+        Returns:
+            The JSON document as a str.
+
+        Raises:
+            ValueError : a warning or failure reason is neither an int nor a hexadecimal status code.
+        """
+        element = StowRsJsonResponse.__element
+        plain = StowRsJsonResponse.__plain
+        referenced = []
+        for instance in successlist:
+            sopClass , sopInstance , wadoUrl , warning = instance
+            if warning is None and plain(sopClass) and plain(sopInstance) and plain(wadoUrl):
+                referenced.append(_REFERENCED_ITEM % (_encode(sopClass), _encode(sopInstance), _encode(wadoUrl)))
+                continue
+            item = '{"00081150": %s, "00081155": %s, "00081190": %s' % (element("UI", sopClass), element("UI", sopInstance), element("UR", wadoUrl))
+            if warning is not None:
+                item += ', "00081196": %s' % element("US", warning)
+            referenced.append(item + "}")
+
+        failed = []
+        for sopClass , sopInstance , reason in failedlist:
+            failed.append('{"00081150": %s, "00081155": %s, "00081197": %s}' % (element("UI", sopClass), element("UI", sopInstance), element("US", reason)))
+
+        return _RESPONSE % (element("UR", retrieveUrl), ", ".join(failed), ", ".join(referenced))
+
+    @staticmethod
+    def __plain( value ):
+        # a non empty, single valued string, which takes the preformatted path.
+        return isinstance(value, str) and value != "" and "\\" not in value
+
+    @staticmethod
+    def __statusCode( reason ):
+        # the value of a WarningReason or FailureReason US element : "A700" is 42752, "0110" is 272.
+        return reason if isinstance(reason, int) else int(reason, 16)
+
+    @staticmethod
+    def __element( vr , value ):
+        # pydicom omits the "Value" of an empty element and splits strings on backslashes.
+        if value is None or value == "":
+            return '{"vr": "%s"}' % vr
+        if vr == "US":
+            return '{"Value": [%d], "vr": "US"}' % StowRsJsonResponse.__statusCode(value)
+        if isinstance(value, str):
+            value = value.split("\\")
+        return '{"Value": %s, "vr": "%s"}' % (json.dumps(list(value)), vr)
+
+    @staticmethod
+    def generateDatasetResponse( successlist , failedlist , retrieveUrl):
+        """
+        Builds the same response as generateResponse through a pydicom Dataset. It is the reference implementation
+        the fast serializer is checked and benchmarked against.
+        """
         RetrievelUrlElement = DataElement("00081190" ,"UR" , retrieveUrl)
         FailedSequence = DataElement("00081198" ,"SQ" , "")
         FailedSequence = StowRsJsonResponse.__buildJsonFailedlist( failedlist , FailedSequence)
@@ -20,10 +93,10 @@ class StowRsJsonResponse(object):
         ds.add(RetrievelUrlElement)
         ds.add(FailedSequence)
         ds.add(SuccessSequence)
-        
+
         return ds.to_json()
 
-    @staticmethod   
+    @staticmethod
     def __buildJsonSuccesslist( successlist, SuccessSequence: DataElement ):
 
         successSeq = Sequence()
@@ -38,7 +111,7 @@ class StowRsJsonResponse(object):
             instanceDs.add(instanceWadoUrl)
 
             if instance[3] is not None:
-                instanceWarning = DataElement("00081196","US", instance[3])
+                instanceWarning = DataElement("00081196","US", StowRsJsonResponse.__statusCode(instance[3]))
                 instanceDs.add(instanceWarning)
 
 
@@ -56,12 +129,12 @@ class StowRsJsonResponse(object):
 
             instanceSOPClass = DataElement("00081150","UI", instance[0])
             instanceSOPInstanceUID = DataElement("00081155","UI", instance[1])
-            InstanceFailureReason = DataElement("00081197", "US" , instance[2])
+            InstanceFailureReason = DataElement("00081197", "US" , StowRsJsonResponse.__statusCode(instance[2]))
             instanceDs = Dataset()
             instanceDs.add(instanceSOPClass)
             instanceDs.add(instanceSOPInstanceUID)
             instanceDs.add(InstanceFailureReason)
-            
+
             failedSeq.append(instanceDs)
 
         FailedSequence.value = failedSeq
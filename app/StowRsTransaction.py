@@ -0,0 +1,379 @@
+"""
+StowRsTransaction.py : the processing of the instances received in a STOW-RS request, shared by the WSGI and the ASGI front ends.
+The front ends only read the multipart body and pass the chunks of each instance to the sink returned by OpenInstance.
+
+SPDX-License-Identifier: Apache 2.0
+"""
+
+import os
+import uuid
+import asyncio
+import logging
+from concurrent import futures
+from pydicom import dcmread
+from DicomHeaderSniffer import DicomHeaderSniffer
+from UploadScheduler import DefaultPriority
+from StowRsXmlResponse import StowRsXmlResponse
+from StowRsJsonResponse import StowRsJsonResponse
+import StowMetrics
+
+
+class DiskInstanceSink:
+    """
+    Writes a received instance in a temporary file, looking for its UIDs on the way. The optional hasher is fed with the
+    chunks too, see S3FileManager.NewContentHasher.
+    """
+
+    failureReason = "A700"     # reported when the instance could not be written.
+
+    def __init__(self, filepath, hasher=None):
+        self.filepath = filepath
+        self.hasher = hasher
+        self.sniffer = DicomHeaderSniffer()
+        self.timer = StowMetrics.PhaseTimer()
+        self.file = open(filepath, "wb")
+
+    def write(self, chunk):
+        # Returns False when the rest of the instance is not needed, it never is the case for this sink.
+        self.timer.mark("parse")
+        if not self.sniffer.done:
+            self.sniffer.feed(chunk)
+            self.timer.mark("header")
+        self.file.write(chunk)
+        self.timer.mark("write")
+        if self.hasher is not None:
+            self.hasher.update(chunk)
+            self.timer.mark("hash")
+        StowMetrics.receivedBytes.inc(len(chunk))
+        return True
+
+    def close(self):
+        """
+        Returns:
+            the pydicom dataset object containing the tags "00080016" , "0020000D" , "0020000E" , "00080018".
+        """
+        self.file.close()
+        self.timer.flush()
+        ds = self.sniffer.getDataset()
+        if ds is None:
+            # The UIDs could not be sniffed from the stream, let pydicom parse the header of the file.
+            timer = StowMetrics.PhaseTimer()
+            ds = dcmread(self.filepath, stop_before_pixels=True, specific_tags = { "00080016" , "0020000D" , "0020000E" , "00080018"})
+            timer.mark("header")
+            timer.flush()
+        return ds
+
+    def abort(self):
+        self.file.close()
+        self.timer.flush()
+        try:
+            os.remove(self.filepath)
+        except OSError:
+            pass
+
+
+class S3InstanceSink:
+    """
+    Diskless mode : streams a received instance directly to its final S3 location.
+    The beginning of the instance is buffered in memory until the DicomHeaderSniffer finds the UIDs needed to build the S3 key,
+    then the buffered data and the rest of the body part are piped into a S3 multipart upload while they are received.
+    """
+
+    failureReason = "0110"
+
+    def __init__(self, uploader, StudyUID, maxHeaderBuffer):
+        self.uploader = uploader
+        self.StudyUID = StudyUID
+        self.maxHeaderBuffer = maxHeaderBuffer
+        self.sniffer = DicomHeaderSniffer()
+        self.timer = StowMetrics.PhaseTimer()
+        self.head = bytearray()
+        self.upload = None
+        self.rejected = False
+
+    def write(self, chunk):
+        # Returns False when the rest of the instance is not needed : its UIDs are unknown or it belongs to another study.
+        self.timer.mark("parse")
+        StowMetrics.receivedBytes.inc(len(chunk))
+        if self.upload is not None:
+            self.upload.write(chunk)
+            self.timer.mark("upload")
+            return True
+        self.head.extend(chunk)
+        done = self.sniffer.feed(chunk)
+        self.timer.mark("header")
+        if done or len(self.head) > self.maxHeaderBuffer:
+            return self.__startUpload()
+        return True
+
+    def __startUpload(self):
+        ds = self.sniffer.getDataset()
+        if ds is None:
+            logging.warning(f"Could not read the UIDs in the first {len(self.head)} bytes of the instance.")
+            self.rejected = True
+            return False
+        if( self.StudyUID is not None) and ( self.StudyUID != ds["0020000D"].value):
+            logging.warning(f"Received instance does not belong to study {self.StudyUID}, rejecting.")
+            self.rejected = True
+            return False
+        DICOMTreePath = "/"+ds["0020000D"].value+"/"+ds["0020000E"].value+"/"+ds["00080018"].value+".dcm"
+        self.upload = self.uploader.OpenStreamUpload(DICOMTreePath)
+        self.upload.write(self.head)
+        self.head = bytearray()
+        self.timer.mark("upload")
+        return True
+
+    def close(self):
+        """
+        Completes the S3 upload of the instance.
+
+        Returns:
+            the pydicom dataset object containing the tags "00080016" , "0020000D" , "0020000E" , "00080018",
+            or None if they could not be found in the first bytes of the instance.
+
+        Raises:
+            Any error raised by S3 while uploading the instance. The multipart upload is aborted.
+        """
+        try:
+            if self.upload is None and not self.rejected:
+                self.__startUpload()
+            if self.upload is not None:
+                self.upload.complete()
+                self.timer.mark("upload")
+        except:
+            self.abort()
+            raise
+        finally:
+            self.timer.flush()
+        return self.sniffer.getDataset()
+
+    def abort(self):
+        if self.upload is not None:
+            self.upload.abort()
+            self.upload = None
+        self.timer.flush()
+
+
+class StowRsTransaction:
+    """
+    The state of a STOW-RS request : the instances stored and failed so far, the pending S3 uploads and the HTTP status.
+    """
+
+    def __init__(self, StudyUID, uploader, tempfolder, WadoURL, diskless=False, synccommit=False, maxHeaderBuffer=67108864, uploadFlow=None, uploadPriority=DefaultPriority, duplicateWarning=None):
+        # uploadFlow : the flow the uploads of the transaction are scheduled in, the sender of the request or by default the
+        # transaction itself. uploadPriority : their class in UploadScheduler.PriorityClasses.
+        # duplicateWarning : the WarningReason reported for the instances already stored with the same content, which are
+        # not uploaded again. None reports them as stored without warning.
+        self.StudyUID = StudyUID
+        self.uploader = uploader
+        self.tempfolder = tempfolder
+        self.WadoURL = WadoURL
+        self.diskless = diskless
+        self.synccommit = synccommit
+        self.maxHeaderBuffer = maxHeaderBuffer
+        self.transactionuuid = str(uuid.uuid4())
+        self.uploadFlow = uploadFlow if uploadFlow is not None else self.transactionuuid
+        self.uploadPriority = uploadPriority
+        self.duplicateWarning = duplicateWarning
+        self.httpstatus = 200
+        self.fileinstance = 0
+        self.retrieveUrl = ""
+        self.successInstance = []
+        self.failedInstance = []
+        self.transactionUploads = []
+        self.committedInstances = []
+        self.admissionDeadline = None      # end of the pause budget of the transaction, see AdmissionController.
+
+    def OpenInstance(self):
+        """
+        Returns the sink receiving the chunks of the next instance of the request.
+
+        Raises:
+            OSError if the temporary file of the instance could not be created.
+        """
+        self.fileinstance = self.fileinstance+1
+        if self.diskless:
+            return S3InstanceSink(self.uploader, self.StudyUID, self.maxHeaderBuffer)
+        storelocation = self.tempfolder+self.transactionuuid
+        os.makedirs(storelocation, exist_ok=True)
+        return DiskInstanceSink(storelocation+"/file_"+str(self.fileinstance), self.uploader.NewContentHasher())
+
+    def RefuseInstance(self):
+        """
+        To be called instead of OpenInstance when the service is overloaded. The instance is to be read to the void with the
+        returned DicomHeaderSniffer, and reported with InstanceFailed( sniffer.getDataset() , "A700" ).
+        """
+        self.fileinstance = self.fileinstance+1
+        logging.warning(f"Instance {self.fileinstance} of transaction {self.transactionuuid} refused, the service is overloaded.")
+        return DicomHeaderSniffer()
+
+    def InstanceReceived(self, sink):
+        """
+        To be called once the whole instance was written to the sink. Checks the study of the instance and queues its upload to S3.
+        """
+        if isinstance(sink, S3InstanceSink):
+            return self.__streamedInstanceReceived(sink)
+        ds = None
+        filelocation = sink.filepath
+        upload = None
+        try:
+            ds = sink.close()
+            if( self.StudyUID is not None) and ( self.StudyUID != ds["0020000D"].value):
+                logging.warning(f"Received instance does not belong to study {self.StudyUID}, rejecting.")
+                self.InstanceFailed(ds, "910") # do not add this entry in S3Sender. The error code is made up, the spec does not specify which one to use.
+                os.remove(sink.filepath)
+                return
+            studyinstanceUID = ds["0020000D"].value
+            seriesInstanceUID = ds["0020000E"].value
+            instanceUID = ds["00080018"].value
+            wadoUrl = self.getWadoUrl(studyinstanceUID, seriesInstanceUID, instanceUID)
+            etag = sink.hasher.etag() if sink.hasher is not None else None
+            if self.uploader.IsDuplicate("/"+studyinstanceUID+"/"+seriesInstanceUID+"/"+instanceUID+".dcm", etag, sink.hasher.size if sink.hasher is not None else 0):
+                logging.info(f"Instance {instanceUID} was stored lately with the same content, it is not uploaded again.")
+                os.remove(sink.filepath)
+                self.successInstance.append([ds["00080016"].value, instanceUID, wadoUrl, self.duplicateWarning ])
+                if self.duplicateWarning is not None:
+                    self.httpstatus = 202
+                return
+            filelocation , dicomtree = self.moveFileInDicomTreeDir(sink.filepath, studyinstanceUID , seriesInstanceUID , instanceUID )
+            checksum = sink.hasher.checksum() if sink.hasher is not None else None
+            upload = self.uploader.AddSendJob([filelocation, dicomtree], flow=self.uploadFlow, priority=self.uploadPriority, etag=etag, checksum=checksum)
+            self.transactionUploads.append(upload)
+            instanceEntry = [ds["00080016"].value, ds["00080018"].value, wadoUrl, None ]
+            self.successInstance.append(instanceEntry)
+            if self.synccommit:
+                self.committedInstances.append([upload, instanceEntry])
+        except Exception as ex:
+            logging.error(f"Could not process the instance {self.fileinstance} :  {ex}")
+            self.InstanceFailed(ds, "0110")
+            if upload is None:
+                # nothing else would remove the temp file of an instance which was not queued for upload.
+                try:
+                    os.remove(filelocation)
+                except OSError:
+                    pass
+
+    def __streamedInstanceReceived(self, sink):
+        try:
+            ds = sink.close()
+        except Exception as ex:
+            logging.error(f"Could not process the instance {self.fileinstance} :  {ex}")
+            ds = None
+        if ds is None:
+            self.InstanceFailed(ds, "0110")
+        elif( self.StudyUID is not None) and ( self.StudyUID != ds["0020000D"].value):
+            self.InstanceFailed(ds, "910")
+        else:
+            wadoUrl = self.getWadoUrl(ds["0020000D"].value, ds["0020000E"].value, ds["00080018"].value)
+            self.successInstance.append([ds["00080016"].value, ds["00080018"].value, wadoUrl, None ])
+
+    def WaitForUploads(self, timeout):
+        """
+        Waits for the S3 uploads of the instances of the transaction, the RESPONSEDELAY given to the uploads before the
+        response is sent. Returns as soon as they are all done, instead of holding the request for the whole delay.
+
+        Args:
+            timeout :   The maximum wait in seconds.
+
+        Returns:
+            True if all the uploads were done before the timeout.
+        """
+        pending = [ upload for upload in self.transactionUploads if not upload.done() ]
+        if timeout <= 0 or len(pending) == 0:
+            return len(pending) == 0
+        done , notDone = futures.wait(pending, timeout=timeout)
+        return len(notDone) == 0
+
+    async def WaitForUploadsAsync(self, timeout):
+        """
+        Same as WaitForUploads for the requests handled by the asyncio front end, the event loop is not blocked while waiting.
+        """
+        pending = [ upload for upload in self.transactionUploads if not upload.done() ]
+        if timeout <= 0 or len(pending) == 0:
+            return len(pending) == 0
+        done , notDone = await asyncio.wait([ asyncio.wrap_future(upload) for upload in pending ], timeout=timeout)
+        return len(notDone) == 0
+
+    def InstanceFailed(self, ds, reason):
+        """
+        Adds the FailedSOPSequence entry of an instance, ds may be None if the UIDs of the instance are unknown.
+        """
+        if ds is None:
+            self.failedInstance.append(["", "", reason])
+        else:
+            self.failedInstance.append([ds["00080016"].value, ds["00080018"].value, reason])
+        self.httpstatus = 202
+
+    def CommitFailed(self, instanceEntry):
+        """
+        Synchronous commit : reports an instance already listed as stored as failed, its upload to S3 did not succeed.
+        """
+        logging.warning(f"Instance {instanceEntry[1]} could not be copied to S3, reporting it as failed.")
+        self.successInstance.remove(instanceEntry)
+        self.failedInstance.append([instanceEntry[0], instanceEntry[1], "0110"])
+        self.httpstatus = 202
+
+    def BuildResponse(self, accept):
+        """
+        Builds the STOW-RS response of the transaction.
+
+        Args:
+            accept :    The Accept header of the request.
+
+        Returns:
+            httpstatus , resp , mimetype , contentType
+            resp is a str for a JSON response, and a generator of bytes chunks for a XML one.
+        """
+        StowMetrics.partsPerRequest.observe(self.fileinstance)
+        if((accept or "").lower() != "application/dicom+xml"):
+            logging.info("Sending the association response as a JSON document.")
+            resp = StowRsJsonResponse.generateResponse(self.successInstance, self.failedInstance, self.retrieveUrl)
+            mimetype = 'text/json'
+            contentType = 'application/json'
+        else:
+            logging.info("Sending the association response as a XML document.")
+            # streamed, the first items are sent while the rest of the document is written.
+            resp = StowRsXmlResponse.iterResponse(self.successInstance, self.failedInstance, self.retrieveUrl)
+            mimetype= 'text/xml'
+            contentType = 'application/xml'
+             #some app like 3D slicer sends */* in their request header "Accept",
+        httpstatus = self.httpstatus
+        if( len(self.successInstance) == 0):
+            httpstatus = 400
+        logging.debug(f"HTTP STATUS : {httpstatus}\r\nMIME-TYPE : {mimetype}\r\nCONTENT-TYPE : {contentType}\r\nPAYLOAD : \r\n{resp if isinstance(resp, str) else '<streamed XML document>'}")
+        logging.debug(f"{self.transactionuuid} removed from active connections list. status {httpstatus} will be returned.")
+        return httpstatus , resp , mimetype , contentType
+
+    def getWadoUrl(self, studyinstanceUID, seriesInstanceUID, instanceUID):
+        """
+        Builds the WADO URL returned to the sender for a stored instance, and updates the retrieve URL of the study.
+        """
+        if(self.WadoURL is None):
+            return ""
+        self.retrieveUrl = f"{self.WadoURL}/studies/{studyinstanceUID}"
+        return f"{self.WadoURL}/studies/{studyinstanceUID}/series/{seriesInstanceUID}/instances/{instanceUID}"
+
+    def moveFileInDicomTreeDir(self, currentfilename , studyUID , seriesUID, instanceUID):
+        """
+        This methods re-organize the received DICOM files on the filesystem by creating a directory structure and copying all the files of a sames series in different folders.
+        The strucuture is shaped like : ./out/transactionuuid/studyuid/seriesuid/sopinstanceuid.dcm
+        Args:
+            currentfilename :   A string representing the aboslute path to the file location after reception.
+            studyUID :          The Study Instance UID of the instance. tag [0020000D] value.
+            seriesUID :         The Series Instance UID of the instance. tag [0020000E] value.
+            instanceUID :       The SOP Instance UID of the instance. tag [00080018] value.
+
+        Returns:
+            newFilePath :       The new absolute file path after the file has been moved.
+            dicomFilePath :     A partial path representing the DICOM Tree to the object
+                                Eg : /studyuid/seriesuid/sopinstanceuid.dcm
+        Raises:
+            None
+        """
+        DICOMTreeFolder = "/"+studyUID+"/"+seriesUID+"/"+instanceUID
+        newlocation = os.path.join(self.tempfolder, self.transactionuuid ,studyUID , seriesUID )
+        os.makedirs(newlocation, exist_ok=True)
+        newFilePath = newlocation+"/"+instanceUID+".dcm"
+        os.replace(currentfilename, newFilePath)
+        dicomFilePath = DICOMTreeFolder+".dcm"
+        return newFilePath , dicomFilePath
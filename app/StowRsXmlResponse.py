@@ -6,10 +6,90 @@ SPDX-License-Identifier: Apache 2.0
 
 import xml.etree.ElementTree as ET
 
+# the markup ET.tostring writes for the NativeDicomModel response, items are emitted in chunks of about this size.
+_CHUNK_SIZE = 65536
+_HEADER = ('<NativeDicomModel xlmns="http://dicom.nema.org/PS3.19/models/NativeDICOM" '
+           'xsi:schemaLocation="http://dicom.nema.org/PS3.19/models/NativeDICOM" '
+           'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">')
+_RETRIEVE_URL = '<DicomAttribute tag="00081190" vr="UR" keyword="RetrieveURL">%s</DicomAttribute>'
+_FAILED_SEQUENCE = '<DicomAttribute tag="00081198" vr="SQ" keyword="FailedSOPSequence"'
+_REFERENCED_SEQUENCE = '<DicomAttribute tag="00081199" vr="SQ" keyword="ReferencedSOPSequence"'
+_ATTRIBUTE = '<DicomAttribute tag="%s" vr="%s" keyword="%s">%s</DicomAttribute>'
+
 class StowRsXmlResponse(object):
-    
+
     @staticmethod
     def generateResponse( successlist , failedlist, retrieveUrl):
+        """
+        Builds the whole XML response of a STOW-RS transaction, see iterResponse.
+
+        Returns:
+            The XML document as bytes, the same as ET.tostring of the tree built by generateTreeResponse.
+        """
+        return b"".join(StowRsXmlResponse.iterResponse(successlist, failedlist, retrieveUrl))
+
+    @staticmethod
+    def iterResponse( successlist , failedlist, retrieveUrl):
+        """
+        Writes the XML response of a STOW-RS transaction incrementally, without building an ElementTree.
+
+        Args:
+            successlist :   The [ SOPClassUID , SOPInstanceUID , RetrieveURL , WarningReason ] entries of the stored instances.
+            failedlist :    The [ SOPClassUID , SOPInstanceUID , FailureReason ] entries of the failed instances.
+            retrieveUrl :   The Retrieve URL of the study.
+
+        Returns:
+            A generator of bytes chunks of about 64KB, which can be sent as the body of a streamed response.
+        """
+        value = StowRsXmlResponse.__value
+        pending = [ _HEADER , _RETRIEVE_URL % value(retrieveUrl) ]
+        size = 0
+        for opening , entries in ((_FAILED_SEQUENCE, failedlist), (_REFERENCED_SEQUENCE, successlist)):
+            if len(entries) == 0:
+                pending.append(opening + " />")
+                continue
+            pending.append(opening + ">")
+            number = 1
+            for instance in entries:
+                item = ( '<Item number="%d">' % number
+                    + _ATTRIBUTE % ("00081150", "UI", "ReferencedSOPClassUID", value(instance[0]))
+                    + _ATTRIBUTE % ("00081155", "UI", "ReferencedSOPInstanceUID", value(instance[1])) )
+                if opening is _FAILED_SEQUENCE:
+                    item += _ATTRIBUTE % ("00081197", "US", "FailureReason", value(instance[2]))
+                else:
+                    item += _ATTRIBUTE % ("00081190", "UR", "RetrieveURL", value(instance[2]))
+                    if instance[3] is not None:
+                        item += _ATTRIBUTE % ("00081196", "US", "WarningReason", value(str(instance[3])))
+                pending.append(item + "</Item>")
+                size += len(item)
+                number += 1
+                if size >= _CHUNK_SIZE:
+                    yield "".join(pending).encode("ascii", "xmlcharrefreplace")
+                    pending = []
+                    size = 0
+            pending.append("</DicomAttribute>")
+        pending.append("</NativeDicomModel>")
+        yield "".join(pending).encode("ascii", "xmlcharrefreplace")
+
+    @staticmethod
+    def __value( text ):
+        # a Value element, escaped like ElementTree does, which writes an empty text as a self-closing element.
+        if not text:
+            return '<Value number="1" />'
+        if "&" in text:
+            text = text.replace("&", "&amp;")
+        if "<" in text:
+            text = text.replace("<", "&lt;")
+        if ">" in text:
+            text = text.replace(">", "&gt;")
+        return '<Value number="1">%s</Value>' % text
+
+    @staticmethod
+    def generateTreeResponse( successlist , failedlist, retrieveUrl):
+        """
+        Builds the same response as generateResponse with an ElementTree. It is the reference implementation the
+        incremental writer is checked and benchmarked against.
+        """
         data = ET.Element('NativeDicomModel')
 
         data.set("xlmns","http://dicom.nema.org/PS3.19/models/NativeDICOM")
@@ -93,7 +173,7 @@ class StowRsXmlResponse(object):
                 InstanceDICOMAttribute.set('keyword','WarningReason')
                 ValueElem = ET.SubElement(InstanceDICOMAttribute, "Value")
                 ValueElem.set("number",str(1))
-                ValueElem.text = instance[2]  
+                ValueElem.text = str(instance[3])
 
             SuccessinstanceNumber+=1
         return ReferencedDICOMAttribute
@@ -0,0 +1,141 @@
+"""
+UploadConcurrencyController.py : a class choosing how many S3 uploads are sent at the same time, from the measured
+throughput and error rate.
+
+SPDX-License-Identifier: Apache 2.0
+"""
+
+import time
+import logging
+from threading import Condition
+
+
+class UploadConcurrencyController:
+    """
+    AIMD control of the number of uploads in flight, between floor and ceiling :
+        - a throttled response from S3 halves the limit at once, at most once per cooldown seconds since the uploads in
+          flight get their SlowDown at the same time.
+        - every interval seconds, the limit is halved if more than errorRateHigh of the uploads failed. Otherwise, if the
+          uploads had to wait for a slot, the limit grows by increaseStep. When a growth did not bring at least minGain
+          more throughput, the network or S3 is the bottleneck : the growth is undone and the limit stays there for
+          holdIntervals intervals before probing again.
+        - like the slow start of TCP, the limit doubles instead of growing by increaseStep until the first decrease or
+          the first growth without gain, a backlog is not sent at the concurrency of THREADCOUNT for minutes.
+    The upload threads take a slot with Acquire() before each attempt and give it back with Release().
+    """
+
+    interval = 3.0
+    cooldown = 1.0
+    errorRateHigh = 0.05
+    increaseStep = 2
+    minGain = 0.05
+    holdIntervals = 6
+
+    def __init__(self, initial, ceiling, floor=1):
+        self.ceiling = max(1, ceiling)
+        self.floor = max(1, min(floor, self.ceiling))
+        self.limit = max(self.floor, min(initial, self.ceiling))
+        self.active = 0
+        self.condition = Condition()
+        self.lastDecrease = 0.0
+        self.previousLimit = None
+        self.previousThroughput = None
+        self.hold = 0
+        self.slowStart = True
+        self.__startWindow(time.monotonic())
+
+    def __startWindow(self, now):
+        self.windowStart = now
+        self.successes = 0
+        self.errors = 0
+        self.bytes = 0
+        self.saturated = False
+        self.throttled = False
+
+    def Acquire(self):
+        with self.condition:
+            if self.active >= self.limit:
+                self.saturated = True
+            while self.active >= self.limit:
+                self.condition.wait()
+            self.active += 1
+
+    def Release(self):
+        with self.condition:
+            self.active -= 1
+            self.condition.notify()
+
+    def OnSuccess(self, size=0):
+        with self.condition:
+            self.successes += 1
+            self.bytes += size
+            self.__adjustIfDue(time.monotonic())
+
+    def OnError(self):
+        with self.condition:
+            self.errors += 1
+            self.__adjustIfDue(time.monotonic())
+
+    def OnThrottled(self):
+        with self.condition:
+            self.throttled = True
+            now = time.monotonic()
+            if now - self.lastDecrease < self.cooldown:
+                return
+            self.__decrease(now, "S3 throttles the uploads")
+
+    def Adjust(self, now=None):
+        """
+        Ends the current measure window and adapts the limit. Called by the upload threads once interval seconds elapsed.
+
+        Args:
+            now :   The time.monotonic() of the end of the window.
+        Returns:
+            The new limit.
+        Raises:
+            None
+        """
+        with self.condition:
+            return self.__adjust(time.monotonic() if now is None else now)
+
+    def __adjustIfDue(self, now):
+        if now - self.windowStart >= self.interval:
+            self.__adjust(now)
+
+    def __adjust(self, now):
+        completed = self.successes + self.errors
+        if completed == 0:
+            self.__startWindow(now)
+            return self.limit
+        throughput = self.bytes / max(now - self.windowStart, 1e-6)
+        errorRate = self.errors / completed
+        if errorRate > self.errorRateHigh and not self.throttled:
+            self.__decrease(now, f"{errorRate:.0%} of the uploads failed")
+        elif self.throttled:
+            self.previousLimit = None
+        elif self.hold > 0:
+            self.hold -= 1
+        elif self.previousLimit is not None and throughput < self.previousThroughput * (1 + self.minGain):
+            logging.info(f"Upload concurrency {self.limit} is not faster than {self.previousLimit}, kept at {self.previousLimit}.")
+            self.limit = self.previousLimit
+            self.previousLimit = None
+            self.hold = self.holdIntervals
+            self.slowStart = False
+        elif self.saturated and self.limit < self.ceiling:
+            self.previousLimit , self.previousThroughput = self.limit , throughput
+            self.limit = min(self.ceiling, self.limit * 2 if self.slowStart else self.limit + self.increaseStep)
+            logging.debug(f"Upload concurrency raised to {self.limit}, {throughput/1048576:.1f}MB/s uploaded.")
+            self.condition.notify_all()
+        else:
+            self.previousLimit = None
+        self.__startWindow(now)
+        return self.limit
+
+    def __decrease(self, now, reason):
+        self.lastDecrease = now
+        self.previousLimit = None
+        self.hold = 0
+        self.slowStart = False
+        if self.limit > self.floor:
+            self.limit = max(self.floor, self.limit // 2)
+            logging.warning(f"{reason}, upload concurrency lowered to {self.limit}.")
@@ -0,0 +1,62 @@
+"""
+UploadJournal.py : a SQLite journal of the instances accepted by the STOW-RS service and not yet copied to S3.
+
+SPDX-License-Identifier: Apache 2.0
+"""
+
+import os
+import sqlite3
+import logging
+from threading import Lock
+
+
+class UploadJournal:
+    """
+    Each accepted instance is recorded with its local file path and its relative S3 path before the STOW-RS response is sent,
+    and its entry is removed once the file is in S3. The entries left in the journal when the service starts are the
+    instances which were acknowledged to the sender but not uploaded, they are to be replayed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = Lock()
+        # The journal is shared by the workers of the multi-process mode, a writer may have to wait for another process.
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        # WAL with synchronous NORMAL survives a crash of the process, which is what happens when a task is stopped.
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS pending (id INTEGER PRIMARY KEY AUTOINCREMENT, filepath TEXT NOT NULL, s3path TEXT NOT NULL, recorded REAL DEFAULT (julianday('now')))")
+        # owner is the pid of the process in charge of the upload, the entries of a worker which died are given to its replacement.
+        columns = [ row[1] for row in self.connection.execute("PRAGMA table_info(pending)") ]
+        if "owner" not in columns:
+            self.connection.execute("ALTER TABLE pending ADD COLUMN owner INTEGER")
+        logging.debug(f"Upload journal opened at {path}.")
+
+    def Record(self, DCMObj):
+        # DCMObj contains the absolute file location , and its relative s3 path. Returns the journal entry id.
+        with self.lock:
+            cursor = self.connection.execute("INSERT INTO pending (filepath, s3path, owner) VALUES (?, ?, ?)", (DCMObj[0], DCMObj[1], os.getpid()))
+            return cursor.lastrowid
+
+    def MarkUploaded(self, entryId):
+        with self.lock:
+            self.connection.execute("DELETE FROM pending WHERE id = ?", (entryId,))
+
+    def Pending(self, owner=None):
+        # Returns the list of ( entry id , [ absolute file location , relative s3 path ] ) not marked as uploaded,
+        # only the ones of the process owner if provided.
+        with self.lock:
+            if owner is None:
+                rows = self.connection.execute("SELECT id, filepath, s3path FROM pending ORDER BY id").fetchall()
+            else:
+                rows = self.connection.execute("SELECT id, filepath, s3path FROM pending WHERE owner = ? ORDER BY id", (owner,)).fetchall()
+        return [ (row[0], [row[1], row[2]]) for row in rows ]
+
+    def Claim(self, entryIds):
+        # The current process takes over the upload of the entries, eg. when replaying them.
+        with self.lock:
+            self.connection.executemany("UPDATE pending SET owner = ? WHERE id = ?", [ (os.getpid(), entryId) for entryId in entryIds ])
+
+    def Close(self):
+        with self.lock:
+            self.connection.close()
@@ -0,0 +1,197 @@
+"""
+UploadRetryPolicy.py : the retry rules of the S3 uploads.
+
+SPDX-License-Identifier: Apache 2.0
+"""
+
+import os
+import time
+import random
+import logging
+from threading import Lock
+from botocore.exceptions import ClientError, ConnectionError as BotoConnectionError, HTTPClientError
+
+
+THROTTLED = "throttled"
+TRANSIENT = "transient"
+PERMANENT = "permanent"
+
+_THROTTLING_CODES = { "SlowDown", "Throttling", "ThrottlingException", "RequestLimitExceeded", "TooManyRequestsException", "503" }
+_TRANSIENT_CODES = { "InternalError", "ServiceUnavailable", "RequestTimeout", "RequestTimeoutException", "OperationAborted" }
+
+
+class UploadInterrupted(Exception):
+    """
+    Raised instead of waiting for the next retry of an upload when the service is stopping.
+    """
+
+
+def classifyError(ex):
+    """
+    Tells if an upload which raised ex is worth retrying. boto3 wraps the errors of upload_file in a S3UploadFailedError,
+    the chained exceptions are looked at too.
+
+    Args:
+        ex :    The exception raised by the upload.
+    Returns:
+        THROTTLED for the 503 SlowDown and the other throttling errors, TRANSIENT for the server side and network errors,
+        PERMANENT otherwise ( access denied, missing bucket or local file... ).
+    Raises:
+        None
+    """
+    seen = set()
+    while ex is not None and id(ex) not in seen:
+        seen.add(id(ex))
+        if isinstance(ex, ClientError):
+            error = ex.response.get("Error", {})
+            code = str(error.get("Code", ""))
+            status = ex.response.get("ResponseMetadata", {}).get("HTTPStatusCode", 0)
+            if code in _THROTTLING_CODES:
+                return THROTTLED
+            if code in _TRANSIENT_CODES or status >= 500:
+                return TRANSIENT
+            return PERMANENT
+        if isinstance(ex, (BotoConnectionError, HTTPClientError)):
+            return TRANSIENT
+        if isinstance(ex, OSError) and not isinstance(ex, (FileNotFoundError, PermissionError, IsADirectoryError)):
+            # a socket error, the local file errors can't be fixed by a retry.
+            return TRANSIENT
+        if "SlowDown" in str(ex) or "(503)" in str(ex):
+            # older boto3 releases raise S3UploadFailedError without chaining the ClientError.
+            return THROTTLED
+        ex = ex.__cause__ or ex.__context__
+    return PERMANENT
+
+
+class UploadRetryPolicy:
+    """
+    Exponential backoff with full jitter : the n-th retry waits a random time between 0 and min(maxDelay, baseDelay * 2^n).
+    The retries share a budget, like the retry quota of the AWS SDKs : a retry costs retryCost tokens, a success gives one
+    back, up to budget. When S3 is down the budget runs out and the uploads fail at their first error instead of piling
+    retries on the service, they go to the dead letter folder.
+    Each attempt takes a slot of limiter, an UploadConcurrencyController, and tells it how the attempt went.
+    """
+
+    maxAttempts = 5
+    baseDelay = 0.2
+    maxDelay = 20.0
+    budget = 500
+    retryCost = 5
+
+    def __init__(self, limiter):
+        self._configure()
+        self.tokens = self.budget
+        self.tokensLock = Lock()
+        self.limiter = limiter
+        self.retries = 0
+        self.throttled = 0
+
+    def _configure(self):
+        self.maxAttempts = max(1, self.__readEnv("UPLOADATTEMPTS", self.maxAttempts))
+        self.baseDelay = self.__readEnv("RETRYBASEDELAYMS", int(self.baseDelay*1000)) / 1000
+        self.maxDelay = self.__readEnv("RETRYMAXDELAYMS", int(self.maxDelay*1000)) / 1000
+        self.budget = self.__readEnv("RETRYBUDGET", self.budget)
+        logging.debug(f"S3 uploads : {self.maxAttempts} attempts, backoff {self.baseDelay}-{self.maxDelay}s, retry budget {self.budget}.")
+
+    @staticmethod
+    def __readEnv(name, default):
+        try:
+            return int(os.environ[name])
+        except:
+            return default
+
+    def Delay(self, attempt):
+        # the wait before the retry following the attempt-th failed attempt.
+        return random.uniform(0, min(self.maxDelay, self.baseDelay * 2**(attempt-1)))
+
+    def SpendRetry(self):
+        # Returns False if the budget does not allow one more retry.
+        with self.tokensLock:
+            if self.tokens < self.retryCost:
+                return False
+            self.tokens -= self.retryCost
+            return True
+
+    def OnSuccess(self, size=0):
+        with self.tokensLock:
+            self.tokens = min(self.budget, self.tokens + 1)
+        self.limiter.OnSuccess(size)
+
+    def OnThrottled(self):
+        with self.tokensLock:
+            self.throttled += 1
+        self.limiter.OnThrottled()
+
+    def WatchClient(self, client):
+        """
+        The S3 client retries the throttled requests by itself before the upload fails. Every throttled response it gets
+        lowers the upload concurrency, including the ones of the parts of the multipart uploads.
+
+        Args:
+            client :    The botocore S3 client of the uploads.
+        Returns:
+            None
+        Raises:
+            None
+        """
+        def onResponse(response=None, **kwargs):
+            if response is not None:
+                code = str(response[1].get("Error", {}).get("Code", ""))
+                if code in _THROTTLING_CODES:
+                    self.OnThrottled()
+            # None lets the retry handler of the client decide.
+            return None
+        client.meta.events.register("needs-retry.s3", onResponse)
+
+    def ShouldRetry(self, kind, attempt):
+        """
+        Args:
+            kind :      The classifyError() of the failed attempt.
+            attempt :   The number of attempts made so far.
+        Returns:
+            True if the upload is to be tried again.
+        Raises:
+            None
+        """
+        if kind == PERMANENT or attempt >= self.maxAttempts or not self.SpendRetry():
+            return False
+        with self.tokensLock:
+            self.retries += 1
+        return True
+
+    def Call(self, function, description, stopping=None, size=0):
+        """
+        Runs function with the retry rules. function must be safe to call again, eg. the upload of a part held in memory.
+
+        Args:
+            function :      The function to call, without arguments.
+            description :   What function does, for the logs.
+            stopping :      An optional threading.Event, the retries end when it is set.
+            size :          The bytes sent by function, for the throughput measured by the limiter.
+        Returns:
+            The value returned by function.
+        Raises:
+            The exception of the last attempt, or UploadInterrupted if stopping was set while waiting for a retry.
+        """
+        attempt = 0
+        while True:
+            attempt += 1
+            self.limiter.Acquire()
+            try:
+                result = function()
+            except Exception as ex:
+                self.limiter.OnError()
+                kind = classifyError(ex)
+                if not self.ShouldRetry(kind, attempt):
+                    raise
+                delay = self.Delay(attempt)
+                logging.warning(f"{description} failed ({kind}, attempt {attempt}/{self.maxAttempts}), retried in {delay:.2f}s : {ex}")
+            else:
+                self.OnSuccess(size)
+                return result
+            finally:
+                self.limiter.Release()
+            if stopping is None:
+                time.sleep(delay)
+            elif stopping.wait(delay):
+                raise UploadInterrupted(f"{description} : not retried, the service is stopping.")
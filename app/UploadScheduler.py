@@ -0,0 +1,109 @@
+"""
+UploadScheduler.py : the queue of the S3 uploads, shared fairly between the transactions or the senders, by priority class.
+
+SPDX-License-Identifier: Apache 2.0
+"""
+
+import logging
+import collections
+from threading import Lock
+
+
+# the priority classes, from a request header, and their share of the upload workers when they all have jobs queued.
+PriorityClasses = { "stat" : 0, "high" : 1, "routine" : 2, "low" : 3 }
+PriorityWeights = { 0 : 16, 1 : 8, 2 : 4, 3 : 1 }
+DefaultPriority = PriorityClasses["routine"]
+
+
+def parsePriority(value):
+    """
+    Args:
+        value :     The value of the priority header of a request, eg. "STAT", or None.
+    Returns:
+        The priority class, DefaultPriority if value is missing or unknown.
+    Raises:
+        None
+    """
+    if value is None:
+        return DefaultPriority
+    priority = PriorityClasses.get(value.strip().lower())
+    if priority is None:
+        logging.warning(f"Unknown upload priority {value}, the instances are uploaded with the routine priority.")
+        return DefaultPriority
+    return priority
+
+
+class _PriorityClass:
+
+    def __init__(self, weight):
+        self.weight = weight
+        self.virtualTime = 0.0
+        self.flows = collections.OrderedDict()   # flow -> deque of jobs, in round robin order.
+
+
+class FairUploadQueue:
+    """
+    The jobs are queued per flow, a flow being a STOW-RS transaction or a sender. Get() takes the jobs of the flows of a
+    priority class in turn, one job each, so a study of a few instances does not wait behind the 20,000 instances of a
+    bulk migration sent before it. The priority classes share the workers by stride scheduling : a class with jobs queued
+    gets weight jobs for every job of a class of weight 1, so even the low class keeps moving.
+    With fair=False the jobs are taken in the order they were queued, whatever their flow and priority.
+    """
+
+    def __init__(self, fair=True):
+        self.fair = fair
+        self.lock = Lock()
+        self.classes = { priority : _PriorityClass(weight) for priority , weight in PriorityWeights.items() }
+        self.fifo = collections.deque()
+        self.virtualTime = 0.0
+        self.count = 0
+
+    def Put(self, job, flow=None, priority=DefaultPriority):
+        with self.lock:
+            self.count += 1
+            if not self.fair:
+                self.fifo.append(job)
+                return
+            priorityClass = self.classes.get(priority, self.classes[DefaultPriority])
+            if not priorityClass.flows:
+                # a class becoming active does not get the turns it missed while it was idle.
+                priorityClass.virtualTime = max(priorityClass.virtualTime, self.virtualTime)
+            jobs = priorityClass.flows.get(flow)
+            if jobs is None:
+                jobs = priorityClass.flows[flow] = collections.deque()
+            jobs.append(job)
+
+    def Get(self):
+        """
+        Returns:
+            The next job to upload.
+        Raises:
+            IndexError if the queue is empty.
+        """
+        with self.lock:
+            if not self.fair:
+                job = self.fifo.popleft()
+                self.count -= 1
+                return job
+            active = [ ( priorityClass.virtualTime , priority ) for priority , priorityClass in self.classes.items() if priorityClass.flows ]
+            if not active:
+                raise IndexError("the upload queue is empty")
+            self.virtualTime , priority = min(active)
+            priorityClass = self.classes[priority]
+            priorityClass.virtualTime += 1.0 / priorityClass.weight
+            flow , jobs = next(iter(priorityClass.flows.items()))
+            job = jobs.popleft()
+            if jobs:
+                priorityClass.flows.move_to_end(flow)
+            else:
+                del priorityClass.flows[flow]
+            self.count -= 1
+            return job
+
+    def Flows(self):
+        # The number of flows with jobs queued.
+        with self.lock:
+            return sum( len(priorityClass.flows) for priorityClass in self.classes.values() )
+
+    def __len__(self):
+        return self.count
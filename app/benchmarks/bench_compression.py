@@ -0,0 +1,225 @@
+"""
+bench_compression.py : benchmark of the ingest side compression of the instances ( InstanceCompressor ).
+
+For each instance and deflate level the benchmark reports the compression ratio, the throughput of one compression
+thread and its CPU cost per MB of received instance, and checks that pydicom reads back the same data set. The
+synthetic instances are Explicit VR Little Endian images generated without numpy : a CT slice ( a body in air, with
+noise in the low bits ), a MR slice, a large CR, an ultrasound RGB frame and a worst case of 12 bits noise. Real
+instances can be measured too with --files.
+
+Usage :
+    python3 benchmarks/bench_compression.py [ --levels 1,6 ] [ --files "/data/*.dcm" ] [ --runs 3 ]
+                                            [ --output results.json ]
+
+SPDX-License-Identifier: Apache 2.0
+"""
+
+import argparse
+import array
+import glob
+import io
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from pydicom import dcmread, uid
+from pydicom.dataset import Dataset, FileMetaDataset
+from InstanceCompressor import InstanceCompressor
+from bench_multipart_reader import gitCommit
+
+MB = 1048576
+
+
+def ctSlice(size, noiseBits, seed=1):
+    # a disc of soft tissue with a ring of bone in air, 12 bits stored in 16 bits.
+    noise = random.Random(seed)
+    pixels = array.array("H")
+    center = size / 2
+    for row in range(size):
+        for column in range(size):
+            radius = math.hypot(row - center, column - center) / center
+            if radius > 0.9:
+                value = 24
+            elif radius > 0.8:
+                value = 2200
+            else:
+                value = 1040 + int(40 * math.sin(row / 9.0) * math.cos(column / 13.0))
+            pixels.append(value + noise.getrandbits(noiseBits))
+    return pixels.tobytes(), size, size, 1, 16
+
+
+def mrSlice(size, seed=2):
+    noise = random.Random(seed)
+    pixels = array.array("H")
+    for row in range(size):
+        for column in range(size):
+            value = 300 + 250 * math.sin(row / 20.0) * math.sin(column / 17.0) if (row - size/2)**2 + (column - size/2)**2 < (size/2.2)**2 else 0
+            pixels.append(max(0, int(value) + noise.randint(0, 15)))
+    return pixels.tobytes(), size, size, 1, 16
+
+
+def crImage(rows, columns, seed=3):
+    # a radiograph, smooth with a texture of 6 bits of noise. Generated by blocks of rows to stay quick.
+    noise = random.Random(seed)
+    pixels = array.array("H")
+    texture = [ noise.getrandbits(6) for _ in range(4096) ]
+    for row in range(rows):
+        base = 1800 + int(600 * math.sin(row / 150.0))
+        offset = noise.randrange(4096)
+        pixels.extend( base + (column >> 3) + texture[(offset + column) & 4095] for column in range(columns) )
+    return pixels.tobytes(), rows, columns, 1, 16
+
+
+def usFrame(rows, columns, seed=4):
+    # an ultrasound sector on a black background, grey speckle stored as RGB.
+    noise = random.Random(seed)
+    pixels = bytearray()
+    for row in range(rows):
+        for column in range(columns):
+            inside = abs(column - columns/2) < row * 0.7 and row > 40
+            grey = min(255, 60 + noise.getrandbits(7)) if inside else 0
+            pixels += bytes((grey, grey, grey))
+    return bytes(pixels), rows, columns, 3, 8
+
+
+def noiseImage(size, seed=5):
+    noise = random.Random(seed)
+    return array.array("H", ( noise.getrandbits(12) for _ in range(size*size) )).tobytes(), size, size, 1, 16
+
+
+SYNTHETIC = [
+    ("CT 512x512", lambda: ctSlice(512, 4)),
+    ("MR 256x256", lambda: mrSlice(256)),
+    ("CR 2048x2048", lambda: crImage(2048, 2048)),
+    ("US 640x480 RGB", lambda: usFrame(480, 640)),
+    ("noise 512x512", lambda: noiseImage(512)),
+]
+
+
+def buildInstance(pixels, rows, columns, samples, bits):
+    meta = FileMetaDataset()
+    meta.MediaStorageSOPClassUID = "1.2.840.10008.5.1.4.1.1.7"
+    meta.MediaStorageSOPInstanceUID = uid.generate_uid()
+    meta.TransferSyntaxUID = uid.ExplicitVRLittleEndian
+    ds = Dataset()
+    ds.file_meta = meta
+    ds.SOPClassUID = meta.MediaStorageSOPClassUID
+    ds.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+    ds.StudyInstanceUID = uid.generate_uid()
+    ds.SeriesInstanceUID = uid.generate_uid()
+    ds.PatientName = "Bench^Compression"
+    ds.Rows , ds.Columns , ds.SamplesPerPixel = rows , columns , samples
+    ds.BitsAllocated = ds.BitsStored = bits
+    ds.HighBit = bits - 1
+    ds.PixelRepresentation = 0
+    ds.PhotometricInterpretation = "RGB" if samples == 3 else "MONOCHROME2"
+    if samples == 3:
+        ds.PlanarConfiguration = 0
+    ds.PixelData = pixels
+    ds["PixelData"].VR = "OW" if bits > 8 else "OB"
+    buffer = io.BytesIO()
+    try:
+        ds.save_as(buffer, enforce_file_format=True)
+    except TypeError:
+        # pydicom 2
+        ds.is_implicit_VR , ds.is_little_endian = False , True
+        ds.save_as(buffer, write_like_original=False)
+    return buffer.getvalue()
+
+
+def runCase(name, source, level, runs, folder, verify):
+    compressor = InstanceCompressor()
+    compressor.level = level
+    compressor.minSaving = 0.0
+    size = os.path.getsize(source)
+    best = None
+    for run in range(runs):
+        target = os.path.join(folder, "instance.dcm")
+        shutil.copyfile(source, target)
+        started , cpuStarted = time.perf_counter() , time.process_time()
+        compressedSize = compressor.Compress(target)
+        elapsed , cpu = time.perf_counter() - started , time.process_time() - cpuStarted
+        if best is None or elapsed < best[0]:
+            best = (elapsed, cpu)
+    compressor.Shutdown()
+    if compressedSize is None:
+        return { "case" : name, "level" : level, "size_bytes" : size, "compressed" : False }
+    lossless = None
+    if verify:
+        lossless = dcmread(target).PixelData == dcmread(source).PixelData
+    elapsed , cpu = best
+    return {
+        "case" : name,
+        "level" : level,
+        "compressed" : True,
+        "size_bytes" : size,
+        "compressed_bytes" : compressedSize,
+        "ratio" : round(size / compressedSize, 3),
+        "mb_per_s" : round(size / MB / max(elapsed, 1e-9), 1),
+        "cpu_s_per_mb" : round(cpu / (size / MB), 4),
+        "lossless" : lossless,
+    }
+
+
+def printResult(result):
+    if not result["compressed"]:
+        print(f"{result['case']:>16} level {result['level']} : not compressed ( not Explicit VR Little Endian )")
+        return
+    print(f"{result['case']:>16} level {result['level']} : {result['size_bytes']/MB:8.2f} MB -> {result['compressed_bytes']/MB:8.2f} MB, "
+          f"ratio {result['ratio']:6.2f}, {result['mb_per_s']:7.1f} MB/s, {result['cpu_s_per_mb']*1000:7.2f} ms CPU/MB"
+          + ("" if result["lossless"] is None else f", lossless {result['lossless']}"))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="InstanceCompressor benchmark")
+    parser.add_argument("--levels", default="1,6", help="comma separated deflate levels")
+    parser.add_argument("--files", help="glob of real instances to measure instead of the synthetic ones")
+    parser.add_argument("--runs", type=int, default=3, help="the fastest of this many runs is kept")
+    parser.add_argument("--no-verify", action="store_true", help="do not read the compressed instances back")
+    parser.add_argument("--output", help="saves the results to this JSON file")
+    args = parser.parse_args()
+
+    folder = tempfile.mkdtemp(prefix="bench-compression-")
+    try:
+        if args.files:
+            sources = [ (os.path.basename(path), path) for path in sorted(glob.glob(args.files)) ]
+        else:
+            sources = []
+            for name , generate in SYNTHETIC:
+                path = os.path.join(folder, name.replace(" ", "_") + ".dcm")
+                with open(path, "wb") as instance:
+                    instance.write(buildInstance(*generate()))
+                sources.append((name, path))
+        results = []
+        for level in [ int(level) for level in args.levels.split(",") ]:
+            for name , path in sources:
+                result = runCase(name, path, level, args.runs, folder, not args.no_verify)
+                printResult(result)
+                results.append(result)
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+    compressed = [ result for result in results if result["compressed"] ]
+    for level in sorted({ result["level"] for result in compressed }):
+        ofLevel = [ result for result in compressed if result["level"] == level ]
+        total = sum( result["size_bytes"] for result in ofLevel )
+        print(f"level {level} overall : ratio {total / sum( result['compressed_bytes'] for result in ofLevel ):.2f}, "
+              f"{sum( result['cpu_s_per_mb'] * result['size_bytes'] for result in ofLevel ) / total * 1000:.2f} ms CPU/MB")
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump({
+                "commit" : gitCommit(),
+                "date" : time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                "python" : platform.python_version(),
+                "machine" : platform.machine(),
+                "results" : results,
+            }, output, indent=2)
+        print(f"results saved to {args.output}")
@@ -0,0 +1,54 @@
+"""
+bench_json_response.py : compares the time needed to build the JSON STOW-RS response with the pydicom Dataset
+implementation and with the direct serializer.
+
+Usage :
+    python3 benchmarks/bench_json_response.py [ number of instances ... ]
+
+SPDX-License-Identifier: Apache 2.0
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from StowRsJsonResponse import StowRsJsonResponse
+
+
+WADO = "https://wado.example.com/dicomweb"
+STUDY = "1.2.826.0.1.3680043.8.498.10000000000000000000000000000000001"
+
+
+def buildLists(instanceCount):
+    """ 1% of the instances are reported as failed, like a transaction with a few rejected parts. """
+    successlist = []
+    failedlist = []
+    for index in range(instanceCount):
+        instanceUID = f"1.2.826.0.1.3680043.8.498.{index}.{index * 7919}"
+        if index % 100 == 99:
+            failedlist.append(["1.2.840.10008.5.1.4.1.1.2", instanceUID, "0110"])
+        else:
+            successlist.append(["1.2.840.10008.5.1.4.1.1.2", instanceUID, f"{WADO}/studies/{STUDY}/series/1.2.3/instances/{instanceUID}", None])
+    return successlist , failedlist
+
+
+def timeIt(generate, successlist, failedlist, runs):
+    best = None
+    for run in range(runs):
+        started = time.perf_counter()
+        resp = generate(successlist, failedlist, f"{WADO}/studies/{STUDY}")
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best , resp
+
+
+if __name__ == "__main__":
+    counts = [ int(count) for count in sys.argv[1:] ] or [ 10, 1000, 10000 ]
+    for instanceCount in counts:
+        successlist , failedlist = buildLists(instanceCount)
+        runs = 5 if instanceCount <= 1000 else 3
+        dataset , expected = timeIt(StowRsJsonResponse.generateDatasetResponse, successlist, failedlist, runs)
+        direct , resp = timeIt(StowRsJsonResponse.generateResponse, successlist, failedlist, runs)
+        assert resp == expected, "the serializers do not produce the same document"
+        print(f"{instanceCount:>6} instances : pydicom {dataset * 1000:9.2f} ms , direct {direct * 1000:8.2f} ms , x{dataset / direct:.0f} , {len(resp)} bytes")
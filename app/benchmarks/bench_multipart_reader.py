@@ -0,0 +1,235 @@
+"""
+bench_multipart_reader.py : benchmark suite of the multipart_reader package.
+
+The multipart/related; type="application/dicom" bodies are generated while they are read, so parts of up to 2GB are
+never held in memory. Their payloads are random bytes, lines ending with CRLF, or data full of sequences which look
+like the delimiter of the parts. For each body and parsing mode the suite measures the throughput, the time per part
+and the peak memory allocated by the parser ( tracemalloc, in a separate run ), and checks the size of every part.
+
+The sync modes read the body through a werkzeug LimitedStream, which is what request.stream is in the STOW-RS
+endpoint. The async mode feeds an AsyncMultipartReader with 64KB messages, like the ASGI server does.
+
+Usage :
+    python3 benchmarks/bench_multipart_reader.py [ --suite quick|full ] [ --modes chunked,async,line ]
+                                                 [ --output results.json ] [ --compare baseline.json ]
+
+    The line mode reads the parts line by line and is very slow on binary data, it only runs when asked for.
+    Save the results of a commit with --output, and compare another commit to them with --compare.
+
+SPDX-License-Identifier: Apache 2.0
+"""
+
+import argparse
+import asyncio
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from multipart_reader import AsyncMultipartReader, MultipartReader
+from werkzeug.wsgi import LimitedStream
+
+
+BOUNDARY = b"BenchBoundary"
+HEADERS = [ ("Content-Type", f'multipart/related; type="application/dicom"; boundary={BOUNDARY.decode()}') ]
+PART_HEADERS = b"Content-Type: application/dicom; transfer-syntax=1.2.840.10008.1.2.1\r\n\r\n"
+PATTERN_SIZE = 1048576
+READ_SIZE = 1048576
+MESSAGE_SIZE = 65536
+KB , MB , GB = 1024 , 1048576 , 1073741824
+
+# name , part count , part size , payloads.
+SUITES = {
+    "quick" : [
+        ("1KB x 5000", 5000, KB, ("random", "crlf")),
+        ("256KB x 64", 64, 256*KB, ("random", "crlf", "near-boundary")),
+        ("16MB x 4", 4, 16*MB, ("random", "crlf", "near-boundary")),
+    ],
+}
+SUITES["full"] = SUITES["quick"] + [
+    ("256MB x 2", 2, 256*MB, ("random", "near-boundary")),
+    ("2GB x 1", 1, 2*GB, ("random", "near-boundary")),
+]
+
+
+def buildPattern(payload):
+    """ The PATTERN_SIZE block repeated in the parts. """
+    data = bytearray(os.urandom(PATTERN_SIZE))
+    if payload == "crlf":
+        # 80 bytes lines, like a text or a DICOM element value full of line ends.
+        for offset in range(78, PATTERN_SIZE - 1, 80):
+            data[offset:offset+2] = b"\r\n"
+    elif payload == "near-boundary":
+        # the delimiter without its last byte, and the delimiter followed by data instead of a line end.
+        lookalikes = ( b"\r\n--" + BOUNDARY[:-1], b"\r\n--" + BOUNDARY + b"X", b"\r\n--", b"\r\n\r\n--" + BOUNDARY[:4] )
+        for index , offset in enumerate(range(0, PATTERN_SIZE - 64, 997)):
+            sequence = lookalikes[index % len(lookalikes)]
+            data[offset:offset+len(sequence)] = sequence
+    return bytes(data)
+
+
+class SyntheticBody(io.RawIOBase):
+    """
+    A multipart body generated while it is read.
+    """
+
+    def __init__(self, partCount, partSize, pattern):
+        self.length = partCount * (len(BOUNDARY) + 4 + len(PART_HEADERS) + partSize + 2) + len(BOUNDARY) + 6
+        self.blocks = self.__generate(partCount, partSize, memoryview(pattern))
+        self.pending = memoryview(b"")
+
+    @staticmethod
+    def __generate(partCount, partSize, pattern):
+        for index in range(partCount):
+            yield b"--" + BOUNDARY + b"\r\n" + PART_HEADERS
+            left = partSize
+            while left > 0:
+                size = min(left, len(pattern))
+                yield pattern[:size]
+                left -= size
+            yield b"\r\n"
+        yield b"--" + BOUNDARY + b"--\r\n"
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while len(self.pending) == 0:
+            block = next(self.blocks, None)
+            if block is None:
+                return 0
+            self.pending = memoryview(block)
+        size = min(len(buffer), len(self.pending))
+        buffer[:size] = self.pending[:size]
+        self.pending = self.pending[size:]
+        return size
+
+
+def openBody(partCount, partSize, pattern):
+    body = SyntheticBody(partCount, partSize, pattern)
+    return LimitedStream(io.BufferedReader(body, MESSAGE_SIZE), body.length) , body.length
+
+
+def parseSync(stream, readSize):
+    reader = MultipartReader(HEADERS, stream, read_size=readSize)
+    sizes = []
+    try:
+        while part := reader.next():
+            size = 0
+            for chunk in part.iter_chunks():
+                size += len(chunk)
+            sizes.append(size)
+    except StopIteration:
+        pass
+    return sizes
+
+
+def parseAsync(stream):
+    async def read():
+        return stream.read(MESSAGE_SIZE)
+
+    async def parse():
+        sizes = []
+        async for part in AsyncMultipartReader(HEADERS, read, read_size=READ_SIZE):
+            size = 0
+            async for chunk in part.iter_chunks():
+                size += len(chunk)
+            sizes.append(size)
+        return sizes
+
+    return asyncio.run(parse())
+
+
+def runOnce(mode, partCount, partSize, pattern, traceMemory=False):
+    stream , length = openBody(partCount, partSize, pattern)
+    if traceMemory:
+        tracemalloc.start()
+    started = time.perf_counter()
+    if mode == "async":
+        sizes = parseAsync(stream)
+    else:
+        sizes = parseSync(stream, READ_SIZE if mode == "chunked" else None)
+    seconds = time.perf_counter() - started
+    peak = None
+    if traceMemory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    assert sizes == [partSize] * partCount, f"{mode} : the parts were not read back whole"
+    return seconds , length , peak
+
+
+def runCase(name, partCount, partSize, payload, mode, runs):
+    pattern = buildPattern(payload)
+    if partCount * partSize > 256*MB:
+        runs = 1
+    seconds = min( runOnce(mode, partCount, partSize, pattern)[0] for run in range(runs) )
+    length = runOnce(mode, partCount, partSize, pattern, traceMemory=True)
+    return {
+        "case" : name, "payload" : payload, "mode" : mode,
+        "parts" : partCount, "part_size" : partSize, "body_bytes" : length[1],
+        "seconds" : round(seconds, 6),
+        "mb_per_s" : round(length[1] / seconds / 1e6, 2),
+        "us_per_part" : round(seconds / partCount * 1e6, 2),
+        "peak_memory_bytes" : length[2],
+    }
+
+
+def gitCommit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def resultKey(result):
+    return (result["case"], result["payload"], result["mode"])
+
+
+def printResult(result, baseline=None):
+    line = (f"{result['case']:>12} {result['payload']:>13} {result['mode']:>7} : {result['mb_per_s']:9.1f} MB/s "
+            f"{result['us_per_part']:12.1f} us/part , peak {result['peak_memory_bytes'] / MB:7.2f} MB")
+    if baseline is not None:
+        line += f" , {(result['mb_per_s'] / baseline['mb_per_s'] - 1) * 100:+6.1f}% MB/s"
+        line += f" , {(result['peak_memory_bytes'] - baseline['peak_memory_bytes']) / MB:+7.2f} MB peak"
+    print(line)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="multipart_reader benchmark suite")
+    parser.add_argument("--suite", choices=sorted(SUITES), default="quick")
+    parser.add_argument("--modes", default="chunked,async", help="comma separated : chunked, async, line")
+    parser.add_argument("--runs", type=int, default=3, help="the best of this many runs is kept")
+    parser.add_argument("--output", help="saves the results to this JSON file")
+    parser.add_argument("--compare", help="JSON results of a previous run to compare to")
+    args = parser.parse_args()
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as previous:
+            baseline = { resultKey(result) : result for result in json.load(previous)["results"] }
+
+    results = []
+    for name , partCount , partSize , payloads in SUITES[args.suite]:
+        for payload in payloads:
+            for mode in args.modes.split(","):
+                result = runCase(name, partCount, partSize, payload, mode, args.runs)
+                printResult(result, baseline.get(resultKey(result)))
+                results.append(result)
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump({
+                "commit" : gitCommit(),
+                "date" : time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                "python" : platform.python_version(),
+                "machine" : platform.machine(),
+                "suite" : args.suite,
+                "results" : results,
+            }, output, indent=2)
+        print(f"results saved to {args.output}")
@@ -0,0 +1,84 @@
+"""
+bench_part_headers.py : measures the per part overhead of the multipart reader for transactions of many small instances.
+
+It compares the parsing of the part headers with the general HTTP parser ( HttpParser and CIMultiDict, used before )
+and with the bytes parser of multipart_reader.headers, then times the reading of whole bodies of small parts.
+
+Usage :
+    python3 benchmarks/bench_part_headers.py [ number of parts ] [ part size in bytes ]
+
+SPDX-License-Identifier: Apache 2.0
+"""
+
+import io
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from multipart_reader import MultipartReader
+from multipart_reader.headers import parse_content_type, parse_part_headers
+from multipart_reader.helpers import parse_mimetype
+from multipart_reader.protocol import HttpParser
+
+
+BOUNDARY = "BenchBoundary"
+HEADERS = [ ("Content-Type", f'multipart/related; type="application/dicom"; boundary={BOUNDARY}') ]
+PART_HEADERS = [
+    b"Content-Type: application/dicom; transfer-syntax=1.2.840.10008.1.2.1\r\n",
+    b"Content-Location: instance\r\n",
+    b"\r\n",
+]
+
+
+def legacyParse(lines):
+    # what MultipartReader._read_headers and _get_part_reader did for each part.
+    decoded = [""] + [ line.decode().strip() for line in lines ]
+    headers , _ , _ = HttpParser().parse_headers(decoded)
+    parse_mimetype(headers.get("Content-Type", ""))
+    return headers
+
+
+def fastParse(lines):
+    headers = parse_part_headers(lines)
+    parse_content_type(headers.get("Content-Type", ""))
+    return headers
+
+
+def timeHeaders(parse, count):
+    started = time.perf_counter()
+    for index in range(count):
+        parse(PART_HEADERS)
+    return (time.perf_counter() - started) / count
+
+
+def buildBody(partCount, partSize):
+    part = f"--{BOUNDARY}\r\n".encode() + b"".join(PART_HEADERS) + os.urandom(partSize) + b"\r\n"
+    return part * partCount + f"--{BOUNDARY}--\r\n".encode()
+
+
+def timeParts(body, readSize):
+    reader = MultipartReader(HEADERS, io.BytesIO(body), read_size=readSize)
+    parts = 0
+    started = time.perf_counter()
+    try:
+        while part := reader.next():
+            for chunk in part.iter_chunks(decode=True):
+                pass
+            parts += 1
+    except StopIteration:
+        pass
+    return parts , time.perf_counter() - started
+
+
+if __name__ == "__main__":
+    partCount = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    partSize = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    assert legacyParse(PART_HEADERS) == fastParse(PART_HEADERS)
+    legacy = min( timeHeaders(legacyParse, partCount) for run in range(3) )
+    fast = min( timeHeaders(fastParse, partCount) for run in range(3) )
+    print(f"part headers : HttpParser {legacy * 1e6:6.2f} us , bytes parser {fast * 1e6:6.2f} us")
+    body = buildBody(partCount, partSize)
+    for mode , readSize in (("line", None), ("chunked", 1048576)):
+        parts , seconds = min( (timeParts(body, readSize) for run in range(3)), key=lambda result: result[1] )
+        print(f"{parts} parts of {partSize} bytes , {mode:>7} mode : {seconds / parts * 1e6:6.2f} us per part")
@@ -0,0 +1,63 @@
+"""
+bench_xml_response.py : compares the ElementTree implementation of the XML STOW-RS response with the incremental writer.
+
+For each transaction size it prints the time to build the whole document, the time until the first chunk of the
+streamed response is available, and the peak memory allocated while building it.
+
+Usage :
+    python3 benchmarks/bench_xml_response.py [ number of instances ... ]
+
+SPDX-License-Identifier: Apache 2.0
+"""
+
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from StowRsXmlResponse import StowRsXmlResponse
+from bench_json_response import WADO, STUDY, buildLists
+
+
+def timeIt(build, runs):
+    best = None
+    for run in range(runs):
+        started = time.perf_counter()
+        resp = build()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best , resp
+
+
+def peakMemory(build):
+    tracemalloc.start()
+    build()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+
+def consume(chunks):
+    # what the server does with a streamed body : send each chunk and drop it.
+    size = 0
+    for chunk in chunks:
+        size += len(chunk)
+    return size
+
+
+if __name__ == "__main__":
+    counts = [ int(count) for count in sys.argv[1:] ] or [ 10, 1000, 10000 ]
+    for instanceCount in counts:
+        successlist , failedlist = buildLists(instanceCount)
+        retrieveUrl = f"{WADO}/studies/{STUDY}"
+        runs = 5 if instanceCount <= 1000 else 3
+        tree , expected = timeIt(lambda: StowRsXmlResponse.generateTreeResponse(successlist, failedlist, retrieveUrl), runs)
+        assert StowRsXmlResponse.generateResponse(successlist, failedlist, retrieveUrl) == expected, "the writers do not produce the same document"
+        streamed , size = timeIt(lambda: consume(StowRsXmlResponse.iterResponse(successlist, failedlist, retrieveUrl)), runs)
+        firstChunk , chunk = timeIt(lambda: next(StowRsXmlResponse.iterResponse(successlist, failedlist, retrieveUrl)), runs)
+        treeMemory = peakMemory(lambda: StowRsXmlResponse.generateTreeResponse(successlist, failedlist, retrieveUrl))
+        streamedMemory = peakMemory(lambda: consume(StowRsXmlResponse.iterResponse(successlist, failedlist, retrieveUrl)))
+        print(f"{instanceCount:>6} instances , {size} bytes :")
+        print(f"    ElementTree {tree * 1000:9.2f} ms , peak {treeMemory / 1048576:7.2f} MB")
+        print(f"    streamed    {streamed * 1000:9.2f} ms , peak {streamedMemory / 1048576:7.2f} MB , first chunk after {firstChunk * 1000:.2f} ms")
@@ -0,0 +1,291 @@
+"""
+fake_s3.py : a minimal S3 compatible server, the stand-in of the bucket in the load tests.
+
+It implements what S3FileManager uses, with the bucket in the path : PutObject, the multipart uploads
+( CreateMultipartUpload, UploadPart, CompleteMultipartUpload, AbortMultipartUpload ), HeadObject and GetObject.
+The requests are not authenticated. The time at which each object became durable is recorded, and the server can
+add latency to the requests or answer some of them with a 503 SlowDown, like a throttled bucket.
+
+The content of the objects is only kept when asked for, otherwise their size and ETag are. The CRC32 checksums sent
+in the headers or in the trailer of the bodies are checked like S3 does, the full object CRC32 of a multipart upload
+only when the content is kept. The x-amz-meta- headers are returned by HeadObject.
+
+SPDX-License-Identifier: Apache 2.0
+"""
+
+import zlib
+import base64
+import hashlib
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+from xml.sax.saxutils import escape
+
+
+READ_SIZE = 1048576
+_SLOWDOWN = (b'<?xml version="1.0" encoding="UTF-8"?>\n<Error><Code>SlowDown</Code>'
+             b'<Message>Please reduce your request rate.</Message></Error>')
+_BADDIGEST = (b'<?xml version="1.0" encoding="UTF-8"?>\n<Error><Code>BadDigest</Code>'
+              b'<Message>The CRC32 you specified did not match the calculated checksum.</Message></Error>')
+_NOSUCHUPLOAD = (b'<?xml version="1.0" encoding="UTF-8"?>\n<Error><Code>NoSuchUpload</Code>'
+                 b'<Message>The specified upload does not exist.</Message></Error>')
+
+
+def crc32Value(crc):
+    return base64.b64encode(crc.to_bytes(4, "big")).decode("ascii")
+
+
+class StoredObject:
+
+    def __init__(self, size, etag, durableAt, data=None, metadata=()):
+        self.size = size
+        self.etag = etag
+        self.durableAt = durableAt
+        self.data = data
+        self.metadata = list(metadata)   # the ( x-amz-meta- header , value ) of the object.
+
+
+class FakeS3Server(ThreadingHTTPServer):
+    """
+    The S3 stand-in, served from a background thread by Start().
+
+    Args:
+        port :          The listening port, 0 picks a free one.
+        keepData :      Keep the content of the objects, for GetObject.
+        latency :       Seconds added to every request.
+        slowDownRate :  Share of the PutObject and UploadPart requests answered with a 503 SlowDown.
+    """
+
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, port=0, keepData=False, latency=0.0, slowDownRate=0.0):
+        super().__init__(("127.0.0.1", port), _S3RequestHandler)
+        self.keepData = keepData
+        self.latency = latency
+        self.slowDownRate = slowDownRate
+        self.lock = threading.Lock()
+        self.objects = {}
+        self.uploads = {}
+        self.uploadMetadata = {}
+        self.requestCount = 0
+        self.slowDownCount = 0
+        self.receivedBytes = 0
+        self.checkedChecksums = 0
+        self.badChecksums = 0
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def Start(self):
+        thread = threading.Thread(target=self.serve_forever, name="fake-s3", daemon=True)
+        thread.start()
+        return self
+
+    def Stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def DurableAt(self, key):
+        # the wall clock time at which key was stored, or None.
+        with self.lock:
+            obj = self.objects.get(key)
+        return obj.durableAt if obj is not None else None
+
+    def Keys(self):
+        with self.lock:
+            return list(self.objects)
+
+    def Get(self, key):
+        with self.lock:
+            return self.objects.get(key)
+
+    def ShouldSlowDown(self):
+        if self.slowDownRate <= 0 or random.random() >= self.slowDownRate:
+            return False
+        with self.lock:
+            self.slowDownCount += 1
+        return True
+
+
+class _S3RequestHandler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+    server_version = "FakeS3"
+
+    def log_message(self, format, *args):
+        pass
+
+    def __parse(self):
+        url = urlsplit(self.path)
+        bucket , _ , key = url.path.lstrip("/").partition("/")
+        query = { name : values[0] for name , values in parse_qs(url.query, keep_blank_values=True).items() }
+        with self.server.lock:
+            self.server.requestCount += 1
+        if self.server.latency > 0:
+            time.sleep(self.server.latency)
+        return bucket , unquote(key) , query
+
+    def __readBody(self):
+        # Returns the MD5 of the body, its size, its content if the objects are kept, and False if its CRC32 does not
+        # match the one of the request.
+        length = int(self.headers.get("Content-Length", 0))
+        chunked = "aws-chunked" in self.headers.get("Content-Encoding", "") \
+            or self.headers.get("x-amz-content-sha256", "").startswith("STREAMING-")
+        md5 = hashlib.md5()
+        crc = 0
+        data = bytearray() if self.server.keepData else None
+        size = 0
+        self.trailers = {}
+        for piece in (self.__readAwsChunked() if chunked else self.__readLength(length)):
+            md5.update(piece)
+            crc = zlib.crc32(piece, crc)
+            size += len(piece)
+            if data is not None:
+                data += piece
+        expected = self.headers.get("x-amz-checksum-crc32") or self.trailers.get("x-amz-checksum-crc32")
+        valid = expected is None or self.command == "POST" or expected == crc32Value(crc)
+        with self.server.lock:
+            self.server.receivedBytes += size
+            if expected is not None and self.command != "POST":
+                self.server.checkedChecksums += 1
+                self.server.badChecksums += 0 if valid else 1
+        return md5 , size , bytes(data) if data is not None else None , valid
+
+    def __readLength(self, length):
+        while length > 0:
+            piece = self.rfile.read(min(length, READ_SIZE))
+            if not piece:
+                raise ConnectionError("body truncated")
+            length -= len(piece)
+            yield piece
+
+    def __readAwsChunked(self):
+        # <hex size>[;chunk-signature=...]\r\n<data>\r\n ... 0\r\n<trailers>\r\n
+        while True:
+            size = int(self.rfile.readline().split(b";")[0].strip(), 16)
+            if size == 0:
+                while line := self.rfile.readline().strip():
+                    name , _ , value = line.decode("latin-1").partition(":")
+                    self.trailers[name.strip().lower()] = value.strip()
+                return
+            yield from self.__readLength(size)
+            self.rfile.readline()
+
+    def __send(self, status, body=b"", headers=()):
+        self.send_response(status)
+        for name , value in headers:
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if body and self.command != "HEAD":
+            self.wfile.write(body)
+
+    def __store(self, key, size, etag, data=None, metadata=()):
+        with self.server.lock:
+            self.server.objects[key] = StoredObject(size, etag, time.time(), data, metadata)
+
+    def __metadata(self):
+        return [ (name, value) for name , value in self.headers.items() if name.lower().startswith("x-amz-meta-") ]
+
+    def do_PUT(self):
+        bucket , key , query = self.__parse()
+        md5 , size , data , valid = self.__readBody()
+        if self.server.ShouldSlowDown():
+            return self.__send(503, _SLOWDOWN, [("Content-Type", "application/xml")])
+        if not valid:
+            return self.__send(400, _BADDIGEST, [("Content-Type", "application/xml")])
+        etag = f'"{md5.hexdigest()}"'
+        if "uploadId" in query:
+            with self.server.lock:
+                upload = self.server.uploads.get(query["uploadId"])
+                if upload is not None:
+                    upload[int(query["partNumber"])] = (size, md5.digest(), data)
+            if upload is None:
+                return self.__send(404, _NOSUCHUPLOAD, [("Content-Type", "application/xml")])
+        else:
+            self.__store(key, size, etag, data, self.__metadata())
+        self.__send(200, headers=[("ETag", etag)])
+
+    def do_POST(self):
+        bucket , key , query = self.__parse()
+        self.__readBody()
+        if "uploads" in query:
+            uploadId = uuid.uuid4().hex
+            with self.server.lock:
+                self.server.uploads[uploadId] = {}
+                self.server.uploadMetadata[uploadId] = self.__metadata()
+            body = ('<?xml version="1.0" encoding="UTF-8"?>\n<InitiateMultipartUploadResult>'
+                    f'<Bucket>{escape(bucket)}</Bucket><Key>{escape(key)}</Key><UploadId>{uploadId}</UploadId>'
+                    '</InitiateMultipartUploadResult>').encode()
+            return self.__send(200, body, [("Content-Type", "application/xml")])
+        with self.server.lock:
+            upload = self.server.uploads.pop(query.get("uploadId"), None)
+            metadata = self.server.uploadMetadata.pop(query.get("uploadId"), ())
+        if upload is None:
+            return self.__send(404, _NOSUCHUPLOAD, [("Content-Type", "application/xml")])
+        parts = [ upload[number] for number in sorted(upload) ]
+        # the ETag of a multipart object is the MD5 of the MD5 of its parts, followed by the part count.
+        etag = f'"{hashlib.md5(b"".join(part[1] for part in parts)).hexdigest()}-{len(parts)}"'
+        data = b"".join(part[2] for part in parts) if self.server.keepData else None
+        expected = self.headers.get("x-amz-checksum-crc32")
+        if expected is not None and data is not None:
+            with self.server.lock:
+                self.server.checkedChecksums += 1
+            if expected != crc32Value(zlib.crc32(data)):
+                with self.server.lock:
+                    self.server.badChecksums += 1
+                return self.__send(400, _BADDIGEST, [("Content-Type", "application/xml")])
+        self.__store(key, sum(part[0] for part in parts), etag, data, metadata)
+        body = ('<?xml version="1.0" encoding="UTF-8"?>\n<CompleteMultipartUploadResult>'
+                f'<Bucket>{escape(bucket)}</Bucket><Key>{escape(key)}</Key><ETag>{escape(etag)}</ETag>'
+                '</CompleteMultipartUploadResult>').encode()
+        self.__send(200, body, [("Content-Type", "application/xml")])
+
+    def do_DELETE(self):
+        bucket , key , query = self.__parse()
+        with self.server.lock:
+            if "uploadId" in query:
+                self.server.uploads.pop(query["uploadId"], None)
+                self.server.uploadMetadata.pop(query["uploadId"], None)
+            else:
+                self.server.objects.pop(key, None)
+        self.__send(204)
+
+    def do_GET(self):
+        bucket , key , query = self.__parse()
+        obj = self.server.Get(key)
+        if obj is None:
+            return self.__send(404)
+        self.__send(200, obj.data or b"", [("ETag", obj.etag)])
+
+    def do_HEAD(self):
+        bucket , key , query = self.__parse()
+        obj = self.server.Get(key)
+        if obj is None:
+            return self.__send(404)
+        self.send_response(200)
+        self.send_header("ETag", obj.etag)
+        for name , value in obj.metadata:
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(obj.size))
+        self.end_headers()
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="minimal S3 compatible server")
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every request")
+    parser.add_argument("--slowdown-rate", type=float, default=0.0, help="share of the uploads answered with 503 SlowDown")
+    args = parser.parse_args()
+    server = FakeS3Server(args.port, latency=args.latency, slowDownRate=args.slowdown_rate)
+    print(f"S3 stand-in listening on {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
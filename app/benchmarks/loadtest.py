@@ -0,0 +1,412 @@
+"""
+loadtest.py : end-to-end load test of the STOW-RS service, with a local stand-in of the S3 bucket.
+
+The service ( main.py ) is started in a temporary folder and sends the instances to the S3 stand-in of fake_s3.py.
+Clients post synthetic DICOM studies to it, each request holding the instances of one series, and the /metrics
+endpoint is sampled while they run. The report gives :
+    - the requests/s and MB/s of the STOW-RS requests, and the p50/p95/p99 of their latency,
+    - the upload queue depth, the uploads in flight and the upload concurrency over time,
+    - the time-to-durable of every instance : from the start of its request until the object was stored in S3,
+    - the CPU seconds and peak memory of the service, to size the Fargate tasks.
+
+Usage :
+    python3 benchmarks/loadtest.py [ --concurrency 8 ] [ --requests 200 ] [ --instances 10 ] [ --sizes 512KB,4MB ]
+                                   [ --accept json,xml ] [ --env THREADCOUNT=32 --env SERVERMODE=asgi ]
+                                   [ --s3-latency 0.02 ] [ --bulk-instances 20000 --bulk-priority low ]
+                                   [ --output results.json ]
+
+    --sizes is the mix of the instance sizes, each instance picks one at random. --env passes configuration variables
+    to the service, it is how THREADCOUNT, WORKERS, SERVERMODE... are compared. --s3-latency adds a delay to every S3
+    request, a local stand-in answers much faster than the real bucket. --bulk-instances sends a large series first, the
+    time to durable of the other requests shows how much they wait behind it ( UPLOADFAIRNESS ).
+
+SPDX-License-Identifier: Apache 2.0
+"""
+
+import argparse
+import http.client
+import json
+import os
+import platform
+import random
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from io import BytesIO
+
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from fake_s3 import FakeS3Server
+from bench_multipart_reader import gitCommit
+
+
+APPFOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+SERVICEPORT = 8080 # main.py always listens on 8080.
+BUCKET = "loadtest"
+PREFIX = "loadtest"
+ACCEPT = { "json" : "application/dicom+json", "xml" : "application/dicom+xml" }
+UNITS = { "KB" : 1024, "MB" : 1048576, "GB" : 1073741824, "B" : 1 }
+CT_IMAGE_STORAGE = "1.2.840.10008.5.1.4.1.1.2"
+
+
+def parseSize(text):
+    text = text.strip().upper()
+    for unit , factor in UNITS.items():
+        if text.endswith(unit):
+            return int(float(text[:-len(unit)]) * factor)
+    return int(text)
+
+
+def percentile(values, share):
+    # nearest-rank percentile of values, None if there are none.
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(share * len(ordered) + 0.5)) - 1))]
+
+
+def summarize(values, scale=1000.0):
+    # p50 / p95 / p99 / max of a list of seconds, in milliseconds.
+    return { name : round(percentile(values, share) * scale, 3) if values else None
+             for name , share in (("p50", 0.50), ("p95", 0.95), ("p99", 0.99), ("max", 1.0)) }
+
+
+class StudyGenerator:
+    """
+    Builds the synthetic DICOM instances of a series. The pixel data of each size is generated once and shared.
+    """
+
+    def __init__(self, sizes):
+        self.sizes = sizes
+        self.pixels = { size : os.urandom(size) for size in set(sizes) }
+
+    def instance(self, study, series, number):
+        size = random.choice(self.sizes)
+        ds = Dataset()
+        ds.SOPClassUID = CT_IMAGE_STORAGE
+        ds.SOPInstanceUID = generate_uid()
+        ds.StudyInstanceUID = study
+        ds.SeriesInstanceUID = series
+        ds.PatientName = "LOAD^TEST"
+        ds.PatientID = "LOADTEST"
+        ds.Modality = "CT"
+        ds.InstanceNumber = number
+        ds.PixelData = self.pixels[size]
+        ds["PixelData"].VR = "OB"
+        ds.file_meta = FileMetaDataset()
+        ds.file_meta.MediaStorageSOPClassUID = ds.SOPClassUID
+        ds.file_meta.MediaStorageSOPInstanceUID = ds.SOPInstanceUID
+        ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+        buffer = BytesIO()
+        try:
+            ds.save_as(buffer, enforce_file_format=True)
+        except TypeError:
+            # pydicom 2
+            ds.is_implicit_VR , ds.is_little_endian = False , True
+            ds.save_as(buffer, write_like_original=False)
+        return f"{PREFIX}/{study}/{series}/{ds.SOPInstanceUID}.dcm" , buffer.getvalue()
+
+    def series(self, count):
+        # Returns the S3 keys of the instances and the multipart body of the request.
+        study , series = generate_uid() , generate_uid()
+        boundary = uuid.uuid4().hex
+        keys , pieces = [] , []
+        for number in range(1, count + 1):
+            key , data = self.instance(study, series, number)
+            keys.append(key)
+            pieces += [ f"--{boundary}\r\nContent-Type: application/dicom\r\n\r\n".encode(), data, b"\r\n" ]
+        pieces.append(f"--{boundary}--\r\n".encode())
+        return keys , b"".join(pieces) , f'multipart/related; type="application/dicom"; boundary={boundary}'
+
+
+class MetricsSampler(threading.Thread):
+    """
+    Samples the upload queue depth, the uploads in flight and the upload concurrency from the /metrics endpoint of the service.
+    """
+
+    GAUGES = { "stow_s3_upload_queue_depth" : "queued", "stow_s3_uploads_in_flight" : "inflight",
+               "stow_s3_upload_queued_bytes" : "queued_bytes", "stow_s3_upload_concurrency" : "concurrency" }
+
+    def __init__(self, interval):
+        super().__init__(name="metrics-sampler", daemon=True)
+        self.interval = interval
+        self.samples = []
+        self.stopped = threading.Event()
+        self.started = time.time()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                sample = readGauges(self.GAUGES)
+            except (OSError, http.client.HTTPException):
+                continue
+            sample["t"] = round(time.time() - self.started, 3)
+            self.samples.append(sample)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def readGauges(gauges):
+    connection = http.client.HTTPConnection("127.0.0.1", SERVICEPORT, timeout=5)
+    try:
+        connection.request("GET", "/metrics")
+        text = connection.getresponse().read().decode()
+    finally:
+        connection.close()
+    values = {}
+    for line in text.splitlines():
+        name , _ , value = line.partition(" ")
+        if name in gauges:
+            values[gauges[name]] = float(value)
+    return values
+
+
+def startService(s3url, serviceEnv, folder):
+    env = dict(os.environ)
+    env.update({ "BUCKETNAME" : BUCKET, "PREFIX" : PREFIX, "S3ENDPOINTURL" : s3url, "LOGLEVEL" : "WARNING",
+                 "AWS_ACCESS_KEY" : "loadtest", "AWS_SECRET_KEY" : "loadtest", "AWS_DEFAULT_REGION" : "us-east-1" })
+    env.update(serviceEnv)
+    process = subprocess.Popen([sys.executable, os.path.join(APPFOLDER, "main.py")], cwd=folder, env=env,
+                               stdout=subprocess.DEVNULL)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"the service exited with the code {process.returncode}.")
+        try:
+            readGauges({})
+            return process
+        except (OSError, http.client.HTTPException):
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError("the service did not start listening within 30s.")
+
+
+def processUsage(pid):
+    # CPU seconds and peak resident memory of the service and of its forked workers ( WORKERS > 1 ), read from /proc.
+    # None where /proc is not available.
+    try:
+        cpu , peak = 0.0 , 0
+        for entry in os.listdir("/proc"):
+            if not entry.isdigit():
+                continue
+            try:
+                with open(f"/proc/{entry}/stat") as stat:
+                    fields = stat.read().rpartition(")")[2].split()
+                if int(entry) != pid and int(fields[1]) != pid:
+                    continue
+                cpu += ( int(fields[11]) + int(fields[12]) ) / os.sysconf("SC_CLK_TCK")
+                with open(f"/proc/{entry}/status") as status:
+                    peak += next( int(line.split()[1]) * 1024 for line in status if line.startswith("VmHWM:") )
+            except (OSError, StopIteration):
+                continue
+        return round(cpu, 3) , peak
+    except (OSError, ValueError):
+        return None , None
+
+
+def post(connection, series, headers):
+    # Sends the STOW-RS request of series, returns its result and the connection to use next.
+    keys , body , contentType = series
+    started = time.time()
+    try:
+        connection.request("POST", "/studies", body, dict(headers, **{ "Content-Type" : contentType }))
+        response = connection.getresponse()
+        response.read()
+        status = response.status
+    except (OSError, http.client.HTTPException) as ex:
+        status = f"{type(ex).__name__}"
+        connection.close()
+        connection = http.client.HTTPConnection("127.0.0.1", SERVICEPORT, timeout=connection.timeout)
+    return { "started" : started, "latency" : time.time() - started, "status" : status, "accept" : headers["Accept"],
+             "bytes" : len(body), "keys" : keys, "bulk" : False } , connection
+
+
+def runClients(args, generator):
+    # Each client thread posts its share of the requests. Returns the results of the requests.
+    # With --bulk-instances a single request of that many instances is sent first, like a migration.
+    results = []
+    lock = threading.Lock()
+    counter = iter(range(args.requests))
+    accepts = [ ACCEPT[name] for name in args.accept.split(",") ]
+
+    def client():
+        connection = http.client.HTTPConnection("127.0.0.1", SERVICEPORT, timeout=args.timeout)
+        while True:
+            with lock:
+                index = next(counter, None)
+            if index is None:
+                break
+            headers = { "Accept" : accepts[index % len(accepts)] }
+            if args.priority:
+                headers["X-Upload-Priority"] = args.priority
+            result , connection = post(connection, generator.series(args.instances), headers)
+            with lock:
+                results.append(result)
+        connection.close()
+
+    def bulkClient():
+        connection = http.client.HTTPConnection("127.0.0.1", SERVICEPORT, timeout=args.timeout)
+        headers = { "Accept" : accepts[0] }
+        if args.bulk_priority:
+            headers["X-Upload-Priority"] = args.bulk_priority
+        result , connection = post(connection, bulkSeries, headers)
+        result["bulk"] = True
+        connection.close()
+        with lock:
+            results.append(result)
+
+    threads = [ threading.Thread(target=client, name=f"client-{index}") for index in range(args.concurrency) ]
+    if args.bulk_instances > 0:
+        bulkSeries = generator.series(args.bulk_instances)
+        bulk = threading.Thread(target=bulkClient, name="bulk-client")
+        bulk.start()
+        time.sleep(args.bulk_lead)
+        threads.append(bulk)
+    for thread in threads:
+        if thread.name != "bulk-client":
+            thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def waitDurable(s3, keys, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if all( s3.DurableAt(key) is not None for key in keys ):
+            return True
+        time.sleep(0.1)
+    return False
+
+
+def runLoadTest(args):
+    sizes = [ parseSize(size) for size in args.sizes.split(",") ]
+    serviceEnv = dict( item.split("=", 1) for item in args.env )
+    generator = StudyGenerator(sizes)
+    s3 = FakeS3Server(latency=args.s3_latency, slowDownRate=args.s3_slowdown_rate).Start()
+    with tempfile.TemporaryDirectory(prefix="stow-loadtest-") as folder:
+        service = startService(s3.url, serviceEnv, folder)
+        sampler = MetricsSampler(args.sample_interval)
+        try:
+            sampler.start()
+            started = time.time()
+            results = runClients(args, generator)
+            elapsed = time.time() - started
+            accepted = [ result for result in results if result["status"] == 200 ]
+            keys = [ key for result in accepted for key in result["keys"] ]
+            allDurable = waitDurable(s3, keys, args.drain_timeout)
+            drained = time.time() - started
+            cpu , peakMemory = processUsage(service.pid)
+            sampler.stop()
+        finally:
+            service.send_signal(signal.SIGTERM)
+            try:
+                service.wait(timeout=args.drain_timeout)
+            except subprocess.TimeoutExpired:
+                service.kill()
+            s3.Stop()
+
+    def timeToDurable(results, afterResponse=False):
+        return [ s3.DurableAt(key) - result["started"] - (result["latency"] if afterResponse else 0)
+                 for result in results for key in result["keys"] if s3.DurableAt(key) is not None ]
+
+    regular = [ result for result in accepted if not result["bulk"] ]
+    bulk = [ result for result in accepted if result["bulk"] ]
+    statuses = {}
+    for result in results:
+        statuses[str(result["status"])] = statuses.get(str(result["status"]), 0) + 1
+    sentBytes = sum( result["bytes"] for result in accepted )
+    return {
+        "commit" : gitCommit(),
+        "date" : time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "python" : platform.python_version(),
+        "cpus" : os.cpu_count(),
+        "config" : { "concurrency" : args.concurrency, "requests" : args.requests, "instances" : args.instances,
+                     "sizes" : sizes, "accept" : args.accept, "env" : serviceEnv,
+                     "s3_latency" : args.s3_latency, "s3_slowdown_rate" : args.s3_slowdown_rate,
+                     "priority" : args.priority, "bulk_instances" : args.bulk_instances, "bulk_priority" : args.bulk_priority },
+        "statuses" : statuses,
+        "seconds" : round(elapsed, 3),
+        "requests_per_s" : round(len(accepted) / elapsed, 2),
+        "instances_per_s" : round(len(keys) / elapsed, 2),
+        "mb_per_s" : round(sentBytes / elapsed / 1e6, 2),
+        "latency_ms" : summarize([ result["latency"] for result in regular ]),
+        "latency_ms_per_accept" : { accept : summarize([ result["latency"] for result in regular
+                                                         if result["accept"] == accept ])
+                                    for accept in sorted({ result["accept"] for result in regular }) },
+        "time_to_durable_ms" : summarize(timeToDurable(regular)),
+        "durable_after_response_ms" : summarize(timeToDurable(regular, afterResponse=True)),
+        "bulk_time_to_durable_ms" : summarize(timeToDurable(bulk)) if bulk else None,
+        "all_durable" : allDurable,
+        "drained_seconds" : round(drained, 3),
+        "s3_requests" : s3.requestCount,
+        "s3_slowdowns" : s3.slowDownCount,
+        "s3_checksums_checked" : s3.checkedChecksums,
+        "s3_bad_checksums" : s3.badChecksums,
+        "service_cpu_seconds" : cpu,
+        "service_peak_memory_bytes" : peakMemory,
+        "queue" : sampler.samples,
+    }
+
+
+def printReport(report):
+    print(f"{report['statuses']} in {report['seconds']}s : {report['requests_per_s']} requests/s, "
+          f"{report['instances_per_s']} instances/s, {report['mb_per_s']} MB/s")
+    print(f"latency (ms)                    : {report['latency_ms']}")
+    for accept , latency in report["latency_ms_per_accept"].items():
+        print(f"  {accept:<29} : {latency}")
+    print(f"time to durable in S3 (ms)      : {report['time_to_durable_ms']}")
+    print(f"durable after the response (ms) : {report['durable_after_response_ms']}")
+    if report["bulk_time_to_durable_ms"] is not None:
+        print(f"bulk request, time to durable   : {report['bulk_time_to_durable_ms']}")
+    print(f"all instances durable : {report['all_durable']}, queue drained after {report['drained_seconds']}s, "
+          f"{report['s3_requests']} S3 requests, {report['s3_slowdowns']} SlowDown, "
+          f"{report['s3_checksums_checked']} CRC32 checked ({report['s3_bad_checksums']} bad)")
+    if report["service_cpu_seconds"] is not None:
+        print(f"service : {report['service_cpu_seconds']} CPU seconds "
+              f"({report['service_cpu_seconds'] / max(report['mb_per_s'] * report['seconds'], 1e-6):.4f} s/MB), "
+              f"peak memory {report['service_peak_memory_bytes'] / 1048576:.1f} MB")
+    samples = report["queue"]
+    if samples:
+        print("queue depth over time :")
+        step = max(1, len(samples) // 20)
+        for sample in samples[::step]:
+            print(f"  {sample['t']:8.2f}s  queued {int(sample.get('queued', 0)):6d}  "
+                  f"in flight {int(sample.get('inflight', 0)):4d}  concurrency {int(sample.get('concurrency', 0)):4d}  "
+                  f"{sample.get('queued_bytes', 0) / 1048576:9.1f} MB")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="STOW-RS service load test against a local S3 stand-in")
+    parser.add_argument("--concurrency", type=int, default=8, help="client connections posting at the same time")
+    parser.add_argument("--requests", type=int, default=200, help="STOW-RS requests to send")
+    parser.add_argument("--instances", type=int, default=10, help="instances per request")
+    parser.add_argument("--sizes", default="512KB", help="comma separated instance sizes, eg 256KB,4MB")
+    parser.add_argument("--accept", default="json", help="comma separated : json, xml")
+    parser.add_argument("--priority", help="X-Upload-Priority header of the requests : stat, high, routine, low")
+    parser.add_argument("--bulk-instances", type=int, default=0, help="instances of a bulk request sent before the others")
+    parser.add_argument("--bulk-priority", help="X-Upload-Priority header of the bulk request")
+    parser.add_argument("--bulk-lead", type=float, default=2.0, help="seconds between the bulk request and the others")
+    parser.add_argument("--env", action="append", default=[], help="NAME=VALUE passed to the service, repeatable")
+    parser.add_argument("--s3-latency", type=float, default=0.0, help="seconds added to every S3 request")
+    parser.add_argument("--s3-slowdown-rate", type=float, default=0.0, help="share of the uploads answered with 503 SlowDown")
+    parser.add_argument("--sample-interval", type=float, default=0.5, help="seconds between two /metrics samples")
+    parser.add_argument("--timeout", type=float, default=300, help="seconds a client waits for a response")
+    parser.add_argument("--drain-timeout", type=float, default=300, help="seconds to wait for the uploads once the requests are sent")
+    parser.add_argument("--output", help="saves the report to this JSON file")
+    args = parser.parse_args()
+
+    report = runLoadTest(args)
+    printReport(report)
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+        print(f"report saved to {args.output}")
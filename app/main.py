@@ -6,12 +6,19 @@ SPDX-License-Identifier: Apache 2.0
 """
 
 import os
+import sys
+import signal
+import socket
+import shutil
+import functools
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
 from http import HTTPStatus
 import string
 from flask import Flask, render_template, request
 from flask import Response
-from multipart_reader import MultipartReader
+from multipart_reader import MultipartReader, AsyncMultipartReader
 import xml.etree.ElementTree as ET
 from pydicom import dcmread
 import werkzeug
@@ -22,26 +29,91 @@ import logging
 import uuid
 import collections
 from S3FileManager import *
+from DicomHeaderSniffer import DicomHeaderSniffer
+from AdmissionController import AdmissionController
+from UploadJournal import UploadJournal
+from DeadLetterFolder import DeadLetterFolder
+from InstanceDeduplicator import InstanceDeduplicator
+from InstanceCompressor import InstanceCompressor
+from UploadScheduler import parsePriority
+from StowRsTransaction import StowRsTransaction
+from StowAsgi import AsgiApp, AsgiResponse, ClientDisconnected, RequestBodyTooLarge
+import StowMetrics
 from waitress import serve
 import time
 
 
 app = Flask(__name__)
+asgiApp = AsgiApp(maxBodySize=4294967296)
 tempfolder= os.getcwd()+"/out/"
+metricsfolder = tempfolder+"metrics/" # multi-process mode : the metrics of each worker.
+deadletterfolder = tempfolder+"deadletter/" # the instances which could not be uploaded, see replayDeadLetter.
+waitressthreads = 4 # the waitress default, the request threads of the WSGI front end.
+maxheaderbuffersize = 67108864 # Diskless mode : the UIDs must be found in the first 64MB of an instance.
 finishedTransactions = collections.deque([])
-filesToDelete = collections.deque([])
 destinationBucket = None
+uploadfairness = "transaction" # the uploads are queued fairly between the transactions, the senders, or "none" for FIFO.
+priorityheader = "X-Upload-Priority" # request header giving the priority class of the uploads : stat, high, routine or low.
+deduplication = "none" # "index" skips the instances stored lately with the same content, "head" also asks S3 for the other ones.
+duplicatewarning = None # the WarningReason of the duplicate instances in the response, None reports them as stored.
+compression = "none" # "deflate" stores the Explicit VR Little Endian instances as Deflated Explicit VR Little Endian.
+undecodablereason = "C000" # the FailureReason of the parts which could not be decoded ( Cannot understand ).
 
 
 
+def measureRequest(handler):
+    """
+    Decorator recording the count and the duration of the STOW-RS requests per HTTP status.
+    """
+    @functools.wraps(handler)
+    def measuredHandler(*args, **kwargs):
+        started = time.perf_counter()
+        response = handler(*args, **kwargs)
+        status = str(response.status_code)
+        StowMetrics.requestCount.inc(status=status)
+        StowMetrics.requestDuration.observe(time.perf_counter()-started, status=status)
+        return response
+    if asyncio.iscoroutinefunction(handler):
+        @functools.wraps(handler)
+        async def measuredCoroutine(*args, **kwargs):
+            started = time.perf_counter()
+            response = await handler(*args, **kwargs)
+            status = str(response.status_code)
+            StowMetrics.requestCount.inc(status=status)
+            StowMetrics.requestDuration.observe(time.perf_counter()-started, status=status)
+            return response
+        return measuredCoroutine
+    return measuredHandler
+
 @app.route("/studies", methods=["POST"])
+@measureRequest
 def callMethod():
     return _StowRsReceiver(None)
 
 @app.route("/studies/<studyInstanceUID>", methods=["POST"])
+@measureRequest
 def callMethodwithStudyUID(studyInstanceUID):
     return _StowRsReceiver( studyInstanceUID )
 
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    return Response(status = 200 , response=StowMetrics.registry.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+# The same routes for the ASGI front end, see SERVERMODE.
+@asgiApp.route("POST", "/studies")
+@measureRequest
+async def asgiCallMethod(request):
+    return await _StowRsReceiverAsync(request, None)
+
+@asgiApp.route("POST", "/studies/(?P<studyInstanceUID>[^/]+)")
+@measureRequest
+async def asgiCallMethodwithStudyUID(request, studyInstanceUID):
+    return await _StowRsReceiverAsync(request, studyInstanceUID)
+
+@asgiApp.route("GET", "/metrics")
+async def asgiMetrics(request):
+    return AsgiResponse(200, body=StowMetrics.registry.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
 
 def _StowRsReceiver( StudyUID ):
     """
@@ -58,87 +130,169 @@ def _StowRsReceiver( StudyUID ):
         None
     """
 
-    hd = request.headers.to_wsgi_list()
-    reader = MultipartReader(hd, request.stream)
-
-    transactionuuid = uuid.uuid4()
-    httpstatus = 200
+    if not admission.Admit():
+        logging.warning(f"STOW-RS request refused, the service is overloaded. Retry-After : {admission.retryAfter}s.")
+        return Response(status = 503 , headers = { "Retry-After" : str(admission.retryAfter) })
 
-    
-    fileinstance =0 
-    logging.debug(f"Receiving STOW-RS connection, assigned to Tran ID :{str(transactionuuid)}.")
+    hd = request.headers.to_wsgi_list()
+    reader = MultipartReader(hd, request.stream, read_size=multipartreadsize)
+    transaction = newTransaction(StudyUID, requestSender(request.headers.get("X-Forwarded-For"), request.remote_addr), request.headers.get(priorityheader))
+    logging.debug(f"Receiving STOW-RS connection, assigned to Tran ID :{transaction.transactionuuid}.")
     try:
-        successInstance = []
-        failedInstance = []
         while rFile := reader.next():
+            if not admission.WaitForCapacity(transaction):
+                ds = _SniffAndRelease(rFile, transaction.RefuseInstance())
+                transaction.InstanceFailed(ds, "A700")
+                continue
             try:
-                fileinstance = fileinstance+1
-                try:
-                    #08/04/2022 - Test the exception handling for this use case.
-                    storelocation = tempfolder+str(transactionuuid)
-                    os.makedirs(storelocation, exist_ok=True)
-                    filepath = storelocation+"/file_"+str(fileinstance)
-                    with open(filepath, "wb") as binary_file:
-                        binary_file.write(rFile.read()) 
-                except:
-                    ds = adapt_dataset_from_bytes(rFile.read())   
-                    failedInstance.append([ds["00080016"].value, ds["00080018"].value, "A700"])
-                    httpstatus = 202
-                    continue
-                try:
-                    ds = dcmread(filepath,  specific_tags = { "00080016" , "0020000D" , "0020000E" , "00080018"})
-                    if( StudyUID is not None) and ( StudyUID != ds["0020000D"].value):
-                        logging.warning(f"Received instance does not belong to study {StudyUID}, rejecting.")
-                        failedInstance.append([ds["00080016"].value, ds["00080018"].value, "910"]) # do not add this entry in S3Sender. The error code is made up, the spec does not specify which one to use.
-                        filesToDelete.append(filepath)
-                        httpstatus = 202
-                        continue
-                except Exception as ex:
-                    logging.error(ex)
-
-                studyinstanceUID = ds["0020000D"].value
-                seriesInstanceUID = ds["0020000E"].value
-                instanceUID = ds["00080018"].value
-                
-                filelocation , dicomtree = moveFileInDicomTreeDir(storelocation+"/file_"+str(fileinstance), str(transactionuuid) , studyinstanceUID , seriesInstanceUID , instanceUID ) 
-                if(WadoURL is None):
-                    wadoUrl = ""
-                    retrieveUrl = ""
-                else:
-                    wadoUrl = f"{WadoURL}/studies/{studyinstanceUID}/series/{seriesInstanceUID}/instances/{instanceUID}"
-                    retrieveUrl = f"{WadoURL}/studies/{studyinstanceUID}"
-                successInstance.append([ds["00080016"].value, ds["00080018"].value, wadoUrl, None ])
-                S3Sender.AddSendJob([filelocation, dicomtree] )
-
+                sink = transaction.OpenInstance()
+            except Exception as ex:
+                logging.error(f"Could not store the instance {transaction.fileinstance} :  {ex}")
+                ds = _SniffAndRelease(rFile, DicomHeaderSniffer())
+                transaction.InstanceFailed(ds, "A700")
+                continue
+            failureReason = undecodablereason
+            try:
+                # gzip, deflate and base64 encoded parts are decoded on the fly. An error raised while the sink writes
+                # a chunk is reported with the reason of the sink, the other ones come from the decoding of the part.
+                for chunk in rFile.iter_chunks(decode=True):
+                    failureReason = sink.failureReason
+                    if not sink.write(chunk):
+                        break
+                    failureReason = undecodablereason
             except Exception as ex:
-                logging.error(f"Could not process the instance {fileinstance} :  {ex}")
-                failedInstance.append([ds["00080016"].value, ds["00080018"].value, "0110"]) 
-                httpstatus = 202
+                logging.error(f"Could not process the instance {transaction.fileinstance} :  {ex}")
+                sink.abort()
+                ds = _SniffAndRelease(rFile, sink.sniffer)
+                transaction.InstanceFailed(ds, failureReason)
+                continue
+            rFile.release()
+            transaction.InstanceReceived(sink)
     except StopIteration as serror:
-        logging.debug(f"{str(fileinstance)} files received." )
-    resp=""
-
-    if(request.headers.get('Accept').lower() != "application/dicom+xml"):
-        logging.info("Sending the association response as a JSON document.")
-        resp = StowRsJsonResponse.generateResponse(successInstance, failedInstance, retrieveUrl)
-        mimetype = 'text/json'
-        contentType = 'application/json'  
-    else:
-        logging.info("Sending the association response as a XML document.")
-        resp = StowRsXmlResponse.generateResponse(successInstance, failedInstance, retrieveUrl)
-        mimetype= 'text/xml'
-        contentType = 'application/xml'
-         #some app like 3D slicer sends */* in their request header "Accept", 
+        logging.debug(f"{str(transaction.fileinstance)} files received." )
+
+    if synccommit:
+        # The uploads ran while the body was received, only the slowest ones are left to wait for.
+        for upload , instanceEntry in transaction.committedInstances:
+            if not upload.result():
+                transaction.CommitFailed(instanceEntry)
+
+    httpstatus , resp , mimetype , contentType = transaction.BuildResponse(request.headers.get('Accept'))
+    finishedTransactions.append(transaction.transactionuuid)
+    if responsedelay > 0 and not transaction.WaitForUploads(responsedelay):
+        logging.debug(f"{transaction.transactionuuid} : uploads still running after the response delay.")
+    return Response(status = httpstatus  ,response=resp, mimetype=mimetype , content_type=contentType)
 
+async def _StowRsReceiverAsync( request, StudyUID=None ):
+    """
+    Same as _StowRsReceiver, for the ASGI front end. The body is read from the event loop, the file and S3 work of each chunk
+    is offloaded to the ioExecutor threads so that a slow sender only holds a coroutine.
 
-    if( len(successInstance) == 0):
-        httpstatus = 400
+    Args:
+        request :   The AsgiRequest.
+        StudyUID :  The Study Instance UID provided in the URL, or None.
 
-    finishedTransactions.append(str(transactionuuid))
-    logging.debug(f"HTTP STATUS : {httpstatus}\r\nMIME-TYPE : {mimetype}\r\nCONTENT-TYPE : {contentType}\r\nPAYLOAD : \r\n{resp}")
-    logging.debug(f"{str(transactionuuid)} removed from active connections list. status {httpstatus} will be returned.")
-    time.sleep(responsedelay)
-    return Response(status = httpstatus  ,response=resp, mimetype=mimetype , content_type=contentType)
+    Returns:
+        The AsgiResponse.
+    """
+    if not admission.Admit():
+        logging.warning(f"STOW-RS request refused, the service is overloaded. Retry-After : {admission.retryAfter}s.")
+        return AsgiResponse(503, headers = { "Retry-After" : str(admission.retryAfter) })
+
+    loop = asyncio.get_running_loop()
+    reader = AsyncMultipartReader(request.headers, request.read, read_size=multipartreadsize)
+    transaction = newTransaction(StudyUID, requestSender(request.header("X-Forwarded-For"), request.client), request.header(priorityheader))
+    logging.debug(f"Receiving STOW-RS connection, assigned to Tran ID :{transaction.transactionuuid}.")
+    async for rFile in reader:
+        if not await admission.WaitForCapacityAsync(transaction):
+            ds = await _SniffAndReleaseAsync(rFile, transaction.RefuseInstance())
+            transaction.InstanceFailed(ds, "A700")
+            continue
+        try:
+            sink = await loop.run_in_executor(ioExecutor, transaction.OpenInstance)
+        except Exception as ex:
+            logging.error(f"Could not store the instance {transaction.fileinstance} :  {ex}")
+            ds = await _SniffAndReleaseAsync(rFile, DicomHeaderSniffer())
+            transaction.InstanceFailed(ds, "A700")
+            continue
+        failureReason = undecodablereason
+        try:
+            async for chunk in rFile.iter_chunks(decode=True):
+                failureReason = sink.failureReason
+                if not await loop.run_in_executor(ioExecutor, sink.write, chunk):
+                    break
+                failureReason = undecodablereason
+        except (ClientDisconnected, RequestBodyTooLarge):
+            await loop.run_in_executor(ioExecutor, sink.abort)
+            raise
+        except Exception as ex:
+            logging.error(f"Could not process the instance {transaction.fileinstance} :  {ex}")
+            await loop.run_in_executor(ioExecutor, sink.abort)
+            ds = await _SniffAndReleaseAsync(rFile, sink.sniffer)
+            transaction.InstanceFailed(ds, failureReason)
+            continue
+        await rFile.release()
+        await loop.run_in_executor(ioExecutor, transaction.InstanceReceived, sink)
+    logging.debug(f"{str(transaction.fileinstance)} files received." )
+
+    if synccommit:
+        for upload , instanceEntry in transaction.committedInstances:
+            if not await asyncio.wrap_future(upload):
+                transaction.CommitFailed(instanceEntry)
+
+    httpstatus , resp , mimetype , contentType = transaction.BuildResponse(request.header('Accept'))
+    finishedTransactions.append(transaction.transactionuuid)
+    if responsedelay > 0 and not await transaction.WaitForUploadsAsync(responsedelay):
+        logging.debug(f"{transaction.transactionuuid} : uploads still running after the response delay.")
+    return AsgiResponse(httpstatus, body=resp, content_type=contentType)
+
+def newTransaction( StudyUID, sender=None, priority=None ):
+    """
+    Args:
+        StudyUID :  The Study Instance UID provided in the URL, or None.
+        sender :    The address of the client, the uploads of its transactions share a flow with UPLOADFAIRNESS=sender.
+        priority :  The value of the priority header of the request, or None.
+    Returns:
+        The StowRsTransaction of the request.
+    """
+    flow = sender if uploadfairness == "sender" else None
+    return StowRsTransaction(StudyUID, S3Sender, tempfolder, WadoURL, diskless=disklessmode, synccommit=synccommit, maxHeaderBuffer=maxheaderbuffersize,
+                             uploadFlow=flow, uploadPriority=parsePriority(priority), duplicateWarning=duplicatewarning)
+
+def requestSender( forwardedFor, remoteAddress ):
+    # The client address is the first one of X-Forwarded-For behind the load balancer and nginx.
+    if forwardedFor:
+        return forwardedFor.split(",")[0].strip()
+    return remoteAddress
+
+def _SniffAndRelease( rFile, sniffer ):
+    """
+    Reads the rest of a body part to the void, looking for the UIDs of the instance on the way.
+
+    Args:
+        rFile :     The BodyPartReader of the instance.
+        sniffer :   The DicomHeaderSniffer which has seen the data already read from rFile.
+
+    Returns:
+        the pydicom dataset object containing the tags "00080016" , "0020000D" , "0020000E" , "00080018", or None.
+    """
+    if not sniffer.done:
+        for chunk in rFile.iter_chunks():
+            if sniffer.feed(chunk):
+                break
+    rFile.release()
+    return sniffer.getDataset()
+
+async def _SniffAndReleaseAsync( rFile, sniffer ):
+    """
+    Same as _SniffAndRelease for the AsyncBodyPartReader.
+    """
+    if not sniffer.done:
+        async for chunk in rFile.iter_chunks():
+            if sniffer.feed(chunk):
+                break
+    await rFile.release()
+    return sniffer.getDataset()
 
 def adapt_dataset_from_bytes(blob):
     """
@@ -158,60 +312,210 @@ def adapt_dataset_from_bytes(blob):
     return dataset
 
 
-def moveFileInDicomTreeDir(currentfilename ,transactionuuid , studyUID , seriesUID, instanceUID):
+def removeLocalFile(obj, success):
     """
-    This methods re-organize the received DICOM files on the filesystem by creating a directory structure and copying all the files of a sames series in different folders.
-    The strucuture is shaped like : ./out/transactionuuid/studyuid/seriesuid/sopinstanceuid.dcm
+    Completion callback of the S3FileManager uploads. Deletes the local copy of the instance once it is in S3.
+    The files which could not be uploaded are kept in the dead letter folder, or in the temp folder when the service stopped
+    before the upload could be retried, unless the S3FileManager drops its failed jobs ( synchronous commit mode ).
     Args:
-        currentfilename :   A string representing the aboslute path to the file location after reception.
-        transactionuuid :   The transaction uid generated at the reception of the HTTP request.
-        studyUID :          The Study Instance UID of the instance. tag [0020000D] value.
-        seriesUID :         The Series Instance UID of the instance. tag [0020000E] value.
-        instanceUID :       The SOP Instance UID of the instance. tag [00080018] value.
+        obj :       The upload job, [ absolute file path , relative S3 path ].
+        success :   True if the file was copied to S3.
+    Returns:
+        None
+    Raises:
+        None
+    """   
+    if not success and S3Sender.keepFailed:
+        logging.warning(f"Instance {obj[0]} kept on the filesystem for a later upload.")
+        admission.Notify()
+        return
+    try:
+        logging.debug(f"Removing instance {obj[0]} from filesystem.")
+        os.remove(obj[0])
+    except Exception as err:
+        logging.error(str(err))
+    admission.Notify()
+
+
+def stopService(signum, frame):
+    """
+    SIGTERM handler. Stops the web service, the upload queue is then drained before the process exits.
+    """
+    logging.info("SIGTERM received, stopping the STOW-RS service.")
+    sys.exit(0)
+
+
+def setMetricsSources():
+    """
+    Binds the gauges of the /metrics endpoint to the S3FileManager statistics and to the temp folder volume.
+    """
+    StowMetrics.uploadQueueDepth.setFunction(lambda: S3Sender.GetStats()["queued"])
+    StowMetrics.uploadQueuedBytes.setFunction(lambda: S3Sender.GetStats()["queued_bytes"])
+    StowMetrics.uploadKeptBytes.setFunction(lambda: S3Sender.GetStats()["kept_bytes"])
+    StowMetrics.uploadsInFlight.setFunction(lambda: S3Sender.GetStats()["inflight"])
+    StowMetrics.uploadConcurrency.setFunction(lambda: S3Sender.GetStats()["concurrency"])
+    StowMetrics.uploadQueueFlows.setFunction(lambda: S3Sender.GetStats()["queued_flows"])
+    StowMetrics.uploadFailures.setFunction(lambda: S3Sender.GetStats()["failed"])
+    StowMetrics.uploadRetries.setFunction(lambda: S3Sender.GetStats()["retries"])
+    StowMetrics.uploadThrottled.setFunction(lambda: S3Sender.GetStats()["throttled"])
+    StowMetrics.uploadDeadLettered.setFunction(lambda: S3Sender.GetStats()["dead_lettered"])
+    StowMetrics.tempFolderUsed.setFunction(lambda: shutil.disk_usage(tempfolder).used)
+    StowMetrics.tempFolderFree.setFunction(lambda: shutil.disk_usage(tempfolder).free)
+
+
+def runWorker(sock, pendingUploads):
+    """
+    Starts the S3 upload pool of the process, and serves the STOW-RS requests until SIGTERM is received.
+    The upload queue is drained before returning.
 
+    Args:
+        sock :              The listening socket shared by the workers of the multi-process mode, or None to listen on port 8080.
+        pendingUploads :    The journal entries this process has to replay, or None to replay the whole journal.
     Returns:
-        newFilePath :       The new absolute file path after the file has been moved.
-        dicomFilePath :     A partial path representing the DICOM Tree to the object
-                            Eg : /studyuid/seriesuid/sopinstanceuid.dcm
+        None
     Raises:
         None
-    """    
-    newlocation = tempfolder+"/"+transactionuuid+"/"+studyUID+"/"+seriesUID+"/"+instanceUID
-    DICOMTreeFolder = "/"+studyUID+"/"+seriesUID+"/"+instanceUID
-    newlocation = os.path.join(tempfolder, transactionuuid ,studyUID , seriesUID )
-    os.makedirs(newlocation, exist_ok=True)
-    os.replace(currentfilename, newlocation+"/"+instanceUID+".dcm")
-    newFilePath = newlocation+"/"+instanceUID+".dcm"
-    dicomFilePath = DICOMTreeFolder+".dcm"
-    return newFilePath , dicomFilePath
-
-def __fileSystemCleaner():
     """
-    This methods is use as code logic for a thread. it monitor which files are marked as sent by the S3FileManager and delete them from the filesystem.
+    global journal, S3Sender, admission, ioExecutor
+    journal = UploadJournal(tempfolder+"upload-journal.db")
+    # In the synchronous commit mode the sender is told about the failed uploads, it sends them again.
+    streamSlots = 0
+    if disklessmode:
+        streamSlots = iothreads if servermode == "asgi" else waitressthreads
+    # The diskless mode streams the instances to S3 before their content is known whole, the duplicates are not looked
+    # for and the instances are not compressed.
+    dedup = None
+    if deduplication in ("index", "head") and not disklessmode:
+        dedup = InstanceDeduplicator(headCheck=deduplication == "head")
+    compressor = None
+    if compression == "deflate" and not disklessmode:
+        compressor = InstanceCompressor()
+    S3Sender = S3FileManager( EdgeId, destinationBucket, onUploaded=removeLocalFile, journal=journal, keepFailed=not synccommit, streamSlots=streamSlots, deadLetter=DeadLetterFolder(deadletterfolder), fair=uploadfairness != "none", dedup=dedup, compressor=compressor)
+    admission = AdmissionController(S3Sender, tempfolder, workers=workers)
+    setMetricsSources()
+    if sock is not None:
+        StowMetrics.registry.shareWith(metricsfolder)
+    S3Sender.ReplayJournal(pendingUploads)
+    signal.signal(signal.SIGTERM, stopService)
+
+    listen = { "host" : "0.0.0.0" , "port" : 8080 } if sock is None else { "sockets" : [sock] }
+    logging.info(f"STOW-RS service started (pid {os.getpid()}).")
+    try:
+        if servermode == "asgi":
+            import uvicorn
+            ioExecutor = ThreadPoolExecutor(max_workers=iothreads, thread_name_prefix="stow-io")
+            logging.info(f"Serving the STOW-RS requests from an asyncio event loop, {iothreads} I/O threads.")
+            server = uvicorn.Server(uvicorn.Config(asgiApp, host="0.0.0.0", port=8080, lifespan="off", log_level="warning"))
+            server.run(sockets=listen.get("sockets"))
+            ioExecutor.shutdown(wait=True)
+        else:
+            serve(app, url_scheme='http', max_request_body_size=4294967296, threads=waitressthreads, **listen)
+    finally:
+        S3Sender.Shutdown(wait=True)
+
+
+def replayDeadLetter():
+    """
+    `python3 main.py replay-deadletter` : sends the instances of the dead letter folder to S3 again, with the S3 configuration
+    of the service. The ones which fail again stay in the folder.
     Args:
         None
+    Returns:
+        True if all the instances were uploaded.
+    Raises:
+        None
+    """
+    deadLetter = DeadLetterFolder(deadletterfolder)
+    senders = {}
+
+    def removeUploaded(obj, success):
+        if success:
+            os.remove(obj[0])
+
+    def sender(bucket):
+        # the manifest holds the whole S3 keys, the prefix is not added again.
+        if bucket not in senders:
+            senders[bucket] = S3FileManager("", bucket, onUploaded=removeUploaded, deadLetter=deadLetter)
+        return senders[bucket]
+
+    try:
+        uploaded , failed = deadLetter.Replay(sender)
+    finally:
+        for s3sender in senders.values():
+            s3sender.Shutdown(wait=True)
+    print(f"{uploaded} instance(s) uploaded, {failed} left in {deadletterfolder}.")
+    return failed == 0
+
+
+def runSupervisor(count):
+    """
+    Multi-process mode : binds port 8080 and forks count workers accepting the connections of the shared socket, each
+    with its own upload pool. The journal entries left by the previous run are split between the workers. A worker which
+    dies is replaced, SIGTERM is forwarded to all the workers and the supervisor exits once they are all stopped.
+
+    Args:
+        count :     The number of workers.
     Returns:
         None
     Raises:
         None
-    """   
-    while(True):
-        try:
-            #Delete files on the filesystem for instance files which should not have been sent within this association.
-            if(len(filesToDelete) > 0 ):
-                fpath = filesToDelete.popleft()
-                logging.debug("Removing instance {obj[0]} from filesystem.")
-                os.remove(fpath)
-
-            #Delete files which were successfully sent. 
-            obj = S3Sender.GetInstanceSent()
-            if obj is not None:
-                logging.debug("Removing instance {obj[0]} from filesystem.")
-                os.remove(obj[0])
-            else:
-                sleep(0.1)
-        except Exception as err:
-            logging.error(str(err))
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(("0.0.0.0", 8080))
+    sock.listen(1024)
+
+    # The journal is read before forking, and no connection to it is inherited by the workers.
+    startupJournal = UploadJournal(tempfolder+"upload-journal.db")
+    pending = startupJournal.Pending()
+    startupJournal.Close()
+    shutil.rmtree(metricsfolder, ignore_errors=True)
+    StowMetrics.registry.folder = metricsfolder     # where forget() finds the samples of the workers.
+
+    children = {}
+    stopping = False
+
+    def spawn(index, pendingUploads):
+        pid = os.fork()
+        if pid == 0:
+            status = 0
+            try:
+                runWorker(sock, pendingUploads)
+            except SystemExit:
+                pass
+            except BaseException:
+                logging.exception(f"Worker {index} failed.")
+                status = 1
+            finally:
+                os._exit(status)
+        children[pid] = index
+
+    def stopWorkers(signum, frame):
+        nonlocal stopping
+        logging.info("SIGTERM received, stopping the workers.")
+        stopping = True
+        for pid in list(children):
+            os.kill(pid, signal.SIGTERM)
+
+    for index in range(count):
+        spawn(index, pending[index::count])
+    signal.signal(signal.SIGTERM, stopWorkers)
+    logging.info(f"Supervisor started {count} workers.")
+
+    while children:
+        pid , status = os.wait()
+        index = children.pop(pid, None)
+        if index is None:
+            continue
+        StowMetrics.registry.forget(pid)
+        if not stopping:
+            # The replacement takes over the uploads the dead worker had not completed.
+            survivorJournal = UploadJournal(tempfolder+"upload-journal.db")
+            orphans = survivorJournal.Pending(owner=pid)
+            survivorJournal.Close()
+            logging.error(f"Worker {index} (pid {pid}) exited with status {status}, starting a new one to upload its {len(orphans)} pending file(s).")
+            spawn(index, orphans)
+    logging.info("All the workers are stopped.")
 
 
 def setLogLevel():
@@ -285,14 +589,69 @@ if __name__ == "__main__":
         print("Response delay : "+str(responsedelay))
     except:
         responsedelay = 0
-        
+
+    try:
+        multipartreadsize = int(os.environ['MULTIPARTREADSIZE'])
+        logging.debug(f"MULTIPARTREADSIZE = {multipartreadsize}")
+    except:
+        multipartreadsize = 1048576 # 0 falls back to the line by line parsing of the multipart body.
+
+    try:
+        disklessmode = os.environ['DISKLESS'].lower() == "true"
+    except:
+        disklessmode = False
+    if disklessmode:
+        logging.info("Diskless mode enabled, the instances are streamed directly to S3.")
+
+    try:
+        synccommit = os.environ['SYNCCOMMIT'].lower() == "true"
+    except:
+        synccommit = False
+    if synccommit:
+        logging.info("Synchronous commit enabled, the response is sent once the instances are stored in S3.")
+
+    try:
+        servermode = os.environ['SERVERMODE'].lower()
+    except:
+        servermode = "waitress" # "asgi" serves the requests from an asyncio event loop with uvicorn.
+    try:
+        iothreads = int(os.environ['IOTHREADS'])
+    except:
+        iothreads = 32 # ASGI mode : threads writing the received chunks to disk or S3.
 
         
-    S3Sender = S3FileManager( EdgeId, destinationBucket)
-    
-    logging.debug("Starting the file cleaner thread.")
-    thread = Thread(target = __fileSystemCleaner)
-    thread.start()
-    
-    logging.info("STOW-RS service started.")
-    serve(app, host="0.0.0.0", port=8080, url_scheme='http', max_request_body_size=4294967296)
+    try:
+        uploadfairness = os.environ['UPLOADFAIRNESS'].lower()
+    except:
+        uploadfairness = "transaction"
+    try:
+        priorityheader = os.environ['PRIORITYHEADER']
+    except:
+        priorityheader = "X-Upload-Priority"
+
+    try:
+        deduplication = os.environ['DEDUP'].lower()
+    except:
+        deduplication = "none"
+    try:
+        duplicatewarning = int(os.environ['DUPLICATEWARNING'], 16) # eg. B000, hexadecimal as the DICOM status codes.
+    except:
+        duplicatewarning = None
+    try:
+        compression = os.environ['COMPRESSION'].lower()
+    except:
+        compression = "none"
+
+    try:
+        workers = int(os.environ['WORKERS'])
+    except:
+        workers = 1 # more than 1 forks the workers sharing the listening socket, to use more than one CPU.
+                    # QUEUEDBYTESHIGH / QUEUEDBYTESLOW stay the limits of the whole container, they are split between the workers.
+
+    os.makedirs(tempfolder, exist_ok=True)
+    if len(sys.argv) > 1 and sys.argv[1] == "replay-deadletter":
+        sys.exit(0 if replayDeadLetter() else 1)
+    if workers > 1:
+        runSupervisor(workers)
+    else:
+        runWorker(None, None)
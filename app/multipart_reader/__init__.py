@@ -1 +1,2 @@
 from .multipart import MultipartReader  # noqa
+from .aio import AsyncMultipartReader  # noqa
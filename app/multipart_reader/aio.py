@@ -0,0 +1,186 @@
+"""Asynchronous flavour of the multipart reader, for the asyncio servers.
+
+The parsing rules are the ones of :mod:`.multipart`, only the reads from
+the underlying :class:`.streams.AsyncStreamReader` are awaited.
+"""
+
+from .multipart import (BodyPartReader, MultipartReader,
+                        _delimiter_line, _ends_boundary_line)
+from .headers import parse_part_headers
+from .streams import AsyncStreamReader
+
+
+__all__ = ('AsyncMultipartReader', 'AsyncBodyPartReader')
+
+
+class AsyncBodyPartReader(BodyPartReader):
+    """Multipart reader for single body part, read from an
+    :class:`.streams.AsyncStreamReader`."""
+
+    async def read(self, decode=False):
+        """Reads body part data.
+
+        :rtype: bytearray
+        """
+        if self._at_eof:
+            return
+        data = bytearray()
+        async for chunk in self.iter_chunks(decode=decode):
+            data.extend(chunk)
+        return data
+
+    async def iter_chunks(self, decode=False):
+        """Iterates over the body part data without ever holding more than
+        one chunk in memory.
+
+        :param bool decode: Decodes the chunks, see
+                            :meth:`.BodyPartReader.iter_chunks`.
+
+        :rtype: async generator of bytes
+        """
+        decoder = self.decoder() if decode else None
+        if decoder is not None and decoder.identity:
+            decoder = None
+        while not self._at_eof:
+            chunk = await self.read_chunk(self._read_size())
+            if not chunk:
+                continue
+            if decoder is None:
+                yield chunk
+            else:
+                for piece in decoder.decode(chunk):
+                    yield piece
+        if decoder is not None:
+            for piece in decoder.flush():
+                yield piece
+
+    async def read_chunk(self, size=BodyPartReader.chunk_size):
+        """Reads body part content chunk of the specified size.
+
+        :param int size: chunk size
+
+        :rtype: bytearray
+        """
+        if self._at_eof:
+            return
+        if self._length is None:
+            return await self._read_chunk_from_stream(size)
+        chunk_size = min(size, self._length - self._read_bytes)
+        chunk = await self._content.read(chunk_size)
+        self._read_bytes += len(chunk)
+        if self._read_bytes == self._length:
+            self._at_eof = True
+            assert b'\r\n' == await self._content.readline(), \
+                'reader did not read all the data or it is malformed'
+        return chunk
+
+    async def _read_chunk_from_stream(self, size):
+        chunk, found = await self._content.read_until(self._delimiter, size)
+        if found and not await self._delimiter_ends_line():
+            chunk += await self._content.read(len(self._delimiter))
+            found = False
+        self._read_bytes += len(chunk)
+        if found:
+            self._at_eof = True
+            await self._content.read(2)
+            self._unread.append(await self._content.readline())
+        return chunk
+
+    async def _delimiter_ends_line(self):
+        end = len(self._delimiter)
+        size = end + 4
+        while True:
+            rest = _delimiter_line(await self._content.peek(size), end, size)
+            if rest is not None:
+                return _ends_boundary_line(rest)
+            size *= 2
+
+    async def release(self):
+        """Lke :meth:`read`, but reads all the data to the void.
+
+        :rtype: None
+        """
+        while not self._at_eof:
+            await self.read_chunk(self._read_size())
+
+
+class AsyncMultipartReader(MultipartReader):
+    """Multipart body reader for asynchronous sources.
+
+    `read` is a coroutine function returning the next block of the body,
+    or ``b''`` once it is complete. The body parts are always delimited by
+    scanning the blocks for the boundary, `read_size` defaults to 1MB.
+    """
+
+    part_reader_cls = AsyncBodyPartReader
+
+    def __init__(self, headers, read, read_size=None):
+        content = read
+        if not isinstance(content, AsyncStreamReader):
+            content = AsyncStreamReader(read, read_size or 1048576)
+        super(AsyncMultipartReader, self).__init__(headers, content)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        part = await self.next()
+        if part is None:
+            raise StopAsyncIteration()
+        return part
+
+    async def next(self):
+        """Emits the next multipart body part, or ``None`` after the final
+        boundary."""
+        if self._at_eof:
+            return None
+        await self._maybe_release_last_part()
+        await self._read_boundary()
+        if self._at_eof:
+            return None
+        self._last_part = self._get_part_reader(await self._read_headers())
+        return self._last_part
+
+    async def release(self):
+        """Reads all the body parts to the void till the final boundary."""
+        async for part in self:
+            await part.release()
+
+    def _get_part_reader(self, headers):
+        # nested multipart bodies are not expected in a STOW-RS request,
+        # every part is read as a single body part.
+        return self.part_reader_cls(self._boundary, headers, self._content)
+
+    async def _readline(self):
+        if self._firstLine:
+            # the body may start with an empty line before the first boundary.
+            self._firstLine = False
+            line = await self._content.readline()
+            if line == b'\r\n':
+                line = await self._content.readline()
+            return line
+        if self._unread:
+            return self._unread.pop()
+        # parts with a Content-Length leave the boundary in the stream.
+        return await self._content.readline()
+
+    async def _read_boundary(self):
+        chunk = (await self._readline()).rstrip()
+        if chunk == self._boundary:
+            pass
+        elif chunk == self._boundary + b'--':
+            self._at_eof = True
+        else:
+            raise ValueError('Invalid boundary %r, expected %r'
+                             % (chunk, self._boundary))
+
+    async def _read_headers(self):
+        return parse_part_headers((await self._content.read_headers()).split(b'\n'))
+
+    async def _maybe_release_last_part(self):
+        """Ensures that the last read body part is read completely."""
+        if self._last_part is not None:
+            if not self._last_part.at_eof():
+                await self._last_part.release()
+            self._unread.extend(self._last_part._unread)
+            self._last_part = None
@@ -0,0 +1,150 @@
+"""Incremental decoders of the body part encodings.
+
+A :class:`PartDecoder` decodes a body part chunk by chunk, so a compressed
+or base64 encoded part never has to be held in memory, encoded or decoded.
+"""
+
+import binascii
+import zlib
+
+from . import hdrs
+
+
+__all__ = ('PartDecoder',)
+
+_BASE64_ALPHABET = (b'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+                    b'0123456789+/=')
+# base64.b64decode discards the characters outside of the alphabet.
+_BASE64_IGNORED = bytes(set(range(256)) - set(_BASE64_ALPHABET))
+
+# Content-Transfer-Encoding values which leave the data untouched.
+_IDENTITY_TRANSFER_ENCODINGS = ('binary', '7bit', '8bit', 'identity')
+
+
+class _Base64Decoder(object):
+
+    def __init__(self):
+        self._pending = b''
+
+    def decode(self, data):
+        data = self._pending + bytes(data).translate(None, _BASE64_IGNORED)
+        end = len(data) - len(data) % 4
+        self._pending = data[end:]
+        if end:
+            yield binascii.a2b_base64(data[:end])
+
+    def flush(self):
+        if self._pending:
+            # raises binascii.Error, like b64decode on the whole data.
+            yield binascii.a2b_base64(self._pending)
+
+
+class _QuotedPrintableDecoder(object):
+
+    def __init__(self):
+        self._pending = b''
+
+    def decode(self, data):
+        # only complete lines are decoded, a soft line break or an escape
+        # sequence may be split across two chunks.
+        data = self._pending + bytes(data)
+        end = data.rfind(b'\n') + 1
+        self._pending = data[end:]
+        if end:
+            yield binascii.a2b_qp(data[:end])
+
+    def flush(self):
+        if self._pending:
+            yield binascii.a2b_qp(self._pending)
+
+
+class _ZlibDecoder(object):
+
+    def __init__(self, wbits, max_length):
+        self._decompressor = zlib.decompressobj(wbits)
+        self._max_length = max_length
+
+    def decode(self, data):
+        # the output of each call is bounded, a small chunk of a highly
+        # compressed part does not expand in memory at once.
+        while True:
+            out = self._decompressor.decompress(data, self._max_length)
+            data = self._decompressor.unconsumed_tail
+            if out:
+                yield out
+            if not data and len(out) < self._max_length:
+                break
+
+    def flush(self):
+        out = self._decompressor.flush()
+        if out:
+            yield out
+        if not self._decompressor.eof:
+            raise zlib.error('Error -5 while decompressing data: '
+                             'incomplete or truncated stream')
+
+
+class PartDecoder(object):
+    """Decodes a body part according to its `Content-Transfer-Encoding`
+    and `Content-Encoding` headers, in this order.
+
+    Supports ``base64``, ``quoted-printable`` and the identity encodings
+    for `Content-Transfer-Encoding`, ``gzip``, ``deflate`` and
+    ``identity`` for `Content-Encoding`.
+
+    :param headers: the headers of the body part
+    :param int max_length: the largest piece a decompressor emits at once
+
+    :raises: :exc:`RuntimeError` - if an encoding is unknown.
+    """
+
+    def __init__(self, headers, max_length=1048576):
+        self._stages = []
+        encoding = headers.get(hdrs.CONTENT_TRANSFER_ENCODING, '').lower()
+        if encoding == 'base64':
+            self._stages.append(_Base64Decoder())
+        elif encoding == 'quoted-printable':
+            self._stages.append(_QuotedPrintableDecoder())
+        elif encoding and encoding not in _IDENTITY_TRANSFER_ENCODINGS:
+            raise RuntimeError('unknown content transfer encoding: {}'
+                               ''.format(encoding))
+        encoding = headers.get(hdrs.CONTENT_ENCODING, '').lower()
+        if encoding == 'deflate':
+            self._stages.append(_ZlibDecoder(-zlib.MAX_WBITS, max_length))
+        elif encoding == 'gzip':
+            self._stages.append(_ZlibDecoder(16 + zlib.MAX_WBITS, max_length))
+        elif encoding and encoding != 'identity':
+            raise RuntimeError('unknown content encoding: {}'.format(encoding))
+
+    @property
+    def identity(self):
+        """``True`` if the data is passed through unchanged."""
+        return not self._stages
+
+    def decode(self, chunk):
+        """Decodes the next chunk of the body part.
+
+        :rtype: generator of bytes
+        """
+        return self._feed(0, chunk)
+
+    def flush(self):
+        """Decodes what is left once the whole body part was passed to
+        :meth:`decode`.
+
+        :raises: :exc:`binascii.Error` or :exc:`zlib.error` if the data
+                 is truncated.
+
+        :rtype: generator of bytes
+        """
+        for index, stage in enumerate(self._stages):
+            for piece in stage.flush():
+                yield from self._feed(index + 1, piece)
+
+    def _feed(self, index, data):
+        if index == len(self._stages):
+            if data:
+                yield data
+            return
+        for piece in self._stages[index].decode(data):
+            yield from self._feed(index + 1, piece)
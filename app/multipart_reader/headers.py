@@ -0,0 +1,136 @@
+"""Fast parser of the body part headers.
+
+A STOW-RS request may hold thousands of small instances, all sent with the
+same few header lines. The lines are parsed as bytes and the parsed header
+of each distinct line is cached, so is the parsed ``Content-Type`` value.
+"""
+
+import functools
+import re
+from types import MappingProxyType
+
+from . import errors
+
+from .helpers import parse_mimetype
+
+
+__all__ = ('PartHeaders', 'parse_part_headers', 'parse_content_type')
+
+HDRRE = re.compile(b'[\x00-\x1F\x7F()<>@,;:\\[\\]={} \t\\\\"]')
+MAX_FIELD_SIZE = 8190
+# the parsed lines, the cache is emptied when it is full.
+_CACHE_SIZE = 256
+_line_cache = {}
+
+
+class PartHeaders(object):
+    """Read-only case-insensitive mapping of the headers of a body part.
+
+    The names are stored upper-cased, like in a :class:`.CIMultiDict`, and
+    the first value of each name is indexed in a dict.
+    """
+
+    __slots__ = ('_items', '_first')
+
+    def __init__(self, items=()):
+        self._items = list(items)
+        self._first = {}
+        for name, value in self._items:
+            self._first.setdefault(name, value)
+
+    def getall(self, key, default=None):
+        """Return a list of all values matching the key."""
+        key = key.upper()
+        res = [v for k, v in self._items if k == key]
+        if res:
+            return res
+        if default is not None:
+            return default
+        raise KeyError('Key not found: %r' % key)
+
+    def get(self, key, default=None):
+        """Get first value matching the key."""
+        return self._first.get(key.upper(), default)
+
+    getone = get
+
+    def __getitem__(self, key):
+        return self._first[key.upper()]
+
+    def __contains__(self, key):
+        return key.upper() in self._first
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self._items)
+
+    def keys(self):
+        return [k for k, v in self._items]
+
+    def items(self):
+        return list(self._items)
+
+    def values(self):
+        return [v for k, v in self._items]
+
+    def __eq__(self, other):
+        if isinstance(other, dict):
+            return all(other.get(k.upper(), other.get(k)) == v
+                       for k, v in self._items)
+        if hasattr(other, 'items'):
+            # another PartHeaders or a CIMultiDict, both upper-case the names.
+            return sorted(self._items) == sorted(other.items())
+        return NotImplemented
+
+    def __repr__(self):
+        body = ', '.join("'{}': {!r}".format(k, v) for k, v in self._items)
+        return '<PartHeaders({})>'.format(body)
+
+
+def _parse_line(line):
+    if len(line) > MAX_FIELD_SIZE:
+        raise errors.LineTooLong('a part header', MAX_FIELD_SIZE)
+    if b':' not in line:
+        raise errors.InvalidHeader(line.decode(errors='replace'))
+    name, value = line.split(b':', 1)
+    name = name.strip(b' \t').upper()
+    if HDRRE.search(name):
+        raise errors.InvalidHeader(name.decode(errors='replace'))
+    return name.decode(), value.strip().decode()
+
+
+def parse_part_headers(lines):
+    """Parses the header lines of a body part, up to the first empty line.
+
+    :param lines: the raw lines, as bytes, with or without their line end
+
+    :raises: :exc:`.errors.InvalidHeader` - if a line is not a header.
+
+    :rtype: :class:`PartHeaders`
+    """
+    items = []
+    for line in lines:
+        header = _line_cache.get(line)
+        if header is None:
+            stripped = line.strip()
+            if not stripped:
+                break
+            header = _parse_line(stripped)
+            if len(_line_cache) >= _CACHE_SIZE:
+                _line_cache.clear()
+            _line_cache[line] = header
+        items.append(header)
+    return PartHeaders(items)
+
+
+@functools.lru_cache(maxsize=_CACHE_SIZE)
+def parse_content_type(value):
+    """Cached :func:`.helpers.parse_mimetype`, the parameters are returned
+    as a read-only mapping since they are shared.
+
+    :rtype: tuple
+    """
+    mtype, stype, suffix, params = parse_mimetype(value)
+    return mtype, stype, suffix, MappingProxyType(params)
@@ -1,17 +1,16 @@
-import binascii
-import base64
 import json
 import re
 import warnings
-import zlib
 
 from collections import deque
 
 from . import hdrs
 
+from .decoders import PartDecoder
+from .headers import parse_content_type, parse_part_headers
 from .helpers import parse_mimetype
 from .multidict import CIMultiDict
-from .protocol import HttpParser
+from .streams import StreamReader
 from .compat import parse_qsl, unquote
 
 
@@ -157,6 +156,25 @@ def content_disposition_filename(params):
         return value
 
 
+def _ends_boundary_line(rest):
+    """Tells whether `rest`, what follows a boundary up to the end of its
+    line, makes it a boundary line: nothing or ``--``, then the line end."""
+    return rest.rstrip(b'\r\n') in (b'', b'--')
+
+
+def _delimiter_line(peeked, end, size):
+    """Returns the rest of the line following the delimiter which starts the
+    `size` bytes peeked, or None when more bytes must be peeked to know it."""
+    rest = peeked[end:]
+    newline = rest.find(b'\n')
+    if newline >= 0:
+        return rest[:newline + 1]
+    if len(peeked) < size or rest.strip(b'-\r'):
+        # the end of the stream, or bytes which already rule out a boundary.
+        return rest
+    return None
+
+
 class BodyPartReader(object):
     """Multipart reader for single body part."""
 
@@ -171,7 +189,10 @@ class BodyPartReader(object):
         self._length = int(length) if length is not None else None
         self._read_bytes = 0
         self._unread = deque()
-
+        # In chunked mode the part end is found by scanning for the
+        # delimiter instead of reading the body line by line.
+        self._chunked = isinstance(content, StreamReader)
+        self._delimiter = b'\r\n' + boundary
 
     def __iter__(self):
         return self
@@ -193,28 +214,70 @@ class BodyPartReader(object):
 
         :param bool decode: Decodes data following by encoding
                             method from `Content-Encoding` header. If it missed
-                            data remains untouched
+                            data remains untouched. The data is decoded
+                            chunk by chunk as it is read.
 
         :rtype: bytearray
         """
         if self._at_eof:
             return
         data = bytearray()
-        if self._length is None:
-            while not self._at_eof:
-                data.extend(self.readline())
-        else:
-            while not self._at_eof:
-                data.extend(self.read_chunk(self.chunk_size))
-        if decode:
-            return self.decode(data)
-        
-        self._firstLine = False
+        for chunk in self.iter_chunks(decode=decode):
+            data.extend(chunk)
         return data
 
+    def iter_chunks(self, decode=False):
+        """Iterates over the body part data without ever holding more than
+        one chunk in memory.
+
+        :param bool decode: Decodes the chunks following the
+                            `Content-Transfer-Encoding` and
+                            `Content-Encoding` headers, see :meth:`decoder`.
+
+        :rtype: generator of bytes
+        """
+        decoder = self.decoder() if decode else None
+        if decoder is not None and decoder.identity:
+            decoder = None
+        while not self._at_eof:
+            if self._length is None and not self._chunked:
+                chunk = self.readline()
+            else:
+                chunk = self.read_chunk(self._read_size())
+            if not chunk:
+                continue
+            if decoder is None:
+                yield chunk
+            else:
+                yield from decoder.decode(chunk)
+        if decoder is not None:
+            yield from decoder.flush()
+
+    def read_into(self, fileobj, decode=False):
+        """Like :meth:`read`, but writes the data to `fileobj` chunk by
+        chunk as it arrives instead of returning it.
+
+        :param fileobj: any object with a ``write`` method
+        :param bool decode: Decodes the data, see :meth:`iter_chunks`.
+
+        :returns: the number of bytes written
+        :rtype: int
+        """
+        written = 0
+        for chunk in self.iter_chunks(decode=decode):
+            fileobj.write(chunk)
+            written += len(chunk)
+        return written
+
+    def _read_size(self):
+        if self._chunked:
+            return self._content.read_size
+        return self.chunk_size
+
     def read_chunk(self, size=chunk_size):
         """Reads body part content chunk of the specified size.
-        The body part must has `Content-Length` header with proper value.
+        The body part must has `Content-Length` header with proper value,
+        unless the reader works in chunked mode.
 
         :param int size: chunk size
 
@@ -222,6 +285,8 @@ class BodyPartReader(object):
         """
         if self._at_eof:
             return
+        if self._length is None and self._chunked:
+            return self._read_chunk_from_stream(size)
         assert self._length is not None, \
             'Content-Length required for chunked read'
         chunk_size = min(size, self._length - self._read_bytes)
@@ -233,6 +298,31 @@ class BodyPartReader(object):
                 'reader did not read all the data or it is malformed'
         return chunk
 
+    def _read_chunk_from_stream(self, size):
+        chunk, found = self._content.read_until(self._delimiter, size)
+        if found and not self._delimiter_ends_line():
+            # body data which happens to look like the delimiter.
+            chunk += self._content.read(len(self._delimiter))
+            found = False
+        self._read_bytes += len(chunk)
+        if found:
+            self._at_eof = True
+            # drop the CRLF preceding the boundary and leave the boundary
+            # line to the multipart reader, like the line mode does.
+            self._content.read(2)
+            self._unread.append(self._content.readline())
+        return chunk
+
+    def _delimiter_ends_line(self):
+        # the rule of _is_boundary, applied to the line after the delimiter.
+        end = len(self._delimiter)
+        size = end + 4
+        while True:
+            rest = _delimiter_line(self._content.peek(size), end, size)
+            if rest is not None:
+                return _ends_boundary_line(rest)
+            size *= 2
+
     def readline(self):
         """Reads body part by line by line.
 
@@ -246,25 +336,27 @@ class BodyPartReader(object):
         else:
             line = self._content.readline()
 
-        if line.startswith(self._boundary):
-            # the very last boundary may not come with \r\n,
-            # so set single rules for everyone
-            sline = line.rstrip(b'\r\n')
-            boundary = self._boundary
-            last_boundary = self._boundary + b'--'
-            # ensure that we read exactly the boundary, not something alike
-            if sline == boundary or sline == last_boundary:
-                self._at_eof = True
-                self._unread.append(line)
-                return ''
-        else:
-            next_line = self._content.readline()
-            if next_line.startswith(self._boundary):
-                line = line.rstrip(b'\r\n')  # strip CRLF but only once
-            self._unread.append(next_line)
+        if self._is_boundary(line):
+            self._at_eof = True
+            self._unread.append(line)
+            return ''
+        next_line = self._content.readline()
+        if self._is_boundary(next_line):
+            # strip the line end preceding the boundary, but only once
+            if line.endswith(b'\r\n'):
+                line = line[:-2]
+            elif line.endswith(b'\n'):
+                line = line[:-1]
+        self._unread.append(next_line)
 
         return line
 
+    def _is_boundary(self, line):
+        # the very last boundary may not come with \r\n,
+        # so set single rules for everyone
+        return (line.startswith(self._boundary) and
+                _ends_boundary_line(line[len(self._boundary):]))
+
     def release(self):
         """Lke :meth:`read`, but reads all the data to the void.
 
@@ -272,7 +364,7 @@ class BodyPartReader(object):
         """
         if self._at_eof:
             return
-        if self._length is None:
+        if self._length is None and not self._chunked:
             while not self._at_eof:
                 self.readline()
         else:
@@ -324,6 +416,16 @@ class BodyPartReader(object):
         """
         return self._at_eof
 
+    def decoder(self):
+        """Returns an incremental decoder for the `Content-Transfer-Encoding`
+        and `Content-Encoding` headers of the body part.
+
+        :raises: :exc:`RuntimeError` - if encoding is unknown.
+
+        :rtype: :class:`.decoders.PartDecoder`
+        """
+        return PartDecoder(self.headers, self._read_size())
+
     def decode(self, data):
         """Decodes data according the specified `Content-Encoding`
         or `Content-Transfer-Encoding` headers value.
@@ -332,7 +434,8 @@ class BodyPartReader(object):
         `Content-Encoding` header.
 
         Supports ``base64``, ``quoted-printable`` encodings for
-        `Content-Transfer-Encoding` header.
+        `Content-Transfer-Encoding` header, ``binary``, ``7bit`` and
+        ``8bit`` leave the data untouched.
 
         :param bytearray data: Data to decode.
 
@@ -340,40 +443,16 @@ class BodyPartReader(object):
 
         :rtype: bytes
         """
-        if hdrs.CONTENT_TRANSFER_ENCODING in self.headers:
-            data = self._decode_content_transfer(data)
-        if hdrs.CONTENT_ENCODING in self.headers:
-            return self._decode_content(data)
-        return data
-
-    def _decode_content(self, data):
-        encoding = self.headers[hdrs.CONTENT_ENCODING].lower()
-
-        if encoding == 'deflate':
-            return zlib.decompress(bytes(data), -zlib.MAX_WBITS)
-        elif encoding == 'gzip':
-            return zlib.decompress(bytes(data), 16 + zlib.MAX_WBITS)
-        elif encoding == 'identity':
+        decoder = self.decoder()
+        if decoder.identity:
             return data
-        else:
-            raise RuntimeError('unknown content encoding: {}'.format(encoding))
-
-    def _decode_content_transfer(self, data):
-        encoding = self.headers[hdrs.CONTENT_TRANSFER_ENCODING].lower()
-
-        if encoding == 'base64':
-            return base64.b64decode(data)
-        elif encoding == 'quoted-printable':
-            return binascii.a2b_qp(data)
-        else:
-            raise RuntimeError('unknown content transfer encoding: {}'
-                               ''.format(encoding))
+        return b''.join(list(decoder.decode(data)) + list(decoder.flush()))
 
     def get_charset(self, default=None):
         """Returns charset parameter from ``Content-Type`` header or default.
         """
         ctype = self.headers.get(hdrs.CONTENT_TYPE, '')
-        _, _, _, params = parse_mimetype(ctype)
+        _, _, _, params = parse_content_type(ctype)
         return params.get('charset', default)
 
     @property
@@ -386,7 +465,13 @@ class BodyPartReader(object):
 
 
 class MultipartReader(object):
-    """Multipart body reader."""
+    """Multipart body reader.
+
+    When `read_size` is provided the content is read in blocks of that size
+    and the body parts without `Content-Length` are delimited by scanning
+    the blocks for the boundary (chunked mode). Otherwise the parts are read
+    line by line.
+    """
 
     #: Multipart reader class, used to handle multipart/* body parts.
     #: None points to type(self)
@@ -394,9 +479,11 @@ class MultipartReader(object):
     #: Body part reader class for non multipart/* content types.
     part_reader_cls = BodyPartReader
 
-    def __init__(self, headers, content):
+    def __init__(self, headers, content, read_size=None):
         self.headers = CIMultiDict(headers)
         self._boundary = ('--' + self._get_boundary()).encode()
+        if read_size and not isinstance(content, StreamReader):
+            content = StreamReader(content, read_size)
         self._content = content
         self._last_part = None
         self._at_eof = False
@@ -446,7 +533,7 @@ class MultipartReader(object):
         :param dict headers: Response headers
         """
         ctype = headers.get(hdrs.CONTENT_TYPE, '')
-        mtype, _, _, _ = parse_mimetype(ctype)
+        mtype, _, _, _ = parse_content_type(ctype)
         if mtype == 'multipart':
             if self.multipart_reader_cls is None:
                 return type(self)(headers, self._content)
@@ -471,15 +558,17 @@ class MultipartReader(object):
         return boundary
 
     def _readline(self):
-        if self._firstLine == True:
+        if self._firstLine:
+            # the body may start with an empty line before the first boundary.
+            self._firstLine = False
             line = self._content.readline()
             if line == b'\r\n':
-                line = self._content.readline() 
-            self._firstLine = False   
+                line = self._content.readline()
+            return line
         if self._unread:
             return self._unread.pop()
-        #return self._content.readline()
-        return line
+        # parts with a Content-Length leave the boundary in the stream.
+        return self._content.readline()
 
     def _read_boundary(self):
         chunk = self._readline().rstrip()
@@ -492,16 +581,15 @@ class MultipartReader(object):
                              % (chunk, self._boundary))
 
     def _read_headers(self):
-        lines = ['']
+        if isinstance(self._content, StreamReader):
+            return parse_part_headers(self._content.read_headers().split(b'\n'))
+        lines = []
         while True:
-            chunk = self._content.readline()
-            chunk = chunk.decode().strip()
-            lines.append(chunk)
-            if not chunk:
+            line = self._content.readline()
+            lines.append(line)
+            if not line.strip():
                 break
-        parser = HttpParser()
-        headers, _, _ = parser.parse_headers(lines)
-        return headers
+        return parse_part_headers(lines)
 
     def _maybe_release_last_part(self):
         """Ensures that the last read body part is read completely."""
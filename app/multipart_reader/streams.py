@@ -0,0 +1,245 @@
+"""Buffered streams used by the chunked multipart parser mode."""
+
+from . import errors
+
+
+__all__ = ('StreamReader', 'AsyncStreamReader')
+
+
+class StreamReader(object):
+    """Wraps a blocking file-like object (eg. a WSGI input stream) and reads
+    it in large blocks.
+
+    Besides the usual ``read`` and ``readline`` methods it can scan the
+    buffered data for a delimiter, keeping the bytes which could be the
+    beginning of a delimiter split across two blocks.
+
+    The ``_try_*`` methods work on the buffered data only and return
+    ``None`` when more data is needed, the public methods fill the buffer
+    until they can answer.
+    """
+
+    def __init__(self, stream, read_size=1048576):
+        self._stream = stream
+        self.read_size = read_size
+        self._buffer = bytearray()
+        self._eof = False
+        # number of bytes at the start of the buffer known to be free of
+        # the delimiter last searched for by read_until()
+        self._clean = 0
+        self._clean_for = None
+        # same for the line feed searched for by readline()
+        self._line_scan = 0
+
+    def at_eof(self):
+        """Returns ``True`` if the wrapped stream is exhausted and nothing
+        is left in the buffer.
+
+        :rtype: bool
+        """
+        return self._eof and not self._buffer
+
+    def _feed_data(self, data):
+        if not data:
+            self._eof = True
+            return False
+        self._buffer.extend(data)
+        return True
+
+    def _fill(self):
+        if self._eof:
+            return False
+        return self._feed_data(self._stream.read(self.read_size))
+
+    def _consume(self, size):
+        if size <= 4096:
+            # lines and headers, a memoryview costs more than a small copy.
+            data = bytes(self._buffer[:size])
+        else:
+            # slicing the bytearray itself would copy the data twice.
+            with memoryview(self._buffer) as view:
+                data = bytes(view[:size])
+        del self._buffer[:size]
+        self._clean = max(self._clean - len(data), 0)
+        self._line_scan = 0
+        return data
+
+    def _try_read(self, size):
+        if size < 0:
+            return self._consume(len(self._buffer)) if self._eof else None
+        if len(self._buffer) >= size or self._eof:
+            return self._consume(size)
+        return None
+
+    def _try_peek(self, size):
+        if len(self._buffer) >= size or self._eof:
+            return bytes(self._buffer[:size])
+        return None
+
+    def _try_readline(self):
+        pos = self._buffer.find(b'\n', self._line_scan)
+        if pos != -1:
+            return self._consume(pos + 1)
+        if self._eof:
+            return self._consume(len(self._buffer))
+        self._line_scan = len(self._buffer)
+        return None
+
+    def _try_read_headers(self, max_size):
+        # the lines up to the first empty one are consumed at once.
+        buffer = self._buffer
+        start = 0
+        while True:
+            pos = buffer.find(b'\n', start)
+            if pos == -1:
+                break
+            if pos == start or (pos == start + 1 and buffer[start] == 13):
+                return self._consume(pos + 1)
+            start = pos + 1
+        if len(buffer) > max_size:
+            raise errors.LineTooLong('part headers', max_size)
+        if self._eof:
+            return self._consume(len(buffer))
+        return None
+
+    def _try_read_until(self, delimiter, size):
+        if self._clean_for != delimiter:
+            self._clean, self._clean_for = 0, delimiter
+        if self._clean >= size:
+            return self._consume(size), False
+        pos = self._buffer.find(delimiter, self._clean)
+        if pos != -1:
+            if pos > size:
+                return self._consume(size), False
+            return self._consume(pos), True
+        # Everything but the last len(delimiter)-1 bytes can't be part
+        # of a delimiter, hand it out once there is enough of it.
+        safe = len(self._buffer) - (len(delimiter) - 1)
+        self._clean = max(safe, 0)
+        if safe >= size:
+            return self._consume(size), False
+        if self._eof:
+            if safe > 0:
+                return self._consume(safe), False
+            raise ValueError('stream ended before delimiter %r' % delimiter)
+        return None
+
+    def read(self, size=-1):
+        """Reads up to `size` bytes, or everything left if `size` is negative.
+
+        :rtype: bytes
+        """
+        while True:
+            data = self._try_read(size)
+            if data is not None:
+                return data
+            self._fill()
+
+    def peek(self, size):
+        """Returns up to `size` bytes without consuming them.
+
+        :rtype: bytes
+        """
+        while True:
+            data = self._try_peek(size)
+            if data is not None:
+                return data
+            self._fill()
+
+    def readline(self):
+        """Reads one line, including the trailing ``\\n`` if any.
+
+        :rtype: bytes
+        """
+        while True:
+            line = self._try_readline()
+            if line is not None:
+                return line
+            self._fill()
+
+    def read_headers(self, max_size=65536):
+        """Reads the header lines of a body part, up to and including the
+        empty line ending them.
+
+        :raises: :exc:`.errors.LineTooLong` - if the headers are larger
+                 than `max_size`.
+
+        :rtype: bytes
+        """
+        while True:
+            block = self._try_read_headers(max_size)
+            if block is not None:
+                return block
+            self._fill()
+
+    def read_until(self, delimiter, size):
+        """Reads up to `size` bytes located before `delimiter`. The delimiter
+        itself is left in the buffer.
+
+        :param bytes delimiter: the byte sequence to stop at
+        :param int size: maximum number of bytes to return
+
+        :raises: :exc:`ValueError` - if the stream ends before the delimiter.
+
+        :returns: tuple of the data and a flag telling if the delimiter
+                  was reached
+        :rtype: tuple
+        """
+        while True:
+            result = self._try_read_until(delimiter, size)
+            if result is not None:
+                return result
+            self._fill()
+
+
+class AsyncStreamReader(StreamReader):
+    """Same as :class:`StreamReader` for asynchronous sources.
+
+    `read` is a coroutine function returning the next block of data
+    received, or ``b''`` at the end of the stream (eg. the body messages
+    of an ASGI request).
+    """
+
+    def __init__(self, read, read_size=1048576):
+        super(AsyncStreamReader, self).__init__(None, read_size)
+        self._read = read
+
+    async def _fill(self):
+        if self._eof:
+            return False
+        return self._feed_data(await self._read())
+
+    async def read(self, size=-1):
+        while True:
+            data = self._try_read(size)
+            if data is not None:
+                return data
+            await self._fill()
+
+    async def peek(self, size):
+        while True:
+            data = self._try_peek(size)
+            if data is not None:
+                return data
+            await self._fill()
+
+    async def readline(self):
+        while True:
+            line = self._try_readline()
+            if line is not None:
+                return line
+            await self._fill()
+
+    async def read_headers(self, max_size=65536):
+        while True:
+            block = self._try_read_headers(max_size)
+            if block is not None:
+                return block
+            await self._fill()
+
+    async def read_until(self, delimiter, size):
+        while True:
+            result = self._try_read_until(delimiter, size)
+            if result is not None:
+                return result
+            await self._fill()
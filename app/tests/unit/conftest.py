@@ -0,0 +1,90 @@
+import hashlib
+import os
+import threading
+
+import pytest
+from botocore.exceptions import ClientError
+
+from S3FileManager import S3FileManager
+
+
+class FakeBucket:
+    def __init__(self, s3):
+        self.s3 = s3
+
+    def upload_file(self, filename, key, ExtraArgs=None, Config=None):
+        self.s3.gate.wait()
+        if self.s3.fail:
+            raise ConnectionError("S3 is down")
+        if self.s3.errors:
+            raise self.s3.errors.pop(0)
+        with open(filename, "rb") as uploaded:
+            content = uploaded.read()
+        self.s3.uploads[key] = content
+        self.s3.extraArgs[key] = ExtraArgs
+        self.s3.etags[key] = '"%s"' % hashlib.md5(content).hexdigest()
+        self.s3.order.append(key)
+
+
+class FakeClient:
+    def __init__(self, s3):
+        self.s3 = s3
+
+    def head_object(self, Bucket, Key):
+        self.s3.heads += 1
+        if Key not in self.s3.etags:
+            raise ClientError({"Error": {"Code": "404"}, "ResponseMetadata": {"HTTPStatusCode": 404}}, "HeadObject")
+        return {"ETag": self.s3.etags[Key]}
+
+
+class FakeMeta:
+    def __init__(self, s3):
+        self.client = FakeClient(s3)
+
+
+class FakeS3:
+    """
+    The boto3 S3 resource of S3FileManager. The uploads raise the errors queued in errors, or ConnectionError while
+    fail is set, and wait for the gate to be open.
+    """
+
+    def __init__(self):
+        self.uploads = {}       # S3 key -> uploaded content
+        self.extraArgs = {}     # S3 key -> ExtraArgs of its upload
+        self.etags = {}         # S3 key -> ETag, returned by head_object
+        self.order = []
+        self.errors = []
+        self.fail = False
+        self.heads = 0
+        self.gate = threading.Event()
+        self.gate.set()
+        self.meta = FakeMeta(self)
+
+    def Bucket(self, name):
+        return FakeBucket(self)
+
+
+@pytest.fixture
+def s3():
+    return FakeS3()
+
+
+@pytest.fixture
+def make_manager(s3):
+    # an S3FileManager of the bucket "bucket" uploading to the s3 fixture, retrying without waiting.
+    def make(edgeId="P", **kwargs):
+        manager = S3FileManager(edgeId, "bucket", **kwargs)
+        manager.s3 = s3
+        manager.retryPolicy.baseDelay = 0.001
+        return manager
+    return make
+
+
+@pytest.fixture
+def make_file(tmp_path):
+    def make(name, content=b"instance"):
+        path = os.path.join(str(tmp_path), name)
+        with open(path, "wb") as created:
+            created.write(content)
+        return path
+    return make
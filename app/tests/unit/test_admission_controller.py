@@ -0,0 +1,66 @@
+import time
+from concurrent.futures import Future
+
+from AdmissionController import AdmissionController
+
+
+class FakeUploader:
+    def __init__(self, queued_bytes):
+        self.queued_bytes = queued_bytes
+
+    def GetStats(self):
+        return {"queued_bytes": self.queued_bytes}
+
+
+class FakeTransaction:
+    def __init__(self, uploads=()):
+        self.transactionUploads = list(uploads)
+        self.admissionDeadline = None
+
+
+def make_controller(tmp_path, queued_bytes=0):
+    controller = AdmissionController(FakeUploader(queued_bytes), str(tmp_path))
+    controller.freeDiskLow = 0
+    controller.freeDiskHigh = 0
+    controller.maxPause = 0.3
+    return controller
+
+
+def test_admits_when_idle(tmp_path):
+    controller = make_controller(tmp_path)
+    assert controller.Admit()
+    assert controller.WaitForCapacity(FakeTransaction())
+
+
+def test_overload_pauses_a_transaction_once(tmp_path):
+    controller = make_controller(tmp_path, queued_bytes=controller_high() + 1)
+    transaction = FakeTransaction()
+    started = time.monotonic()
+    results = [controller.WaitForCapacity(transaction) for instance in range(5)]
+    assert results == [False] * 5
+    assert time.monotonic() - started < 2 * controller.maxPause
+
+
+def test_in_flight_cap_pauses_a_transaction_once(tmp_path):
+    controller = make_controller(tmp_path)
+    controller.maxInstancesInFlight = 2
+    transaction = FakeTransaction([Future(), Future()])
+    started = time.monotonic()
+    assert not any(controller.WaitForCapacity(transaction) for instance in range(5))
+    assert time.monotonic() - started < 2 * controller.maxPause
+    transaction.transactionUploads[0].set_result(True)
+    assert controller.WaitForCapacity(transaction)
+    assert len(transaction.transactionUploads) == 1
+
+
+def test_hysteresis(tmp_path):
+    controller = make_controller(tmp_path, queued_bytes=controller_high() + 1)
+    assert not controller.Admit()
+    controller.uploader.queued_bytes = AdmissionController.queuedBytesLow + 1
+    assert not controller.Admit()
+    controller.uploader.queued_bytes = AdmissionController.queuedBytesLow - 1
+    assert controller.Admit()
+
+
+def controller_high():
+    return AdmissionController.queuedBytesHigh
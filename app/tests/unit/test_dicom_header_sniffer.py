@@ -0,0 +1,114 @@
+import io
+import os
+
+import pytest
+from pydicom import uid
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.sequence import Sequence
+
+from DicomHeaderSniffer import DicomHeaderSniffer
+
+
+UID_TAGS = ("00080016", "00080018", "0020000D", "0020000E")
+TRANSFER_SYNTAXES = [
+    uid.ExplicitVRLittleEndian,
+    uid.ImplicitVRLittleEndian,
+    uid.ExplicitVRBigEndian,
+    uid.DeflatedExplicitVRLittleEndian,
+]
+
+
+def make_instance(transfer_syntax, undefined_length=True, pixels=1000):
+    meta = FileMetaDataset()
+    meta.MediaStorageSOPClassUID = "1.2.840.10008.5.1.4.1.1.2"
+    meta.MediaStorageSOPInstanceUID = uid.generate_uid()
+    meta.TransferSyntaxUID = transfer_syntax
+    ds = Dataset()
+    ds.file_meta = meta
+    ds.SOPClassUID = meta.MediaStorageSOPClassUID
+    ds.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+    ds.ImageType = ["ORIGINAL", "PRIMARY"]
+    # a nested sequence placed before the study and series UIDs.
+    code = Dataset()
+    code.CodeValue = "X"
+    item = Dataset()
+    item.ReferencedSOPInstanceUID = "1.2.3"
+    item.PurposeOfReferenceCodeSequence = Sequence([code])
+    ds.ReferencedImageSequence = Sequence([item, item])
+    if undefined_length:
+        ds.ReferencedImageSequence.is_undefined_length = True
+        for element in ds.ReferencedImageSequence:
+            element.is_undefined_length_sequence_item = True
+    ds.StudyInstanceUID = uid.generate_uid()
+    ds.SeriesInstanceUID = uid.generate_uid()
+    ds.PatientName = "Test^Patient"
+    ds.PixelData = os.urandom(pixels)
+    ds["PixelData"].VR = "OB"
+    return save(ds), ds
+
+
+def save(ds):
+    buffer = io.BytesIO()
+    try:
+        ds.save_as(buffer, enforce_file_format=True)
+    except TypeError:
+        # pydicom 2
+        transfer_syntax = ds.file_meta.TransferSyntaxUID
+        ds.is_implicit_VR = transfer_syntax.is_implicit_VR
+        ds.is_little_endian = transfer_syntax.is_little_endian
+        ds.save_as(buffer, write_like_original=False)
+    return buffer.getvalue()
+
+
+def sniff(data, feed_size):
+    sniffer = DicomHeaderSniffer()
+    for offset in range(0, len(data), feed_size):
+        if sniffer.feed(data[offset:offset + feed_size]):
+            break
+    return sniffer
+
+
+@pytest.mark.parametrize("transfer_syntax", TRANSFER_SYNTAXES)
+@pytest.mark.parametrize("undefined_length", [True, False])
+@pytest.mark.parametrize("feed_size", [1, 3, 7, 64, 1000000])
+def test_finds_the_uids(transfer_syntax, undefined_length, feed_size):
+    data, ds = make_instance(transfer_syntax, undefined_length)
+    sniffer = sniff(data, feed_size)
+    assert sniffer.done
+    found = sniffer.getDataset()
+    assert found is not None
+    for tag in UID_TAGS:
+        assert found[tag].value == ds[tag].value
+
+
+def test_stops_before_the_pixel_data():
+    data, ds = make_instance(uid.ExplicitVRLittleEndian, pixels=4000000)
+    sniffer = DicomHeaderSniffer()
+    assert sniffer.feed(data[:len(data) - 4000000])
+    assert sniffer.getDataset()["00080018"].value == ds.SOPInstanceUID
+
+
+def test_dataset_without_file_meta():
+    data, ds = make_instance(uid.ExplicitVRLittleEndian)
+    raw = io.BytesIO()
+    del ds.file_meta
+    try:
+        ds.save_as(raw, implicit_vr=True, little_endian=True)
+    except TypeError:
+        ds.is_implicit_VR, ds.is_little_endian = True, True
+        ds.save_as(raw)
+    sniffer = sniff(raw.getvalue(), 5)
+    assert sniffer.getDataset()["0020000D"].value == ds.StudyInstanceUID
+
+
+def test_gives_up_on_other_data():
+    sniffer = sniff(b"not a DICOM instance\r\n" * 500, 100)
+    assert sniffer.done
+    assert sniffer.getDataset() is None
+
+
+def test_incomplete_header_is_not_done():
+    data, ds = make_instance(uid.ExplicitVRLittleEndian)
+    sniffer = DicomHeaderSniffer()
+    assert not sniffer.feed(data[:200])
+    assert sniffer.getDataset() is None
@@ -0,0 +1,101 @@
+import io
+import os
+import threading
+import zlib
+
+from pydicom import dcmread, uid
+
+from ContentHasher import ContentHasher, crc32Value
+from InstanceCompressor import InstanceCompressor, deflatedFileMeta
+from tests.unit.test_dicom_header_sniffer import make_instance, save
+
+
+def compressible_instance(transfer_syntax=uid.ExplicitVRLittleEndian):
+    _ , ds = make_instance(transfer_syntax)
+    # 16 bits pixels of a smooth image, like the body in a CT slice.
+    ds.PixelData = b"".join( (1000 + (row*column) % 300).to_bytes(2, "little") for row in range(128) for column in range(128) )
+    ds["PixelData"].VR = "OW"
+    return save(ds)
+
+
+def test_instance_is_deflated(make_file):
+    original = compressible_instance()
+    path = make_file("a.dcm", original)
+    hasher = ContentHasher()
+    size = InstanceCompressor().Compress(path, hasher)
+    with open(path, "rb") as compressed:
+        data = compressed.read()
+    assert size == len(data) < len(original) / 2
+    assert hasher.checksum() == crc32Value(zlib.crc32(data))
+    expected = dcmread(io.BytesIO(original))
+    ds = dcmread(path)
+    assert ds.file_meta.TransferSyntaxUID == uid.DeflatedExplicitVRLittleEndian
+    assert ds.file_meta.MediaStorageSOPInstanceUID == expected.file_meta.MediaStorageSOPInstanceUID
+    assert ds.PixelData == expected.PixelData
+    assert ds.ReferencedImageSequence == expected.ReferencedImageSequence
+    assert [ element.tag for element in ds ] == [ element.tag for element in expected ]
+
+
+def test_other_instances_are_left_as_they_are(tmp_path, make_file):
+    compressor = InstanceCompressor()
+    instances = [
+        compressible_instance(uid.ImplicitVRLittleEndian),
+        make_instance(uid.ExplicitVRLittleEndian, pixels=100000)[0],    # random pixels do not shrink.
+        b"not a DICOM file" * 100,
+    ]
+    for index , original in enumerate(instances):
+        path = make_file(str(index), original)
+        assert compressor.Compress(path) is None
+        with open(path, "rb") as kept:
+            assert kept.read() == original
+    assert sorted(os.listdir(str(tmp_path))) == sorted( str(index) for index in range(len(instances)) )
+
+
+def test_truncated_file_meta():
+    element = b"\x02\x00\x10\x00UI\x14\x001.2.840.10008.1.2.1\x00"
+    assert deflatedFileMeta(element) == b"\x02\x00\x10\x00UI\x16\x001.2.840.10008.1.2.1.99"
+    assert deflatedFileMeta(element[:-4]) is None
+    assert deflatedFileMeta(element[:6]) is None
+    assert deflatedFileMeta(b"\x02\x00\x02\x00UI\x02\x001\x00") is None
+
+
+def test_queued_instances_are_compressed_before_their_upload(s3, make_manager, make_file):
+    manager = make_manager(compressor=InstanceCompressor())
+    original = compressible_instance()
+    path = make_file("a.dcm", original)
+    assert manager.AddSendJob([path, "/1/2/a.dcm"], checksum=crc32Value(zlib.crc32(original))).result() is True
+    manager.Shutdown(wait=True)
+    data = s3.uploads["P/1/2/a.dcm"]
+    assert len(data) < len(original)
+    assert s3.extraArgs["P/1/2/a.dcm"]["ChecksumCRC32"] == crc32Value(zlib.crc32(data))
+    assert manager.GetStats()["queued_bytes"] == 0
+
+
+def test_instance_is_uploaded_as_it_is_when_its_compression_fails(s3, make_manager, make_file):
+    class FailingCompressor(InstanceCompressor):
+        def Compress(self, filepath, hasher=None):
+            raise MemoryError()
+
+    manager = make_manager(compressor=FailingCompressor())
+    original = compressible_instance()
+    assert manager.AddSendJob([make_file("a.dcm", original), "/1/2/a.dcm"]).result(timeout=10) is True
+    manager.Shutdown(wait=True)
+    assert s3.uploads["P/1/2/a.dcm"] == original
+
+
+def test_upload_future_fails_when_the_compressed_job_cannot_be_queued(make_manager, make_file):
+    compressing = threading.Event()
+
+    class SlowCompressor(InstanceCompressor):
+        def Compress(self, filepath, hasher=None):
+            compressing.wait(10)
+            return super().Compress(filepath, hasher)
+
+    manager = make_manager(compressor=SlowCompressor())
+    upload = manager.AddSendJob([make_file("a.dcm", compressible_instance()), "/1/2/a.dcm"])
+    manager.executor.shutdown(wait=True)
+    compressing.set()
+    assert isinstance(upload.exception(timeout=10), RuntimeError)
+    manager.Shutdown(wait=True)
+    stats = manager.GetStats()
+    assert stats["queued"] == 0 and stats["queued_bytes"] == 0
@@ -0,0 +1,109 @@
+import hashlib
+import os
+
+import pytest
+from botocore.exceptions import ClientError
+from pydicom import uid
+
+from ContentHasher import S3ETagHasher
+from InstanceDeduplicator import InstanceDeduplicator
+from StowRsTransaction import StowRsTransaction
+from tests.unit.test_dicom_header_sniffer import make_instance
+
+MB = 1048576
+
+
+def hashed(data, chunk, threshold=8*MB, partSize=5*MB):
+    hasher = S3ETagHasher(threshold, partSize)
+    for start in range(0, len(data), chunk):
+        hasher.update(data[start:start+chunk])
+    return hasher.etag()
+
+
+def test_etag_of_a_single_part_object():
+    data = os.urandom(3*MB + 17)
+    assert hashed(data, 65536) == hashlib.md5(data).hexdigest()
+    assert hashed(b"", 1) == hashlib.md5(b"").hexdigest()
+
+
+@pytest.mark.parametrize("chunk", [1000003, 5*MB, 7*MB])
+def test_etag_of_a_multipart_object(chunk):
+    data = os.urandom(12*MB + 5)
+    parts = [ data[start:start+5*MB] for start in range(0, len(data), 5*MB) ]
+    expected = hashlib.md5(b"".join(hashlib.md5(part).digest() for part in parts)).hexdigest() + "-3"
+    assert hashed(data, chunk) == expected
+    # the threshold is where upload_file switches to a multipart upload.
+    assert hashed(data[:8*MB], chunk).endswith("-2")
+    assert hashed(data[:8*MB-1], chunk) == hashlib.md5(data[:8*MB-1]).hexdigest()
+
+
+def test_index_keeps_the_last_instances():
+    dedup = InstanceDeduplicator(headCheck=False)
+    dedup.capacity = 2
+    dedup.Remember("a", "1")
+    dedup.Remember("b", "2")
+    assert dedup.IsDuplicate("a", "1")
+    dedup.Remember("c", "3")
+    assert not dedup.IsDuplicate("b", "2")
+    assert dedup.IsDuplicate("a", "1") and dedup.IsDuplicate("c", "3")
+    assert not dedup.IsDuplicate("c", "4")
+
+
+def test_head_check():
+    def failing(key):
+        raise ClientError({"Error": {"Code": "403"}}, "HeadObject")
+
+    dedup = InstanceDeduplicator()
+    assert dedup.IsStored(lambda key: '"abc"', "a", "abc")
+    assert dedup.IsDuplicate("a", "abc")
+    assert not dedup.IsStored(lambda key: '"abd"', "b", "abc")
+    assert not dedup.IsStored(lambda key: None, "b", "abc")
+    assert not dedup.IsStored(failing, "b", "abc")
+    assert not InstanceDeduplicator(headCheck=False).IsStored(lambda key: '"abc"', "a", "abc")
+
+
+def etag_of(manager, content):
+    hasher = manager.NewContentHasher()
+    hasher.update(content)
+    return hasher.etag()
+
+
+def test_upload_skipped_when_s3_has_the_same_content(s3, make_manager, make_file):
+    s3.etags["P/1/2/a.dcm"] = '"%s"' % hashlib.md5(b"instance").hexdigest()
+    manager = make_manager(dedup=InstanceDeduplicator())
+    etag = etag_of(manager, b"instance")
+    assert manager.AddSendJob([make_file("a"), "/1/2/a.dcm"], etag=etag).result() is True
+    assert manager.AddSendJob([make_file("b", b"changed"), "/1/2/a.dcm"], etag=etag_of(manager, b"changed")).result() is True
+    manager.Shutdown(wait=True)
+    assert s3.uploads == {"P/1/2/a.dcm": b"changed"}
+    stats = manager.GetStats()
+    assert stats["duplicates"] == 1 and stats["uploaded"] == 1
+    # the uploaded content is the one in the index now.
+    assert manager.IsDuplicate("/1/2/a.dcm", etag_of(manager, b"changed"))
+    assert not manager.IsDuplicate("/1/2/a.dcm", etag)
+
+
+def test_jobs_without_etag_are_uploaded(s3, make_manager, make_file):
+    manager = make_manager(dedup=InstanceDeduplicator())
+    assert manager.AddSendJob([make_file("a"), "/1/2/a.dcm"]).result() is True
+    manager.Shutdown(wait=True)
+    assert s3.heads == 0 and s3.uploads == {"P/1/2/a.dcm": b"instance"}
+
+
+def test_transaction_skips_the_instances_sent_again(tmp_path, s3, make_manager):
+    manager = make_manager(dedup=InstanceDeduplicator(headCheck=False))
+    instance , _ = make_instance(uid.ExplicitVRLittleEndian)
+    responses = []
+    for duplicateWarning in (None, 0xB000):
+        transaction = StowRsTransaction(None, manager, str(tmp_path)+"/", None, duplicateWarning=duplicateWarning)
+        sink = transaction.OpenInstance()
+        sink.write(instance)
+        transaction.InstanceReceived(sink)
+        assert transaction.WaitForUploads(10)
+        responses.append(transaction)
+    manager.Shutdown(wait=True)
+    assert len(s3.uploads) == 1
+    first , second = responses
+    assert first.httpstatus == 200 and first.successInstance[0][3] is None
+    assert second.httpstatus == 202 and second.successInstance[0][3] == 0xB000
+    assert not os.path.exists(sink.filepath)
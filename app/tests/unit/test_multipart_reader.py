@@ -0,0 +1,250 @@
+import asyncio
+import base64
+import binascii
+import io
+import os
+import zlib
+
+import pytest
+
+from multipart_reader import AsyncMultipartReader, MultipartReader
+from multipart_reader import errors
+from multipart_reader.headers import parse_content_type
+from multipart_reader.streams import StreamReader
+
+
+HEADERS = [("Content-Type", 'multipart/related; type="application/dicom"; boundary=BND')]
+
+# payloads which look like the delimiter, or like a part of it.
+TRICKY_PARTS = [
+    b"y",
+    b"",
+    b"\r\n--BN\r\n--BNDX\r\n--BND-\r\n",
+    b"--BND",
+    b"data\r\n--BNData",
+    b"a\nb\r\n\r\n" * 1000,
+    os.urandom(300000),
+]
+
+
+def build_body(parts):
+    body = io.BytesIO()
+    for part in parts:
+        body.write(b"--BND\r\nContent-Type: application/dicom\r\n\r\n" + part + b"\r\n")
+    body.write(b"--BND--\r\n")
+    return body.getvalue()
+
+
+def read_parts(body, read_size, chunks=False):
+    reader = MultipartReader(HEADERS, io.BytesIO(body), read_size=read_size)
+    parts = []
+    try:
+        while part := reader.next():
+            if chunks:
+                parts.append(b"".join(part.iter_chunks()))
+            else:
+                parts.append(bytes(part.read()))
+    except StopIteration:
+        pass
+    return parts
+
+
+@pytest.mark.parametrize("read_size", [1, 2, 5, 6, 7, 8, 13, 4096, 1048576])
+def test_chunked_mode_splits_boundary_like_payloads(read_size):
+    assert read_parts(build_body(TRICKY_PARTS), read_size) == TRICKY_PARTS
+
+
+def test_line_mode_splits_boundary_like_payloads():
+    # a part starting with the boundary line can only be told apart by the chunked mode.
+    parts = [part for part in TRICKY_PARTS if part != b"--BND"]
+    parts += [b"\r\n--BNDX", b"a\r\n--BNDX\r\nb", b"ends with a line\r\n"]
+    assert read_parts(build_body(parts), None) == parts
+
+
+# delimiters followed by something else than the line end or '--' and the line end.
+LOOK_ALIKE_PARTS = [b"a\r\n--BND b", b"\r\n--BND\tc", b"d\r\n--BND\r e", b"\r\n--BND--f", b"g\r\n--BND\r\r\r\r\rh"]
+
+
+@pytest.mark.parametrize("read_size", [None, 1, 7, 65536])
+def test_look_alike_delimiters_are_data_in_both_modes(read_size):
+    assert read_parts(build_body(LOOK_ALIKE_PARTS), read_size) == LOOK_ALIKE_PARTS
+    assert read_parts_async(build_body(LOOK_ALIKE_PARTS), 3, read_size or 7) == LOOK_ALIKE_PARTS
+
+
+@pytest.mark.parametrize("read_size", [7, 65536])
+def test_iter_chunks_returns_the_same_data(read_size):
+    assert read_parts(build_body(TRICKY_PARTS), read_size, chunks=True) == TRICKY_PARTS
+
+
+def test_unread_parts_are_released():
+    body = build_body([os.urandom(100000), b"second"])
+    reader = MultipartReader(HEADERS, io.BytesIO(body), read_size=4096)
+    reader.next()
+    assert bytes(reader.next().read()) == b"second"
+
+
+def test_read_until_keeps_the_delimiter():
+    stream = StreamReader(io.BytesIO(b"abc--BNDdef"), read_size=2)
+    assert stream.read_until(b"--BND", 100) == (b"abc", True)
+    assert stream.read(5) == b"--BND"
+    assert stream.read() == b"def"
+
+
+def test_read_until_limits_the_size():
+    stream = StreamReader(io.BytesIO(b"0123456789--BND"), read_size=3)
+    data = []
+    while True:
+        chunk, found = stream.read_until(b"--BND", 4)
+        assert len(chunk) <= 4
+        data.append(chunk)
+        if found:
+            break
+    assert b"".join(data) == b"0123456789"
+
+
+def test_read_until_raises_without_delimiter():
+    stream = StreamReader(io.BytesIO(b"no delimiter"), read_size=4)
+    with pytest.raises(ValueError):
+        while True:
+            chunk, found = stream.read_until(b"--BND", 1024)
+            assert not found
+
+
+@pytest.mark.parametrize("read_size", [None, 4, 1048576])
+def test_content_length_parts(read_size):
+    body = (b"--BND\r\nContent-Length: 3\r\n\r\nabc\r\n"
+            b"--BND\r\nContent-Length: 2\r\n\r\nzz\r\n--BND--\r\n")
+    assert read_parts(body, read_size) == [b"abc", b"zz"]
+
+
+def read_parts_async(body, block_size, read_size):
+    source = io.BytesIO(body)
+
+    async def read():
+        return source.read(block_size)
+
+    async def parse():
+        return [b"".join([chunk async for chunk in part.iter_chunks()])
+                async for part in AsyncMultipartReader(HEADERS, read, read_size=read_size)]
+
+    return asyncio.run(parse())
+
+
+@pytest.mark.parametrize("block_size, read_size", [(1, 7), (3, 7), (65536, 1048576)])
+def test_async_reader_returns_the_same_parts(block_size, read_size):
+    assert read_parts_async(build_body(TRICKY_PARTS), block_size, read_size) == TRICKY_PARTS
+
+
+def test_async_reader_content_length_parts():
+    body = (b"--BND\r\nContent-Length: 3\r\n\r\nabc\r\n"
+            b"--BND\r\nContent-Length: 2\r\n\r\nzz\r\n--BND--\r\n")
+    assert read_parts_async(body, 5, None) == [b"abc", b"zz"]
+
+
+def encoded_part(data, headers):
+    return b"--BND\r\n" + headers + b"\r\n\r\n" + data + b"\r\n--BND--\r\n"
+
+
+def gzip_data(data):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def deflate_data(data):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+PAYLOAD = os.urandom(100000) + b"\0" * 500000
+ENCODINGS = [
+    (b"Content-Encoding: gzip", gzip_data(PAYLOAD)),
+    (b"Content-Encoding: deflate", deflate_data(PAYLOAD)),
+    (b"Content-Transfer-Encoding: base64", base64.encodebytes(PAYLOAD)),
+    (b"Content-Transfer-Encoding: quoted-printable", binascii.b2a_qp(PAYLOAD, istext=False)),
+    (b"Content-Transfer-Encoding: base64\r\nContent-Encoding: gzip", base64.encodebytes(gzip_data(PAYLOAD))),
+    (b"Content-Transfer-Encoding: binary", PAYLOAD),
+]
+
+
+@pytest.mark.parametrize("headers, data", ENCODINGS)
+@pytest.mark.parametrize("read_size", [None, 7, 4096, 1048576])
+def test_iter_chunks_decodes_the_parts(headers, data, read_size):
+    reader = MultipartReader(HEADERS, io.BytesIO(encoded_part(data, headers)), read_size=read_size)
+    part = reader.next()
+    chunks = list(part.iter_chunks(decode=True))
+    assert b"".join(chunks) == PAYLOAD
+    if read_size and b"Content-Encoding" in headers:
+        # the decompressor emits pieces of the read size at most.
+        assert max(len(chunk) for chunk in chunks) <= read_size
+
+
+@pytest.mark.parametrize("headers, data", ENCODINGS)
+def test_read_decodes_the_parts(headers, data):
+    reader = MultipartReader(HEADERS, io.BytesIO(encoded_part(data, headers)), read_size=65536)
+    assert bytes(reader.next().read(decode=True)) == PAYLOAD
+
+
+@pytest.mark.parametrize("headers, data", ENCODINGS)
+def test_async_reader_decodes_the_parts(headers, data):
+    source = io.BytesIO(encoded_part(data, headers))
+
+    async def read():
+        return source.read(5000)
+
+    async def parse():
+        return [b"".join([chunk async for chunk in part.iter_chunks(decode=True)])
+                async for part in AsyncMultipartReader(HEADERS, read, read_size=4096)]
+
+    assert asyncio.run(parse()) == [PAYLOAD]
+
+
+def test_truncated_gzip_part_raises():
+    body = encoded_part(gzip_data(PAYLOAD)[:-100], b"Content-Encoding: gzip")
+    part = MultipartReader(HEADERS, io.BytesIO(body), read_size=4096).next()
+    with pytest.raises(zlib.error):
+        b"".join(part.iter_chunks(decode=True))
+
+
+def test_unknown_encoding_raises():
+    body = encoded_part(b"data", b"Content-Encoding: br")
+    part = MultipartReader(HEADERS, io.BytesIO(body), read_size=4096).next()
+    with pytest.raises(RuntimeError):
+        list(part.iter_chunks(decode=True))
+
+
+@pytest.mark.parametrize("read_size", [None, 3, 4096])
+def test_part_headers(read_size):
+    body = (b"--BND\r\ncontent-type: application/dicom; transfer-syntax=1.2.840.10008.1.2.1\r\n"
+            b"Content-Location:  a:b \r\n\r\nfirst\r\n"
+            b"--BND\r\n\r\nno headers\r\n"
+            b"--BND\nContent-Type: application/dicom\n\nbare line feeds\r\n--BND--\r\n")
+    reader = MultipartReader(HEADERS, io.BytesIO(body), read_size=read_size)
+    first = reader.next()
+    assert first.headers["Content-Type"] == "application/dicom; transfer-syntax=1.2.840.10008.1.2.1"
+    assert first.headers.get("CONTENT-LOCATION") == "a:b"
+    assert "content-length" not in first.headers
+    assert bytes(first.read()) == b"first"
+    second = reader.next()
+    assert len(second.headers) == 0
+    assert bytes(second.read()) == b"no headers"
+    third = reader.next()
+    assert third.headers.get("content-type") == "application/dicom"
+    assert bytes(third.read()) == b"bare line feeds"
+
+
+def test_invalid_part_header_raises():
+    body = b"--BND\r\nnot a header\r\n\r\ndata\r\n--BND--\r\n"
+    with pytest.raises(errors.InvalidHeader):
+        MultipartReader(HEADERS, io.BytesIO(body), read_size=4096).next()
+
+
+def test_part_headers_are_limited():
+    body = b"--BND\r\n" + b"X-Padding: " + b"x" * 100000 + b"\r\n\r\ndata\r\n--BND--\r\n"
+    with pytest.raises(errors.LineTooLong):
+        MultipartReader(HEADERS, io.BytesIO(body), read_size=4096).next()
+
+
+def test_content_type_is_parsed_once():
+    assert parse_content_type("application/dicom; transfer-syntax=1.2") is \
+        parse_content_type("application/dicom; transfer-syntax=1.2")
+    assert parse_content_type("application/dicom; transfer-syntax=1.2")[3]["transfer-syntax"] == "1.2"
@@ -0,0 +1,60 @@
+import json
+import warnings
+
+import pytest
+from pydicom.uid import UID
+
+from StowRsJsonResponse import StowRsJsonResponse
+from StowRsXmlResponse import StowRsXmlResponse
+
+
+SOP_CLASS = UID("1.2.840.10008.5.1.4.1.1.2")
+WADO = "https://wado.example.com/studies/1.2.3"
+
+SUCCESS_LISTS = [
+    [],
+    [[SOP_CLASS, UID("1.2.3.4"), WADO + "/series/1.2.3.5/instances/1.2.3.4", None]],
+    [["1.2.840.10008.5.1.4.1.1.4", "1.2.3.%d" % index, WADO + "/instances/%d" % index, None] for index in range(50)],
+    # no WADO URL configured, a warning reason, characters json escapes.
+    [[SOP_CLASS, "1.2.3.4", "", None], ["1.2", "1.3", WADO, "0110"], ["1.2", "1.3", 'https://h/é"\\', 45063]],
+]
+FAILED_LISTS = [
+    [],
+    [["", "", "910"]],
+    [[SOP_CLASS, UID("1.2.3.9"), "0110"], ["1.2", "1.2.3", 272]],
+]
+
+
+@pytest.mark.parametrize("successlist", SUCCESS_LISTS)
+@pytest.mark.parametrize("failedlist", FAILED_LISTS)
+@pytest.mark.parametrize("retrieveUrl", [WADO, "", None])
+def test_json_response_matches_pydicom(successlist, failedlist, retrieveUrl):
+    with warnings.catch_warnings():
+        # pydicom warns about the escaped URL.
+        warnings.simplefilter("ignore")
+        expected = StowRsJsonResponse.generateDatasetResponse(successlist, failedlist, retrieveUrl)
+    assert StowRsJsonResponse.generateResponse(successlist, failedlist, retrieveUrl) == expected
+
+
+@pytest.mark.parametrize("generate", [StowRsJsonResponse.generateResponse, StowRsJsonResponse.generateDatasetResponse])
+def test_json_response_reasons_are_hexadecimal_status_codes(generate):
+    failedlist = [["1.2", "1.3", "A700"], ["1.2", "1.4", "C000"], ["1.2", "1.5", "A900"], ["1.2", "1.6", "0110"]]
+    document = json.loads(generate([["1.2", "1.7", WADO, "B000"], ["1.2", "1.8", WADO, 0xB007]], failedlist, WADO))
+    assert [item["00081197"]["Value"] for item in document["00081198"]["Value"]] == [[42752], [49152], [43264], [272]]
+    assert [item["00081196"]["Value"] for item in document["00081199"]["Value"]] == [[45056], [45063]]
+
+
+@pytest.mark.parametrize("successlist", SUCCESS_LISTS + [[["1.2", "1.3", "https://h/?a=1&b=<2>", None]] * 2000])
+@pytest.mark.parametrize("failedlist", FAILED_LISTS[:2])
+@pytest.mark.parametrize("retrieveUrl", [WADO, "", None])
+def test_xml_response_matches_element_tree(successlist, failedlist, retrieveUrl):
+    successlist = [[str(value) if value is not None else None for value in instance] for instance in successlist]
+    expected = StowRsXmlResponse.generateTreeResponse(successlist, failedlist, retrieveUrl)
+    assert StowRsXmlResponse.generateResponse(successlist, failedlist, retrieveUrl) == expected
+
+
+def test_xml_response_is_streamed():
+    successlist = [["1.2", "1.3.%d" % index, WADO, None] for index in range(3000)]
+    chunks = list(StowRsXmlResponse.iterResponse(successlist, [], WADO))
+    assert len(chunks) > 1
+    assert b"".join(chunks) == StowRsXmlResponse.generateTreeResponse(successlist, [], WADO)
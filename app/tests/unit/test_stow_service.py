@@ -0,0 +1,109 @@
+import asyncio
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from pydicom import uid
+
+import main
+from tests.unit.test_dicom_header_sniffer import make_instance
+
+
+CONTENT_TYPE = 'multipart/related; type="application/dicom"; boundary=BND'
+
+
+class Admission:
+    # admits the first instances of the requests, then refuses the others as if the service was overloaded.
+    def __init__(self, instances):
+        self.instances = instances
+
+    def Admit(self):
+        return True
+
+    def WaitForCapacity(self, transaction):
+        self.instances -= 1
+        return self.instances >= 0
+
+    async def WaitForCapacityAsync(self, transaction):
+        return self.WaitForCapacity(transaction)
+
+    def Notify(self):
+        pass
+
+
+@pytest.fixture
+def service(tmp_path, monkeypatch, make_manager):
+    # the globals main sets up from the environment, with the s3 fixture as the bucket.
+    settings = {
+        "tempfolder" : str(tmp_path) + "/", "WadoURL" : None, "responsedelay" : 0, "multipartreadsize" : 1048576,
+        "disklessmode" : False, "synccommit" : False, "admission" : Admission(1000),
+        "S3Sender" : make_manager(onUploaded=main.removeLocalFile), "ioExecutor" : ThreadPoolExecutor(max_workers=2),
+    }
+    for name , value in settings.items():
+        monkeypatch.setattr(main, name, value, raising=False)
+    yield main
+    main.S3Sender.Shutdown(wait=True)
+    main.ioExecutor.shutdown(wait=True)
+
+
+def multipart(parts):
+    body = b""
+    for headers , data in parts:
+        body += b"--BND\r\nContent-Type: application/dicom\r\n" + headers + b"\r\n" + data + b"\r\n"
+    return body + b"--BND--\r\n"
+
+
+def post_wsgi(body):
+    response = main.app.test_client().post("/studies", data=body, headers={"Content-Type": CONTENT_TYPE, "Accept": "application/dicom+json"})
+    return response.status_code , response.get_data()
+
+
+def post_asgi(body):
+    scope = { "type": "http", "method": "POST", "path": "/studies", "client": ("127.0.0.1", 1),
+              "headers": [(b"content-type", CONTENT_TYPE.encode()), (b"accept", b"application/dicom+json")] }
+    messages = [{ "type": "http.request", "body": body[start:start+65536], "more_body": start+65536 < len(body) }
+                for start in range(0, len(body), 65536)]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(main.asgiApp(scope, receive, send))
+    return sent[0]["status"] , b"".join(message.get("body", b"") for message in sent[1:])
+
+
+@pytest.fixture(params=[post_wsgi, post_asgi], ids=["wsgi", "asgi"])
+def post(request):
+    return request.param
+
+
+def response_reasons(body):
+    document = json.loads(body)
+    failed = [ (item["00081155"]["Value"][0], item["00081197"]["Value"][0]) for item in document["00081198"].get("Value", []) ]
+    stored = [ item["00081155"]["Value"][0] for item in document["00081199"].get("Value", []) ]
+    return failed , stored
+
+
+def test_refused_instances_are_reported_as_out_of_resources(service, post, s3):
+    service.admission = Admission(1)
+    instances = [ make_instance(uid.ExplicitVRLittleEndian) for index in range(2) ]
+    status , body = post(multipart([ (b"", data) for data , ds in instances ]))
+    assert status == 202
+    failed , stored = response_reasons(body)
+    assert failed == [(instances[1][1].SOPInstanceUID, 0xA700)]
+    assert stored == [instances[0][1].SOPInstanceUID]
+
+
+def test_part_which_cannot_be_decoded_fails_alone(service, post, s3):
+    instances = [ make_instance(uid.ExplicitVRLittleEndian) for index in range(3) ]
+    headers = [ b"", b"Content-Encoding: br\r\n", b"" ]
+    status , body = post(multipart([ (header, data) for header , ( data , ds ) in zip(headers, instances) ]))
+    assert status == 202
+    failed , stored = response_reasons(body)
+    assert failed == [(instances[1][1].SOPInstanceUID, 0xC000)]
+    assert stored == [instances[0][1].SOPInstanceUID, instances[2][1].SOPInstanceUID]
+    service.S3Sender.Shutdown(wait=True)
+    assert sorted(s3.uploads) == sorted( "P/%s/%s/%s.dcm" % (ds.StudyInstanceUID, ds.SeriesInstanceUID, ds.SOPInstanceUID) for data , ds in (instances[0], instances[2]) )
@@ -0,0 +1,58 @@
+import asyncio
+import os
+import threading
+import time
+from concurrent.futures import Future
+
+from StowRsTransaction import StowRsTransaction
+
+
+def make_transaction(uploads):
+    transaction = StowRsTransaction(None, None, "/tmp/", None)
+    transaction.transactionUploads = list(uploads)
+    return transaction
+
+
+def complete_later(upload, delay):
+    timer = threading.Timer(delay, upload.set_result, (True,))
+    timer.start()
+    return timer
+
+
+def test_wait_returns_when_the_uploads_are_done():
+    upload = Future()
+    complete_later(upload, 0.1)
+    started = time.monotonic()
+    assert make_transaction([upload]).WaitForUploads(10)
+    assert time.monotonic() - started < 5
+
+
+def test_wait_is_capped_by_the_delay():
+    started = time.monotonic()
+    assert not make_transaction([Future()]).WaitForUploads(0.2)
+    assert 0.2 <= time.monotonic() - started < 5
+
+
+def test_no_delay_does_not_wait():
+    assert not make_transaction([Future()]).WaitForUploads(0)
+    done = Future()
+    done.set_result(True)
+    assert make_transaction([done]).WaitForUploads(0)
+
+
+def test_async_wait():
+    upload = Future()
+    complete_later(upload, 0.1)
+    assert asyncio.run(make_transaction([upload]).WaitForUploadsAsync(10))
+    assert not asyncio.run(make_transaction([Future()]).WaitForUploadsAsync(0.1))
+
+
+def test_temp_file_of_a_failed_instance_is_removed(tmp_path, make_manager):
+    manager = make_manager()
+    transaction = StowRsTransaction(None, manager, str(tmp_path)+"/", None)
+    sink = transaction.OpenInstance()
+    sink.write(b"not a DICOM instance" * 100)
+    transaction.InstanceReceived(sink)
+    manager.Shutdown(wait=True)
+    assert transaction.failedInstance == [["", "", "0110"]] and transaction.httpstatus == 202
+    assert os.listdir(os.path.join(str(tmp_path), transaction.transactionuuid)) == []
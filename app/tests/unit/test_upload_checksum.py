@@ -0,0 +1,98 @@
+import os
+import zlib
+
+import pytest
+from botocore.httpchecksum import Crc32Checksum
+
+from ContentHasher import ContentHasher, crc32Value
+from S3FileManager import S3FileManager, S3StreamUpload
+from UploadConcurrencyController import UploadConcurrencyController
+from UploadRetryPolicy import UploadRetryPolicy
+
+MB = 1048576
+
+
+def sdk_crc32(data):
+    checksum = Crc32Checksum()
+    checksum.update(data)
+    return checksum.b64digest()
+
+
+def test_checksum_is_the_one_of_the_sdk():
+    data = os.urandom(3*MB + 5)
+    hasher = ContentHasher()
+    for start in range(0, len(data), 100000):
+        hasher.update(data[start:start+100000])
+    assert hasher.checksum() == sdk_crc32(data)
+    assert hasher.size == len(data) and hasher.etag() is None
+    assert ContentHasher(checksum=False).checksum() is None
+
+
+def test_upload_sends_the_checksum(monkeypatch, s3, make_manager, make_file):
+    monkeypatch.setenv("MULTIPARTTHRESHOLD", str(8*MB))
+    manager = make_manager()
+    small = make_file("small")
+    large = make_file("large", b"\0" * 8*MB)
+    assert manager.AddSendJob([small, "/small"], checksum="AAAAAQ==").result()
+    assert manager.AddSendJob([large, "/large"], checksum="AAAAAg==").result()
+    assert manager.AddSendJob([small, "/replayed"]).result()
+    manager.Shutdown(wait=True)
+    assert sorted(s3.extraArgs.items()) == [
+        ("P/large", {"ChecksumCRC32": "AAAAAg==", "Metadata": {"crc32": "AAAAAg=="}, "ChecksumAlgorithm": "CRC32", "ChecksumType": "FULL_OBJECT"}),
+        ("P/replayed", None),
+        ("P/small", {"ChecksumCRC32": "AAAAAQ==", "Metadata": {"crc32": "AAAAAQ=="}}),
+    ]
+
+
+def test_checksum_can_be_disabled(monkeypatch):
+    monkeypatch.setenv("UPLOADCHECKSUM", "none")
+    assert S3FileManager("P", "bucket").NewContentHasher() is None
+
+
+class RecordingClient:
+    def __init__(self):
+        self.calls = []
+
+    def create_multipart_upload(self, **kwargs):
+        self.calls.append(("create", kwargs))
+        return {"UploadId": "1"}
+
+    def upload_part(self, **kwargs):
+        self.calls.append(("part", kwargs))
+        return {"ETag": '"%d"' % kwargs["PartNumber"]}
+
+    def complete_multipart_upload(self, **kwargs):
+        self.calls.append(("complete", kwargs))
+
+    def put_object(self, **kwargs):
+        self.calls.append(("put", kwargs))
+
+
+def stream(data, checksum=True):
+    client = RecordingClient()
+    upload = S3StreamUpload(client, "bucket", "key", 5*MB, UploadRetryPolicy(UploadConcurrencyController(4, 4)), checksum)
+    for start in range(0, len(data), 300000):
+        upload.write(data[start:start+300000])
+    upload.complete()
+    return client.calls
+
+
+def test_stream_upload_sends_the_checksum_of_each_part():
+    data = os.urandom(12*MB)
+    create , first , second , third , complete = stream(data)
+    assert create[1]["ChecksumAlgorithm"] == "CRC32" and create[1]["ChecksumType"] == "FULL_OBJECT"
+    parts = [ data[:5*MB], data[5*MB:10*MB], data[10*MB:] ]
+    for ( name , kwargs ) , part in zip((first, second, third), parts):
+        assert kwargs["ChecksumCRC32"] == sdk_crc32(part)
+    assert complete[1]["ChecksumCRC32"] == sdk_crc32(data) and complete[1]["ChecksumType"] == "FULL_OBJECT"
+    assert [ part["ChecksumCRC32"] for part in complete[1]["MultipartUpload"]["Parts"] ] == [ sdk_crc32(part) for part in parts ]
+
+
+@pytest.mark.parametrize("checksum", [True, False])
+def test_small_stream_upload(checksum):
+    [( name , kwargs )] = stream(b"instance", checksum)
+    assert name == "put"
+    if checksum:
+        assert kwargs["ChecksumCRC32"] == crc32Value(zlib.crc32(b"instance")) and kwargs["Metadata"] == {"crc32": kwargs["ChecksumCRC32"]}
+    else:
+        assert "ChecksumCRC32" not in kwargs
@@ -0,0 +1,98 @@
+import threading
+
+from UploadConcurrencyController import UploadConcurrencyController
+
+
+def run_window(controller, now, successes, size=1048576, errors=0, saturated=True):
+    # one measure window of controller.interval seconds ending at now.
+    controller.saturated = saturated
+    controller.successes, controller.errors, controller.bytes = successes, errors, successes * size
+    controller.windowStart = now - controller.interval
+    return controller.Adjust(now)
+
+
+def test_limit_starts_within_the_bounds():
+    assert UploadConcurrencyController(16, 64).limit == 16
+    assert UploadConcurrencyController(100, 64).limit == 64
+    assert UploadConcurrencyController(0, 64, floor=2).limit == 2
+
+
+def test_throttling_halves_the_limit_once_per_cooldown():
+    controller = UploadConcurrencyController(16, 64)
+    controller.OnThrottled()
+    assert controller.limit == 8
+    controller.OnThrottled()   # within the cooldown, the same burst of SlowDown.
+    assert controller.limit == 8
+    controller.lastDecrease -= controller.cooldown
+    controller.OnThrottled()
+    assert controller.limit == 4
+
+
+def test_limit_never_goes_under_the_floor():
+    controller = UploadConcurrencyController(4, 64, floor=3)
+    controller.OnThrottled()
+    assert controller.limit == 3
+
+
+def test_limit_doubles_until_the_first_decrease():
+    controller = UploadConcurrencyController(4, 64)
+    assert run_window(controller, 100, successes=100) == 8
+    assert run_window(controller, 103, successes=200) == 16
+    controller.OnThrottled()
+    assert controller.limit == 8
+    assert run_window(controller, 106, successes=200) == 8
+    assert run_window(controller, 109, successes=200) == 10
+
+
+def test_saturated_uploads_grow_the_limit_while_the_throughput_grows():
+    controller = UploadConcurrencyController(16, 20)
+    controller.slowStart = False
+    assert run_window(controller, 100, successes=100) == 18
+    assert run_window(controller, 105, successes=120) == 20
+    # the ceiling is reached.
+    assert run_window(controller, 110, successes=140) == 20
+
+
+def test_limit_does_not_grow_without_waiting_uploads():
+    controller = UploadConcurrencyController(16, 64)
+    assert run_window(controller, 100, successes=100, saturated=False) == 16
+
+
+def test_growth_without_gain_is_undone_and_held():
+    controller = UploadConcurrencyController(16, 64)
+    assert run_window(controller, 100, successes=100) == 32
+    assert run_window(controller, 105, successes=101) == 16
+    for window in range(controller.holdIntervals):
+        assert run_window(controller, 110 + window * 5, successes=100) == 16
+    # the slow start is over.
+    assert run_window(controller, 200, successes=100) == 18
+
+
+def test_errors_halve_the_limit():
+    controller = UploadConcurrencyController(16, 64)
+    assert run_window(controller, 100, successes=90, errors=10) == 8
+    assert run_window(controller, 105, successes=99, errors=1) == 10
+    assert run_window(controller, 110, successes=99, errors=10, saturated=False) == 5
+
+
+def test_window_ends_after_the_interval():
+    controller = UploadConcurrencyController(16, 64)
+    controller.saturated = True
+    controller.windowStart -= controller.interval
+    controller.OnSuccess(1048576)
+    assert controller.limit == 32
+    assert controller.successes == 0
+
+
+def test_acquire_waits_for_a_slot():
+    controller = UploadConcurrencyController(1, 4)
+    controller.Acquire()
+    acquired = threading.Event()
+    waiter = threading.Thread(target=lambda: (controller.Acquire(), acquired.set()))
+    waiter.start()
+    assert not acquired.wait(0.1)
+    assert controller.saturated
+    controller.Release()
+    assert acquired.wait(1)
+    controller.Release()
+    waiter.join()
@@ -0,0 +1,55 @@
+import os
+
+from UploadJournal import UploadJournal
+
+
+def test_entries_survive_a_restart(tmp_path):
+    journal = UploadJournal(str(tmp_path / "journal.db"))
+    first = journal.Record(["/out/a", "/1/2/a.dcm"])
+    second = journal.Record(["/out/b", "/1/2/b.dcm"])
+    journal.MarkUploaded(first)
+    journal.Close()
+
+    reopened = UploadJournal(str(tmp_path / "journal.db"))
+    assert reopened.Pending() == [(second, ["/out/b", "/1/2/b.dcm"])]
+    assert reopened.Pending(owner=os.getpid()) == [(second, ["/out/b", "/1/2/b.dcm"])]
+    assert reopened.Pending(owner=-1) == []
+    reopened.Close()
+
+
+def test_replay_uploads_the_pending_files(tmp_path, s3, make_manager, make_file):
+    journal = UploadJournal(str(tmp_path / "journal.db"))
+    kept = make_file("kept.dcm")
+    journal.Record([kept, "/1/2/kept.dcm"])
+    journal.Record([str(tmp_path / "lost.dcm"), "/1/2/lost.dcm"])
+
+    manager = make_manager(journal=journal)
+    assert manager.ReplayJournal() == 1
+    manager.Shutdown(wait=True)
+    assert s3.uploads == {"P/1/2/kept.dcm": b"instance"}
+
+    journal = UploadJournal(str(tmp_path / "journal.db"))
+    assert journal.Pending() == []
+    journal.Close()
+
+
+def test_failed_upload_stays_in_the_journal(tmp_path, s3, make_manager, make_file):
+    journal = UploadJournal(str(tmp_path / "journal.db"))
+    path = make_file("a.dcm")
+    s3.fail = True
+    manager = make_manager(journal=journal)
+    assert manager.AddSendJob([path, "/1/2/a.dcm"]).result() is False
+    assert manager.GetStats()["kept_bytes"] == len(b"instance")
+    assert [obj for entryId, obj in journal.Pending()] == [[path, "/1/2/a.dcm"]]
+    manager.Shutdown(wait=True)
+
+
+def test_failed_upload_is_dropped_without_keepFailed(tmp_path, s3, make_manager, make_file):
+    journal = UploadJournal(str(tmp_path / "journal.db"))
+    path = make_file("a.dcm")
+    s3.fail = True
+    manager = make_manager(journal=journal, keepFailed=False)
+    assert manager.AddSendJob([path, "/1/2/a.dcm"]).result() is False
+    assert manager.GetStats()["kept_bytes"] == 0
+    assert journal.Pending() == []
+    manager.Shutdown(wait=True)
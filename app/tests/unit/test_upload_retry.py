@@ -0,0 +1,191 @@
+import os
+import threading
+
+import pytest
+from boto3.exceptions import S3UploadFailedError
+from botocore.exceptions import ClientError, EndpointConnectionError
+
+from DeadLetterFolder import DeadLetterFolder
+from UploadJournal import UploadJournal
+from UploadConcurrencyController import UploadConcurrencyController
+from UploadRetryPolicy import UploadInterrupted, UploadRetryPolicy, classifyError, PERMANENT, THROTTLED, TRANSIENT
+
+
+def client_error(code, status):
+    return ClientError({"Error": {"Code": code, "Message": code}, "ResponseMetadata": {"HTTPStatusCode": status}}, "PutObject")
+
+
+def upload_failed(cause):
+    # boto3 raises S3UploadFailedError while handling the ClientError.
+    try:
+        raise cause
+    except ClientError:
+        try:
+            raise S3UploadFailedError("Failed to upload")
+        except S3UploadFailedError as ex:
+            return ex
+
+
+def make_policy(maxAttempts=5, budget=500, ceiling=4):
+    policy = UploadRetryPolicy(UploadConcurrencyController(ceiling, ceiling))
+    policy.maxAttempts = maxAttempts
+    policy.baseDelay = 0.001
+    policy.budget = policy.tokens = budget
+    return policy
+
+
+@pytest.mark.parametrize("error, kind", [
+    (client_error("SlowDown", 503), THROTTLED),
+    (client_error("InternalError", 500), TRANSIENT),
+    (client_error("502", 502), TRANSIENT),
+    (client_error("AccessDenied", 403), PERMANENT),
+    (client_error("NoSuchBucket", 404), PERMANENT),
+    (upload_failed(client_error("SlowDown", 503)), THROTTLED),
+    (upload_failed(client_error("AccessDenied", 403)), PERMANENT),
+    (EndpointConnectionError(endpoint_url="http://s3"), TRANSIENT),
+    (ConnectionResetError(), TRANSIENT),
+    (FileNotFoundError(), PERMANENT),
+    (ValueError("bad"), PERMANENT),
+])
+def test_errors_are_classified(error, kind):
+    assert classifyError(error) == kind
+
+
+def test_backoff_grows_and_is_capped():
+    policy = make_policy()
+    policy.baseDelay, policy.maxDelay = 1.0, 5.0
+    for attempt in range(1, 10):
+        assert 0 <= policy.Delay(attempt) <= min(5.0, 2**(attempt-1))
+
+
+def test_transient_errors_are_retried():
+    policy = make_policy()
+    calls = []
+
+    def upload():
+        calls.append(1)
+        if len(calls) < 3:
+            raise client_error("InternalError", 500)
+        return "done"
+
+    assert policy.Call(upload, "upload") == "done"
+    assert len(calls) == 3
+    assert policy.retries == 2
+
+
+def test_permanent_errors_are_not_retried():
+    policy = make_policy()
+    calls = []
+
+    def upload():
+        calls.append(1)
+        raise client_error("AccessDenied", 403)
+
+    with pytest.raises(ClientError):
+        policy.Call(upload, "upload")
+    assert len(calls) == 1
+
+
+def test_attempts_are_bounded():
+    policy = make_policy(maxAttempts=3)
+    calls = []
+
+    def upload():
+        calls.append(1)
+        raise client_error("InternalError", 500)
+
+    with pytest.raises(ClientError):
+        policy.Call(upload, "upload")
+    assert len(calls) == 3
+
+
+def test_retry_budget_runs_out_and_is_refilled_by_successes():
+    policy = make_policy(budget=10)
+    assert policy.SpendRetry() and policy.SpendRetry()
+    assert not policy.SpendRetry()
+    for success in range(5):
+        policy.OnSuccess()
+    assert policy.SpendRetry()
+    assert not policy.SpendRetry()
+
+
+def test_stopping_interrupts_the_retries():
+    policy = make_policy()
+    policy.baseDelay = 60
+    stopping = threading.Event()
+    stopping.set()
+
+    def upload():
+        raise client_error("InternalError", 500)
+
+    with pytest.raises(UploadInterrupted):
+        policy.Call(upload, "upload", stopping)
+
+
+def test_throttled_responses_of_the_client_lower_the_concurrency():
+    class Events:
+        def register(self, name, handler):
+            self.handler = handler
+
+    class Client:
+        class meta:
+            events = Events()
+
+    policy = make_policy(ceiling=8)
+    policy.WatchClient(Client)
+    assert Client.meta.events.handler(response=(None, {"Error": {"Code": "SlowDown"}}), attempts=1) is None
+    assert Client.meta.events.handler(response=(None, {}), attempts=1) is None
+    assert policy.throttled == 1
+    assert policy.limiter.limit == 4
+
+
+def test_upload_succeeds_after_slowdowns(s3, make_manager, make_file):
+    s3.errors = [upload_failed(client_error("SlowDown", 503))] * 2
+    manager = make_manager()
+    assert manager.AddSendJob([make_file("a.dcm"), "/1/2/a.dcm"]).result() is True
+    assert s3.uploads == {"P/1/2/a.dcm": b"instance"}
+    assert manager.GetStats()["retries"] == 2
+    manager.Shutdown(wait=True)
+
+
+def test_failed_upload_goes_to_the_dead_letter_folder(tmp_path, s3, make_manager, make_file):
+    journal = UploadJournal(str(tmp_path / "journal.db"))
+    deadLetter = DeadLetterFolder(str(tmp_path / "deadletter"))
+    s3.errors = [client_error("AccessDenied", 403)]
+    manager = make_manager(deadLetter=deadLetter, journal=journal)
+    path = make_file("a.dcm")
+    assert manager.AddSendJob([path, "/1/2/a.dcm"]).result() is False
+    manager.Shutdown(wait=True)
+
+    assert not os.path.exists(path)
+    [entry] = deadLetter.Entries()
+    assert entry["bucket"] == "bucket" and entry["key"] == "P/1/2/a.dcm" and entry["size"] == len(b"instance")
+    assert "AccessDenied" in entry["error"]
+    with open(entry["file"], "rb") as kept:
+        assert kept.read() == b"instance"
+    stats = manager.GetStats()
+    assert stats["dead_lettered"] == 1 and stats["kept_bytes"] == 0
+    journal = UploadJournal(str(tmp_path / "journal.db"))
+    assert journal.Pending() == []
+    journal.Close()
+
+
+def test_dead_letters_are_replayed(tmp_path, monkeypatch, s3, make_manager, make_file):
+    monkeypatch.setenv("THREADCOUNT", "1")   # the first upload gets the error.
+    deadLetter = DeadLetterFolder(str(tmp_path / "deadletter"))
+    first = deadLetter.Add(make_file("a.dcm", b"a"), "bucket", "P/1/2/a.dcm", "SlowDown")
+    second = deadLetter.Add(make_file("b.dcm", b"b"), "bucket", "P/1/2/b.dcm", "SlowDown")
+    s3.errors = [client_error("AccessDenied", 403)]
+
+    def removeUploaded(obj, success):
+        if success:
+            os.remove(obj[0])
+
+    manager = make_manager(edgeId="", deadLetter=deadLetter, onUploaded=removeUploaded)
+    assert deadLetter.Replay(lambda bucket: manager) == (1, 1)
+    manager.Shutdown(wait=True)
+
+    assert s3.uploads == {"P/1/2/b.dcm": b"b"}
+    assert not os.path.exists(second)
+    [entry] = deadLetter.Entries()
+    assert entry["file"] == first and entry["key"] == "P/1/2/a.dcm"
@@ -0,0 +1,90 @@
+import pytest
+
+from UploadScheduler import DefaultPriority, FairUploadQueue, PriorityClasses, parsePriority
+
+
+STAT, HIGH, ROUTINE, LOW = (PriorityClasses[name] for name in ("stat", "high", "routine", "low"))
+
+
+def drain(queue):
+    jobs = []
+    while len(queue):
+        jobs.append(queue.Get())
+    return jobs
+
+
+def test_flows_are_served_in_turn():
+    queue = FairUploadQueue()
+    for index in range(4):
+        queue.Put(("bulk", index), flow="bulk")
+    queue.Put(("small", 0), flow="small")
+    queue.Put(("small", 1), flow="small")
+    assert drain(queue) == [("bulk", 0), ("small", 0), ("bulk", 1), ("small", 1), ("bulk", 2), ("bulk", 3)]
+
+
+def test_a_new_flow_does_not_wait_for_the_backlog():
+    queue = FairUploadQueue()
+    for index in range(1000):
+        queue.Put(index, flow="migration")
+    for index in range(10):
+        queue.Get()
+    queue.Put("urgent", flow="study")
+    assert queue.Flows() == 2
+    assert [queue.Get(), queue.Get()] == [10, "urgent"]
+
+
+def test_priority_classes_share_the_workers_by_weight():
+    queue = FairUploadQueue()
+    for index in range(100):
+        queue.Put("low", flow="migration", priority=LOW)
+        queue.Put("stat", flow="emergency", priority=STAT)
+    served = [queue.Get() for index in range(34)]
+    assert served.count("stat") == 32 and served.count("low") == 2
+
+
+def test_an_idle_class_does_not_get_the_turns_it_missed():
+    queue = FairUploadQueue()
+    for index in range(100):
+        queue.Put("routine", flow="a")
+    for index in range(50):
+        queue.Get()
+    for index in range(10):
+        queue.Put("low", flow="b", priority=LOW)
+    served = [queue.Get() for index in range(10)]
+    assert served.count("low") <= 3
+
+
+def test_fifo_mode_keeps_the_order():
+    queue = FairUploadQueue(fair=False)
+    queue.Put(1, flow="a", priority=LOW)
+    queue.Put(2, flow="b", priority=STAT)
+    queue.Put(3, flow="a")
+    assert drain(queue) == [1, 2, 3]
+
+
+def test_get_raises_when_empty():
+    with pytest.raises(IndexError):
+        FairUploadQueue().Get()
+
+
+@pytest.mark.parametrize("value, priority", [
+    (None, DefaultPriority), ("STAT", STAT), (" high ", HIGH), ("low", LOW), ("urgent!", DefaultPriority),
+])
+def test_priority_header_values(value, priority):
+    assert parsePriority(value) == priority
+
+
+def test_small_transaction_is_uploaded_before_the_end_of_a_bulk_one(monkeypatch, s3, make_manager, make_file):
+    monkeypatch.setenv("THREADCOUNT", "1")
+    monkeypatch.setenv("UPLOADCONCURRENCYMAX", "1")
+    s3.gate.clear()
+    manager = make_manager(edgeId="")
+    path = make_file("instance.dcm")
+    uploads = [ manager.AddSendJob([path, f"/bulk/{index}"], flow="bulk") for index in range(20) ]
+    uploads.append(manager.AddSendJob([path, "/small/0"], flow="small", priority=HIGH))
+    s3.gate.set()
+    assert all( upload.result() for upload in uploads )
+    manager.Shutdown(wait=True)
+    # the first bulk job was already taken by the worker when the small one was queued.
+    assert s3.order.index("/small/0") <= 2
+    assert sorted(s3.order) == sorted([f"/bulk/{index}" for index in range(20)] + ["/small/0"])
@@ -22,6 +22,7 @@ class Roles(Construct):
         effect = iam.Effect.ALLOW,
                     actions = [
                         's3:ListBucket',
+                        's3:GetObject',
                         's3:PutObject'
                     ],
                     resources = [dicom_s3_arn  , f"{dicom_s3_arn}/*" ]
@@ -95,7 +95,12 @@ FARGATE_TASK_DEF = {
         "envs" :{
             "PREFIX" : "STOWFG-1",
             "LOGLEVEL" : "WARNING",
-            "RESPONSEDELAY" : "0"
+            "RESPONSEDELAY" : "0",  #max seconds a response waits for the S3 uploads of its instances.
+            "THREADCOUNT" : "16",   #S3 uploads sent at the same time when the service starts.
+            "UPLOADCONCURRENCYMAX" : "64",  #the upload concurrency is adapted to the throughput and the errors, up to this ceiling.
+            "DEDUP" : "head",       #instances sent again with the same content are not uploaded : "none", "index" or "head" ( also asks S3 ).
+            "COMPRESSION" : "none", #"deflate" stores the uncompressed Explicit VR Little Endian instances deflated, lossless.
+            "WORKERS" : "1"         #STOW-RS worker processes, set to the number of vCPUs of the app container ( cpu / 1024 ).
         }
     }
 }